@@ -1,16 +1,36 @@
 import yt_dlp
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+import aiohttp
+from aiohttp import web
+from pyrogram import Client, filters, idle, raw
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, FloodWait, MediaEmpty, RPCError
+from pyrogram.session import Session
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, InputMediaVideo, InputMediaAudio
 import logging
+import logging.handlers
 import asyncio
 import concurrent.futures
+import contextlib
 import os
 import config
 import hashlib
+import base64
 import subprocess
 import sqlite3
 import uuid
+import re
 import sys
+import itertools
+import copy
+import time
+import shutil
+import socket
+import json
+import bisect
+import mmap
+import threading
+import collections
+import urllib.parse
 
 # ==========================================
 # CONFIGURATION AND LOGGING
@@ -66,42 +86,423 @@ def check_spotdl():
 
 SPOTDL_AVAILABLE = check_spotdl()
 
+def check_ffprobe():
+    """Checks for ffprobe next to the detected FFmpeg (used to read media parameters)"""
+    if not FFMPEG_PATH:
+        return None
+    path = os.path.join(os.path.dirname(FFMPEG_PATH), 'ffprobe') if os.path.dirname(FFMPEG_PATH) else 'ffprobe'
+    try:
+        subprocess.run([path, '-version'], capture_output=True, check=True)
+        return path
+    except:
+        return None
+
+FFPROBE_PATH = check_ffprobe()
+
 # Load settings from config.py
 API_ID = config.API_ID
 API_HASH = config.API_HASH
 BOT_TOKEN = config.BOT_TOKEN
 ALLOWED_USERS = getattr(config, 'ALLOWED_USERS', [])
+# Spotify API keys for spotDL (empty: spotDL's built-in keys)
+SPOTIFY_CLIENT_ID = getattr(config, 'SPOTIFY_CLIENT_ID', '')
+SPOTIFY_CLIENT_SECRET = getattr(config, 'SPOTIFY_CLIENT_SECRET', '')
+# Worker mode: the bot only queues jobs, `--worker` processes download and send them
+USE_WORKERS = getattr(config, 'USE_WORKERS', False)
+# Metrics endpoint port (0 - no endpoint); workers take theirs from the command line
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9464)
+METRICS_HOST = '127.0.0.1' # Local only: Prometheus or an agent on the same host scrapes it
 
 # Folder paths
 VIDEO_DIR = "./downloads/video/"
 AUDIO_DIR = "./downloads/audio/"
 DB_DIR = "./database/"
 THUMB_CACHE_DIR = "./thumbs_cache/"
+SOURCE_CACHE_DIR = "./downloads/sources/"
+# Small files are staged in RAM (tmpfs) and never touch the disk; None turns it off
+STAGING_TMPFS_DIR = "/dev/shm/media_downloader_bot/" if os.path.isdir("/dev/shm") else None
 SPOTIFY_DIR = "./downloads/spotify/"
+LOG_DIR = "./logs/"
+DB_PATH = os.path.join(DB_DIR, "bot_database.db")
 
 # File limits (2 GB for Telegram)
 MAX_FILE_SIZE_BYTES = 2000 * 1024 * 1024
 MAX_FILE_SIZE_MB = 1950
+# Larger files are cut into parts at keyframes (needs FFmpeg)
+SPLIT_OVERSIZE = True
+SPLIT_PART_SIZE_BYTES = 1900 * 1024 * 1024 # Target part size, with headroom for keyframe spacing
+MAX_SPLIT_PARTS = 4
+SPLIT_ATTEMPTS = 3 # Retries with shorter segments when a part still comes out too large
+SPLIT_UPLOAD_CONCURRENCY = 2 # Parts of one file uploaded at the same time
+PART_SEPARATOR = ',' # Between the file_ids of a multi-part file in the cache
+# Uploads to Telegram: a file is sent in parts over several media connections at once
+UPLOAD_CONNECTIONS = 4 # Media sessions kept open for uploads
+UPLOAD_REQUESTS_PER_CONNECTION = 2 # Parts in flight on each session
+UPLOAD_PART_SIZE = 512 * 1024 # Largest part Telegram accepts
+UPLOAD_BIG_FILE_SIZE = 10 * 1024 * 1024 # Larger files are uploaded as "big" files (Telegram rule)
+UPLOAD_PART_RETRIES = 5 # Attempts per part before the upload fails
+UPLOAD_RETRY_DELAY = 1 # Seconds, multiplied by the attempt number
+MAX_DOWNLOAD_SIZE_BYTES = MAX_SPLIT_PARTS * SPLIT_PART_SIZE_BYTES if SPLIT_OVERSIZE and FFMPEG_AVAILABLE else MAX_FILE_SIZE_BYTES
+MAX_DOWNLOAD_SIZE_MB = MAX_DOWNLOAD_SIZE_BYTES // (1024 * 1024) if SPLIT_OVERSIZE and FFMPEG_AVAILABLE else MAX_FILE_SIZE_MB
+# Size estimates the format planner accepts, with the headroom of MAX_FILE_SIZE_MB below the hard limits
+PLAN_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024 # Sent as one file
+PLAN_SIZE_LIMIT_BYTES = MAX_DOWNLOAD_SIZE_BYTES - (MAX_FILE_SIZE_BYTES - PLAN_FILE_SIZE_BYTES) # Split into parts if needed
+
+# Staging: every job works in its own folder, removed when the job ends
+STAGING_QUOTA_BYTES = 20 * 1024 * 1024 * 1024 # Jobs wait in the queue while job folders take more than this
+STAGING_MIN_FREE_BYTES = 1024 * 1024 * 1024 # ...or while the disk has less free space than this
+STAGING_TMPFS_MAX_FILE_BYTES = 64 * 1024 * 1024 # Largest job (source and result together) staged in RAM
+STAGING_TMPFS_MAX_BYTES = 512 * 1024 * 1024 # RAM taken by all staged jobs together
+STAGING_SWEEP_INTERVAL = 600 # Seconds between orphan sweeps
+STAGING_MEASURE_INTERVAL = 5 # Seconds between measurements of the staged bytes for the disk quota
+STAGING_ORPHAN_AGE = 3600 # Folders and files without a running job older than this (seconds) are removed
+
+# Sent media cache (reuse Telegram file_id instead of downloading again)
+MEDIA_CACHE_TTL_DAYS = 30
+MEDIA_CACHE_MAX_ENTRIES = 50000
+
+# Recently downloaded sources: audio requests take the audio track from them instead of downloading again
+SOURCE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Least recently used sources are removed above this size
+SOURCE_CACHE_MAX_FILE_BYTES = 512 * 1024 * 1024 # Larger files are not kept
+
+# FFmpeg post-processing: number of simultaneous ffmpeg processes and threads for each,
+# so that all of them together use the cores available to the bot
+CPU_CORES = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 2)
+FFMPEG_MAX_PROCESSES = max(1, CPU_CORES // 2)
+FFMPEG_THREADS = max(1, CPU_CORES // FFMPEG_MAX_PROCESSES)
+AUDIO_STREAM_COPY = True # Send AAC audio as M4A without re-encoding to MP3
+
+# Thumbnails sent with the files, cached by content hash
+THUMB_SIZE = 320 # Telegram limit for the longest side
+THUMB_CACHE_MAX_BYTES = 200 * 1024 * 1024 # Least recently used thumbnails are removed above this size
+THUMB_SOURCE_MAX_BYTES = 5 * 1024 * 1024 # Larger source images (posters, covers) are skipped
+THUMB_FETCH_TIMEOUT = 15 # Seconds to download a source image
+THUMB_FRAME_POSITION = 0.1 # Share of the duration where a video frame is taken when there is no poster
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024 # Bytes from the start and the end of a file hashed as its content key
+
+# Video quality: the planner picks the best one that fits into MAX_FILE_SIZE_MB, or into the parts when files are split
+MAX_VIDEO_HEIGHT = 1080
+QUALITY_STEPS = (720, 480, 360, 240) # Lower-quality buttons offered when the best quality doesn't fit
+
+# Playlists, albums and carousels
+BATCH_MAX_ITEMS = 50 # Entries taken from one playlist
+BATCH_MAX_BYTES = 4 * 1024 * 1024 * 1024 # Total downloaded size of one playlist
+BATCH_PARALLEL = 3 # Entries prepared at the same time (also bounded by the user's download slots)
+MEDIA_GROUP_SIZE = 10 # Telegram album limit
+
+# Spotify: tracks are matched to audio sources by spotDL, downloaded and tagged as MP3
+SPOTIFY_URL_PATTERN = re.compile(r'^https?://open\.spotify\.com/(?:intl-[\w-]+/)?(?:track|album|playlist)/\w+')
+SPOTIFY_MATCH_PARALLEL = 2 # Tracks of one link matched at the same time (runs ahead of the downloads)
+SPOTIFY_MATCH_TTL_DAYS = 30 # Days a track -> source match is reused without searching again
+SPOTDL_OPTIONS = {
+    'format': 'mp3',
+    'bitrate': '320k',
+    'audio_providers': ['youtube-music', 'youtube'],
+    'lyrics_providers': [],
+    'threads': 1, # Parallelism comes from the pipeline stages
+    'overwrite': 'force',
+    'simple_tui': True,
+    'log_level': 'ERROR',
+}
+
+# Link metadata prefetched when the link arrives
+METADATA_CACHE_TTL = 600 # Seconds
+METADATA_CACHE_MAX_ENTRIES = 500
 
 # Create required directories
 os.makedirs(VIDEO_DIR, exist_ok=True)
 os.makedirs(AUDIO_DIR, exist_ok=True)
 os.makedirs(DB_DIR, exist_ok=True)
 os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+if STAGING_TMPFS_DIR:
+    os.makedirs(STAGING_TMPFS_DIR, exist_ok=True)
 os.makedirs(SPOTIFY_DIR, exist_ok=True)
+os.makedirs(LOG_DIR, exist_ok=True)
 
 # Initialize Pyrogram client
-app = Client(name="media_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Files uploaded ahead of sending their messages: path -> InputFile, used once by the send
+prepared_uploads = {}
+
+class MediaClient(Client):
+    """Pyrogram client that uploads files from disk through upload_engine"""
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """Files on disk go in parallel parts, in-memory files the standard way"""
+        if not isinstance(path, str):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+        if file_id is None and path in prepared_uploads:
+            return prepared_uploads.pop(path)
+        return await upload_engine.save_file(self, path, file_id, file_part, progress, progress_args)
+
+app = MediaClient(name="media_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # YouTube settings
 YOUTUBE_COOKIES_FILE = './cookies.txt'
+YDL_POOL_SIZE = 4 # Idle YoutubeDL instances kept per profile (metadata, video, audio)
 loop = asyncio.get_event_loop()
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
 
 # Download queue management
 active_downloads = {}
 downloads_lock = asyncio.Lock()
 MAX_CONCURRENT_DOWNLOADS = 2 # Max simultaneous downloads per user
+MAX_GLOBAL_DOWNLOADS = 6 # Max simultaneous downloads for the whole bot
+MAX_QUEUED_PER_USER = 5 # Max jobs waiting in the queue per user
+QUEUE_STATUS_INTERVAL = 5 # Seconds between queue position updates
+# Running download jobs: cancelled on shutdown and resumed from the jobs table after the restart
+job_tasks = set()
+JOB_MAX_RESUMES = 3 # Restarts a job is resumed after, then it is given up
+JOB_JOURNAL_DAYS = 2 # Journal entries older than this are dropped by the database cleanup
+# Who runs the jobs of this process: 'local' for the bot itself, "host/name" for a `--worker` process
+WORKER_ID = 'local'
+WORKER_POLL_INTERVAL = 2 # Seconds between checks of the shared queue
+WORKER_HEARTBEAT_INTERVAL = 10 # Seconds between a worker's "alive" marks on its jobs
+WORKER_HEARTBEAT_TIMEOUT = 60 # Jobs of a worker silent for this long are taken over by other workers
+WORKER_DIR_PREFIX = 'worker_' # Workers keep their job folders and sources in "worker_<name>" subfolders
+# Pipeline stages (metadata -> network download -> ffmpeg -> probe and thumbnail -> upload to Telegram -> cleanup):
+# each one has its own concurrency limit and a bounded queue in front of it
+STAGE_LIMITS = {'resolve': 4, 'download': 4, 'postprocess': FFMPEG_MAX_PROCESSES, 'probe': 2, 'upload': 3, 'cleanup': 2}
+STAGE_QUEUE_SIZES = {'resolve': 16, 'download': 4, 'postprocess': 2, 'probe': 4, 'upload': 2, 'cleanup': 16}
+# Waiting jobs: user_id -> queue of tickets, plus round-robin order of users
+job_queues = {}
+queue_order = collections.deque()
+
+PROGRESS_EDIT_INTERVAL = 4 # Min seconds between edits of one status message
+
+# Identical downloads in progress: (cache key, format) -> future with the sent file_id and its progress
+inflight_downloads = {}
+
+# Prefetched metadata: normalized URL -> {'expires', 'info', 'sizes'}, plus extractions in progress
+metadata_cache = collections.OrderedDict()
+metadata_fetches = {}
+metadata_cache_stats = {'hits': 0, 'misses': 0}
+# Background tasks that add metadata to format selection messages: (chat_id, message_id) -> task
+describe_tasks = {}
+
+# Link tokens for buttons: in-memory LRU in front of the url_mappings table
+URL_TOKEN_BYTES = 9 # Digest bytes in a token (12 characters of base64)
+URL_CACHE_MAX_ENTRIES = 10000
+url_cache = collections.OrderedDict()
+url_cache_stats = {'hits': 0, 'misses': 0}
+# Lookups of already sent files (media_cache table)
+media_cache_stats = {'hits': 0, 'misses': 0}
+
+# Jobs that have a staging folder: unique_id -> job
+staging_jobs = {}
+# Bytes in disk job folders and free disk space, measured off the event loop by maintain_staging
+staging_usage = {'bytes': 0, 'free': None}
+
+# Source cache: media key -> {'path', 'size', 'format', 'users'} in LRU order
+source_cache = collections.OrderedDict()
+source_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+# Direct links to media files: downloaded with aiohttp without yt-dlp extractors
+DIRECT_MEDIA_EXTENSIONS = {'mp4', 'm4v', 'mov', 'webm', 'mkv', 'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac', 'wav'}
+DIRECT_AUDIO_EXTENSIONS = {'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac', 'wav'}
+DIRECT_PROBE_TIMEOUT = 10 # Seconds for the HEAD request
+DIRECT_CHUNK_SIZE = 1024 * 1024 # Bytes read from the socket at a time
+DIRECT_CONNECTIONS = 4 # Parallel range requests per file
+DIRECT_SPLIT_MIN_SIZE = 16 * 1024 * 1024 # Smaller files are downloaded over one connection
+HTTP_MAX_CONNECTIONS = 64
+http_session = None
+
+# Download engine: 'segmented' fetches fragments and large files over several connections, 'single' over one
+DOWNLOAD_ENGINE = 'segmented'
+FRAGMENT_CONNECTIONS = 4 # Parallel HLS/DASH fragment downloads per file
+FRAGMENTED_PROTOCOLS = ('m3u8', 'm3u8_native', 'http_dash_segments')
+HOST_MAX_CONNECTIONS = 8 # Connections to one host across all jobs
+DOWNLOAD_BANDWIDTH_LIMIT = 0 # Bytes/sec shared by all active downloads, 0 = unlimited
+
+# Inline mode
+INLINE_URL_PATTERN = re.compile(r'^https?://[^\s/]+\.[^\s/]+(/\S*)?$')
+INLINE_DEBOUNCE = 0.6 # Seconds without new input before a query is answered
+INLINE_METADATA_WAIT = 2 # Seconds to wait for link metadata before answering without it
+INLINE_CACHE_TIME = 300 # Seconds Telegram may reuse our answer for the same query
+INLINE_CACHE_TIME_PARTIAL = 10 # Same, for an answer without metadata
+INLINE_RESULTS_TTL = 600 # Seconds
+INLINE_RESULTS_MAX_ENTRIES = 1000
+# Ready answers: normalized URL -> {'expires', 'results'}, plus pending answers: user_id -> task
+inline_results = collections.OrderedDict()
+inline_tasks = {}
+
+# ==========================================
+# METRICS AND JOB LOG
+# ==========================================
+
+# Metric -> (type, help, histogram buckets)
+METRIC_SECONDS_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+METRIC_SPEED_BUCKETS = tuple(64 * 1024 * 2 ** power for power in range(12)) # 64 KB/s .. 128 MB/s
+METRIC_DEFINITIONS = {
+    'bot_extract_seconds': ('histogram', "Link metadata extraction time", METRIC_SECONDS_BUCKETS),
+    'bot_queue_wait_seconds': ('histogram', "Wait for a download slot in the fair queue", METRIC_SECONDS_BUCKETS),
+    'bot_stage_wait_seconds': ('histogram', "Wait for a slot of a pipeline stage", METRIC_SECONDS_BUCKETS),
+    'bot_stage_seconds': ('histogram', "Time a job holds a pipeline stage slot", METRIC_SECONDS_BUCKETS),
+    'bot_ffmpeg_seconds': ('histogram', "Run time of one ffmpeg process", METRIC_SECONDS_BUCKETS),
+    'bot_upload_seconds': ('histogram', "Upload time of one file to Telegram", METRIC_SECONDS_BUCKETS),
+    'bot_transfer_bytes_per_second': ('histogram', "Job speed in the download and upload stages", METRIC_SPEED_BUCKETS),
+    'bot_transfer_bytes_total': ('counter', "Bytes downloaded and uploaded by jobs", None),
+    'bot_db_seconds': ('histogram', "SQLite latency: queries as callers see them, write-behind batch commits", METRIC_SECONDS_BUCKETS),
+    'bot_jobs_total': ('counter', "Finished jobs by result", None),
+    'bot_job_seconds': ('histogram', "Job time from the button press to the result", METRIC_SECONDS_BUCKETS),
+    # Read from the bot's state on every scrape
+    'bot_cache_requests_total': ('counter', "Cache lookups by cache and result", None),
+    'bot_upload_parts_total': ('counter', "Parts sent by the upload engine", None),
+    'bot_upload_part_retries_total': ('counter', "Upload parts sent again after an error", None),
+    'bot_upload_engine_bytes_total': ('counter', "Bytes sent by the upload engine", None),
+    'bot_ydl_instances_total': ('counter', "YoutubeDL instances taken from the pool: created or reused", None),
+    'bot_active_downloads': ('gauge', "Jobs holding a download slot", None),
+    'bot_queued_downloads': ('gauge', "Jobs waiting in the fair queue", None),
+    'bot_stage_active': ('gauge', "Jobs running in a pipeline stage", None),
+    'bot_stage_waiting': ('gauge', "Jobs queued for a pipeline stage slot", None),
+    'bot_stage_limit': ('gauge', "Concurrency limit (threads) of a pipeline stage", None),
+    'bot_db_pending_writes': ('gauge', "Writes waiting in the write-behind queue", None),
+    'bot_upload_connections': ('gauge', "Open media sessions of the upload engine", None),
+    'bot_upload_active': ('gauge', "Files being uploaded by the upload engine", None),
+    'bot_upload_engine_bytes_per_second': ('gauge', "Upload engine speed over the time anything was uploading", None),
+    'bot_source_cache_bytes': ('gauge', "Size of the kept download sources", None),
+    'bot_ydl_idle': ('gauge', "Idle YoutubeDL instances in the pool by profile", None),
+}
+
+# Per-job JSON log, one object per line (written regardless of MINIMAL_LOGGING)
+JOB_LOG_PATH = os.path.join(LOG_DIR, "jobs.log")
+JOB_LOG_MAX_BYTES = 10 * 1024 * 1024
+JOB_LOG_BACKUPS = 3
+
+class Metrics:
+    """Counters and histograms in Prometheus text format (thread-safe: stage and database threads report too)"""
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        """Adds to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records one histogram observation"""
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.values.setdefault(key, {'counts': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0})
+            series['counts'][bisect.bisect_left(buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, samples):
+        """Text exposition of all series plus the samples read at scrape time"""
+        with self.lock:
+            values = copy.deepcopy(self.values)
+        series = collections.defaultdict(list)
+        for (name, labels), value in values.items():
+            series[name].append((labels, value))
+        for name, labels, value in samples:
+            series[name].append((tuple(sorted(labels.items())), value))
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            if name not in series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in series[name]:
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                # Buckets are cumulative in the exposition format
+                for bound, count in zip(buckets + ('+Inf',), itertools.accumulate(value['counts'])):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    """Prometheus label set: {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in labels) + '}'
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+job_log = logging.getLogger('jobs')
+job_log.setLevel(logging.INFO)
+job_log.propagate = False
+job_log.addHandler(logging.handlers.RotatingFileHandler(JOB_LOG_PATH, maxBytes=JOB_LOG_MAX_BYTES, backupCount=JOB_LOG_BACKUPS, encoding='utf-8'))
+
+def log_job(record, url, format_type, quality, user_id, seconds):
+    """Writes a finished job to the JSON job log and the job metrics"""
+    result = record.get('result', 'failed')
+    metrics.inc('bot_jobs_total', result=result)
+    metrics.observe('bot_job_seconds', seconds, result=result)
+    job_log.info(json.dumps({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'job_id': record['job_id'],
+        'worker': WORKER_ID,
+        'user_id': user_id,
+        'url': url,
+        'format': format_type,
+        'quality': quality,
+        'result': result,
+        'error': record.get('error'),
+        'seconds': round(seconds, 2),
+        'queue_seconds': record.get('queue_seconds'),
+        'stages': record.get('stages', {}),
+    }, ensure_ascii=False))
+
+def collect_metrics():
+    """Gauges and cache counters read from the bot's state at scrape time"""
+    upload_stats = upload_engine.stats()
+    samples = [
+        ('bot_active_downloads', {}, sum(map(len, active_downloads.values()))),
+        ('bot_queued_downloads', {}, sum(map(len, job_queues.values()))),
+        ('bot_db_pending_writes', {}, len(db.pending)),
+        ('bot_upload_connections', {}, upload_stats['connections']),
+        ('bot_upload_active', {}, upload_stats['active_uploads']),
+        ('bot_upload_parts_total', {}, upload_stats['parts']),
+        ('bot_upload_part_retries_total', {}, upload_stats['retries']),
+        ('bot_upload_engine_bytes_total', {}, upload_stats['bytes']),
+        ('bot_source_cache_bytes', {}, source_cache_stats['bytes']),
+    ]
+    if upload_stats['bytes_per_sec'] is not None:
+        samples.append(('bot_upload_engine_bytes_per_second', {}, upload_stats['bytes_per_sec']))
+    pool_stats = ydl_pool.stats()
+    samples += [
+        ('bot_ydl_instances_total', {'result': 'created'}, pool_stats['created']),
+        ('bot_ydl_instances_total', {'result': 'reused'}, pool_stats['reused']),
+    ]
+    samples += [('bot_ydl_idle', {'profile': profile}, idle) for profile, idle in pool_stats['idle'].items()]
+    for stage, stats in get_pipeline_stats().items():
+        samples += [
+            ('bot_stage_active', {'stage': stage}, stats['active']),
+            ('bot_stage_waiting', {'stage': stage}, stats['waiting']),
+            ('bot_stage_limit', {'stage': stage}, stats['limit']),
+        ]
+    for cache, stats in (('url', url_cache_stats), ('metadata', metadata_cache_stats), ('media', media_cache_stats), ('source', source_cache_stats)):
+        samples += [
+            ('bot_cache_requests_total', {'cache': cache, 'result': 'hit'}, stats['hits']),
+            ('bot_cache_requests_total', {'cache': cache, 'result': 'miss'}, stats['misses']),
+        ]
+    return samples
+
+async def metrics_handler(request):
+    """GET /metrics"""
+    return web.Response(body=metrics.render(collect_metrics()).encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def serve_metrics(port):
+    """Background task: serves /metrics on METRICS_HOST until cancelled"""
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        console_log(f"Metrics: http://{METRICS_HOST}:{port}/metrics")
+        await loop.create_future()
+    except OSError as e:
+        console_log(f"Metrics endpoint not started: {e}")
+    finally:
+        await runner.cleanup()
 
 # ==========================================
 # DATABASE OPERATIONS (SQLITE)
@@ -109,12 +510,25 @@ MAX_CONCURRENT_DOWNLOADS = 2 # Max simultaneous downloads per user
 
 def get_db_connection():
     """Creates a database connection"""
-    DB_PATH = os.path.join(DB_DIR, "bot_database.db")
     return sqlite3.connect(DB_PATH)
 
+# Database retention: table -> days rows are kept, and the date column they are aged by
+DB_RETENTION_DAYS = {'url_mappings': 30, 'captions': 30, 'command_limits': 90, 'media_cache': MEDIA_CACHE_TTL_DAYS, 'spotify_matches': SPOTIFY_MATCH_TTL_DAYS, 'jobs': JOB_JOURNAL_DAYS}
+DB_RETENTION_COLUMNS = {'url_mappings': 'date_created', 'captions': 'date_created', 'command_limits': 'usage_date', 'media_cache': 'date_created', 'spotify_matches': 'date_created', 'jobs': 'date_created'}
+DB_MAINTENANCE_INTERVAL = 3600 # Seconds between cleanup passes
+DB_DELETE_CHUNK = 1000 # Rows per delete transaction, keeps write locks short
+DB_DELETE_PAUSE = 0.05 # Seconds between chunks so other writes get through
+DB_VACUUM_PAGES = 2000 # Free pages returned to the OS per pass
+
 def init_db():
     """Creates tables if they don't exist"""
     conn = get_db_connection()
+    # Freed pages are returned to the OS by incremental_vacuum (an existing file is rebuilt once)
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    # WAL: readers don't wait for writers, commits don't rewrite the main file
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     # Users table
     cursor.execute('''
@@ -142,6 +556,47 @@ def init_db():
             date_created TEXT
         )
     ''')
+    # Sent media cache (source key + format -> Telegram file_id)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            cache_key TEXT,
+            format_type TEXT,
+            file_id TEXT,
+            date_created TEXT,
+            last_used TEXT,
+            PRIMARY KEY (cache_key, format_type)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache (last_used)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_file_id ON media_cache (file_id)')
+    # Spotify track -> matched audio source (popular tracks skip the search)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS spotify_matches (
+            track_id TEXT PRIMARY KEY,
+            source_url TEXT,
+            date_created TEXT
+        )
+    ''')
+    # Job journal: unfinished jobs with their stage, folder and finished parts, resumed after a restart
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            url TEXT,
+            format_type TEXT,
+            quality INTEGER,
+            user_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            stage TEXT,
+            job_dir TEXT,
+            parts TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            heartbeat TEXT,
+            date_created TEXT,
+            date_updated TEXT
+        )
+    ''')
     # Usage limits table (for future use)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS command_limits (
@@ -151,25 +606,220 @@ def init_db():
             PRIMARY KEY (user_id, usage_date)
         )
     ''')
+    # Date indexes for retention cleanup
+    for table, column in DB_RETENTION_COLUMNS.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})')
     conn.commit()
     conn.close()
 
 init_db()
 
+# Write-behind settings
+DB_FLUSH_INTERVAL = 0.5 # Seconds a write may wait to be grouped with others
+DB_BATCH_SIZE = 200 # Writes per transaction that trigger an immediate flush
+
+class Database:
+    """Long-lived SQLite connection on its own thread with batched write-behind"""
+
+    def __init__(self, path):
+        self.path = path
+        # One thread owns the connection: statements run strictly in submission order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn = None
+        self.pending = []
+        self.flush_handle = None
+
+    def _run(self, func):
+        """Runs func(conn) on the database thread, opening the connection on first use"""
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('PRAGMA busy_timeout=5000')
+        return func(self.conn)
+
+    async def call(self, func):
+        """Runs func(conn) on the database thread after all writes queued before it"""
+        self.flush()
+        started = time.monotonic()
+        try:
+            return await loop.run_in_executor(self.executor, self._run, func)
+        finally:
+            metrics.observe('bot_db_seconds', time.monotonic() - started, operation='query')
+
+    async def fetchone(self, sql, params=()):
+        """Reads one row"""
+        return await self.call(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        """Reads all rows"""
+        return await self.call(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Writes immediately in its own transaction and returns the number of changed rows"""
+        def work(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.call(work)
+
+    def write(self, sql, params=()):
+        """Queues a write; queued writes are committed together in one transaction"""
+        self.pending.append((sql, params))
+        if len(self.pending) >= DB_BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(DB_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """Sends queued writes to the database thread as one batch"""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return None
+        batch, self.pending = self.pending, []
+        future = loop.run_in_executor(self.executor, self._run, lambda conn: self._write_batch(conn, batch))
+        future.add_done_callback(self._report_batch)
+        return future
+
+    @staticmethod
+    def _write_batch(conn, batch):
+        """Commits a batch; runs of the same statement go through executemany"""
+        started = time.monotonic()
+        with conn:
+            for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                conn.executemany(sql, [params for _, params in group])
+        metrics.observe('bot_db_seconds', time.monotonic() - started, operation='write_batch')
+
+    @staticmethod
+    def _report_batch(future):
+        """Logs a failed write-behind batch"""
+        if not future.cancelled() and future.exception():
+            console_log(f"Database write failed: {future.exception()}")
+
+    async def close(self):
+        """Commits queued writes and closes the connection"""
+        future = self.flush()
+        if future:
+            await asyncio.wait({future})
+        if self.conn is not None:
+            await loop.run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+
+db = Database(DB_PATH)
+
+async def purge_expired_rows(table, column, days):
+    """Deletes rows older than the retention period in small chunks and returns how many were removed"""
+    removed = 0
+    while True:
+        count = await db.execute(f'''
+            DELETE FROM {table} WHERE rowid IN (
+                SELECT rowid FROM {table} WHERE {column} < datetime('now', ?) LIMIT ?
+            )
+        ''', (f'-{days} days', DB_DELETE_CHUNK))
+        removed += count
+        if count < DB_DELETE_CHUNK:
+            return removed
+        await asyncio.sleep(DB_DELETE_PAUSE)
+
+async def maintain_database():
+    """Background task: applies table retention and returns freed pages to the OS"""
+    while True:
+        try:
+            for table, days in DB_RETENTION_DAYS.items():
+                removed = await purge_expired_rows(table, DB_RETENTION_COLUMNS[table], days)
+                if removed:
+                    console_log(f"DB cleanup: {table} -{removed} rows")
+            await db.call(lambda conn: conn.execute(f'PRAGMA incremental_vacuum({DB_VACUUM_PAGES})').fetchall())
+            # Keep the WAL file from growing between automatic checkpoints
+            await db.call(lambda conn: conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"DB maintenance failed: {e}")
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+
 # ==========================================
 # DOWNLOAD FLOW CONTROL
 # ==========================================
 
-async def can_start_download(user_id):
-    """Checks if a user can start a new download"""
+async def acquire_download_slot(user_id, status_msg):
+    """Puts a job into the fair queue and waits for its turn, showing the position (if there is a status message)"""
+    ticket = {'user_id': user_id, 'download_id': str(uuid.uuid4()), 'future': loop.create_future()}
+    queued = time.monotonic()
     async with downloads_lock:
-        if user_id not in active_downloads:
-            active_downloads[user_id] = set()
-        if len(active_downloads[user_id]) >= MAX_CONCURRENT_DOWNLOADS:
-            return False
-        download_id = str(uuid.uuid4())
-        active_downloads[user_id].add(download_id)
-        return download_id
+        job_queues.setdefault(user_id, collections.deque()).append(ticket)
+        if user_id not in queue_order:
+            queue_order.append(user_id)
+        dispatch_downloads()
+    last_position = None
+    try:
+        while not ticket['future'].done():
+            position = get_queue_position(ticket)
+            if status_msg and position and position != last_position:
+                await status_msg.edit_text(f"**In queue:** #{position}\nDownload will start automatically.")
+                last_position = position
+            await asyncio.wait({ticket['future']}, timeout=QUEUE_STATUS_INTERVAL)
+    except BaseException:
+        drop_ticket(ticket)
+        raise
+    metrics.observe('bot_queue_wait_seconds', time.monotonic() - queued)
+    if last_position:
+        await status_msg.edit_text("**Downloading...**")
+    return ticket['download_id']
+
+def dispatch_downloads():
+    """Starts waiting jobs while there are free slots (round-robin between users)"""
+    running = sum(len(ids) for ids in active_downloads.values())
+    skipped = 0
+    while queue_order and running < MAX_GLOBAL_DOWNLOADS and skipped < len(queue_order):
+        # Disk quota: while other jobs run, new ones wait for staging space to free up
+        if running and not staging_has_room():
+            break
+        user_id = queue_order[0]
+        queue_order.rotate(-1)
+        # The user already uses their personal limit: give the turn to the next one
+        if len(active_downloads.get(user_id, ())) >= MAX_CONCURRENT_DOWNLOADS:
+            skipped += 1
+            continue
+        ticket = job_queues[user_id].popleft()
+        if not job_queues[user_id]:
+            del job_queues[user_id]
+            queue_order.remove(user_id)
+        active_downloads.setdefault(user_id, set()).add(ticket['download_id'])
+        ticket['future'].set_result(True)
+        running += 1
+        skipped = 0
+
+def get_queue_position(ticket):
+    """Returns the job position in the queue (1 = next to start)"""
+    queues = [job_queues[user_id] for user_id in queue_order]
+    position = 0
+    for depth in range(max(map(len, queues), default=0)):
+        for queue in queues:
+            if depth < len(queue):
+                position += 1
+                if queue[depth] is ticket:
+                    return position
+    return 0
+
+def queued_count(user_id):
+    """Number of user's jobs waiting in the queue"""
+    return len(job_queues.get(user_id, ()))
+
+def drop_ticket(ticket):
+    """Removes a cancelled job from the queue or frees its slot"""
+    user_id = ticket['user_id']
+    if ticket['future'].done():
+        active_downloads.get(user_id, set()).discard(ticket['download_id'])
+        if not active_downloads.get(user_id, True):
+            del active_downloads[user_id]
+    elif ticket in job_queues.get(user_id, ()):
+        job_queues[user_id].remove(ticket)
+        if not job_queues[user_id]:
+            del job_queues[user_id]
+            queue_order.remove(user_id)
+    dispatch_downloads()
 
 async def finish_download(user_id, download_id):
     """Removes a download from the active list upon completion"""
@@ -178,12 +828,233 @@ async def finish_download(user_id, download_id):
             active_downloads[user_id].remove(download_id)
             if not active_downloads[user_id]:
                 del active_downloads[user_id]
+        # Freed slot goes to the next job in the queue
+        dispatch_downloads()
+
+class PipelineStage:
+    """Pipeline stage: own concurrency limit, bounded input queue and thread pool"""
+
+    def __init__(self, name, limit, queue_size):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(limit)
+        # Seats = running + waiting jobs; a full queue holds the job in the previous stage (backpressure)
+        self.seats = asyncio.Semaphore(limit + queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"stage_{name}")
+        self.waiting = self.active = self.completed = 0
+        self.busy_seconds = self.wait_seconds = 0.0
+
+    async def enter(self):
+        """Takes a place in the stage queue"""
+        await self.seats.acquire()
+        self.waiting += 1
+
+    async def start(self):
+        """Waits in the queue for a free slot and returns the start time"""
+        queued = time.monotonic()
+        try:
+            await self.slots.acquire()
+        except BaseException:
+            self.waiting -= 1
+            self.seats.release()
+            raise
+        started = time.monotonic()
+        self.waiting -= 1
+        self.active += 1
+        self.wait_seconds += started - queued
+        metrics.observe('bot_stage_wait_seconds', started - queued, stage=self.name)
+        return started
+
+    def leave(self, started):
+        """Frees the slot and the queue place"""
+        self.active -= 1
+        self.completed += 1
+        self.busy_seconds += time.monotonic() - started
+        metrics.observe('bot_stage_seconds', time.monotonic() - started, stage=self.name)
+        self.slots.release()
+        self.seats.release()
+
+    async def run_in_thread(self, func, *args):
+        """Runs blocking work on the stage's own thread pool"""
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def stats(self):
+        """Stage occupancy for monitoring"""
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'completed': self.completed,
+            'busy_seconds': round(self.busy_seconds, 1),
+            'wait_seconds': round(self.wait_seconds, 1),
+        }
+
+pipeline_stages = {name: PipelineStage(name, limit, STAGE_QUEUE_SIZES[name]) for name, limit in STAGE_LIMITS.items()}
+
+async def advance_stage(job, stage_name):
+    """Moves a job to the next stage; while that stage's queue is full the job keeps its current slot"""
+    stage = pipeline_stages[stage_name]
+    await stage.enter()
+    leave_stage(job)
+    job['stage_started'] = await stage.start()
+    job['stage'] = stage_name
+    if job.get('journaled') and not job.get('cancelled'):
+        update_job_record(job['unique_id'], stage=stage_name)
+
+def leave_stage(job):
+    """Releases the stage the job currently occupies"""
+    if job.get('stage'):
+        pipeline_stages[job.pop('stage')].leave(job['stage_started'])
+
+def get_pipeline_stats():
+    """Occupancy of all pipeline stages"""
+    return {name: stage.stats() for name, stage in pipeline_stages.items()}
+
+# ==========================================
+# PROGRESS REPORTING
+# ==========================================
+
+STAGE_TITLES = {
+    'download': "**Downloading...**",
+    'postprocess': "**Processing file...**",
+    'upload': "**Uploading file...**",
+}
+
+def format_size(size):
+    """Formats a byte count for humans"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_eta(seconds):
+    """Formats remaining seconds as M:SS or H:MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class ProgressReporter:
+    """Collects download/upload progress and edits status messages at a limited rate"""
+
+    def __init__(self, status_msgs):
+        self.status_msgs = list(status_msgs)
+        self.shown_text = {}
+        self.stage = 'download'
+        self.current = self.total = 0
+        self.speed = self.eta = None
+        self.stage_started = time.monotonic()
+        self.stage_stats = {}
+        self.next_edit = 0
+        self.pending = None
+        self.started = self.closed = False
+
+    def start(self):
+        """Begins showing progress (the job has left the queue)"""
+        self.started = True
+        self.set_stage('download')
+
+    def attach(self, status_msg):
+        """Adds one more message (a coalesced requester) to update"""
+        self.status_msgs.append(status_msg)
+        self.schedule()
+
+    def set_stage(self, stage):
+        """Switches to the next stage and records the speed of the previous one"""
+        self.record_stage()
+        self.stage = stage
+        self.current = self.total = 0
+        self.speed = self.eta = None
+        self.stage_started = time.monotonic()
+        self.schedule()
+
+    def update(self, current, total=None, speed=None, eta=None):
+        """Stores new progress values; the message is edited later by schedule()"""
+        elapsed = time.monotonic() - self.stage_started
+        self.current = current or 0
+        self.total = total or self.total
+        self.speed = speed if speed is not None else (self.current / elapsed if elapsed > 0 else None)
+        if eta is None and self.speed and self.total:
+            eta = (self.total - self.current) / self.speed
+        self.eta = eta
+        self.schedule()
+
+    def ydl_hook(self, d):
+        """yt-dlp progress hook (called from the download thread)"""
+        if d.get('status') == 'downloading':
+            loop.call_soon_threadsafe(self.update, d.get('downloaded_bytes'), d.get('total_bytes') or d.get('total_bytes_estimate'), d.get('speed'), d.get('eta'))
+
+    def render(self):
+        """Builds the status text for the current stage"""
+        text = STAGE_TITLES[self.stage]
+        if self.total:
+            text += f" {min(self.current / self.total, 1) * 100:.1f}%\n`{format_size(self.current)} / {format_size(self.total)}`"
+        elif self.current:
+            text += f"\n`{format_size(self.current)}`"
+        if self.speed:
+            text += f" · {format_size(self.speed)}/s"
+        if self.eta is not None and self.total:
+            text += f" · ETA {format_eta(self.eta)}"
+        return text
+
+    def schedule(self):
+        """Plans a message edit no earlier than PROGRESS_EDIT_INTERVAL after the previous one"""
+        if not self.started or self.closed or self.pending:
+            return
+        delay = max(0, self.next_edit - time.monotonic())
+        self.pending = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """Edits every status message whose text has changed"""
+        text = self.render()
+        try:
+            for status_msg in list(self.status_msgs):
+                if self.closed:
+                    break
+                if self.shown_text.get(id(status_msg)) == text:
+                    continue
+                try:
+                    await status_msg.edit_text(text)
+                    self.shown_text[id(status_msg)] = text
+                except FloodWait as e:
+                    # Telegram asked to slow down: skip edits for the requested time
+                    self.next_edit = time.monotonic() + e.value
+                    return
+                except Exception:
+                    pass
+            self.next_edit = time.monotonic() + PROGRESS_EDIT_INTERVAL
+        finally:
+            self.pending = None
+
+    def record_stage(self):
+        """Saves bytes/sec of the finished stage"""
+        elapsed = time.monotonic() - self.stage_started
+        if self.current and elapsed > 0:
+            self.stage_stats[self.stage] = {'bytes': int(self.current), 'seconds': round(elapsed, 2), 'bytes_per_sec': int(self.current / elapsed)}
+            metrics.observe('bot_transfer_bytes_per_second', self.current / elapsed, stage=self.stage)
+            metrics.inc('bot_transfer_bytes_total', int(self.current), stage=self.stage)
+
+    def close(self):
+        """Stops further edits; the job speed stays in stage_stats for the job log"""
+        self.record_stage()
+        self.closed = True
+        if self.pending:
+            self.pending.cancel()
+            self.pending = None
 
 # ==========================================
 # YT-DLP OPTIONS (DOWNLOADER)
 # ==========================================
 
-def get_ydl_options(format_type='video', unique_id=None, download=False):
+def video_format_spec(max_height):
+    """yt-dlp format string for video no higher than max_height"""
+    # Without FFmpeg separate video and audio streams can't be merged
+    if FFMPEG_AVAILABLE:
+        return f'bestvideo[height<={max_height}]+bestaudio/best[height<={max_height}]/best'
+    return f'best[height<={max_height}]/best'
+
+def get_ydl_options(format_type='video', download=False):
     """Returns a dictionary with yt-dlp settings"""
     options = {
         'quiet': True,
@@ -201,67 +1072,1642 @@ def get_ydl_options(format_type='video', unique_id=None, download=False):
     }
     if not download:
         return options
+    # Merging and MP3 conversion are done by the post-processing stage, not by yt-dlp
     options.update({
         'extract_flat': False,
         'merge_output_format': 'mp4',
+        'noprogress': True,
+        # .part files left by an interrupted job are continued, finished files are not downloaded again
+        'continuedl': True,
     })
     if format_type == 'video':
         options.update({
             'ignoreerrors': False,
-            'max_filesize': MAX_FILE_SIZE_BYTES,
-            'format': 'bestvideo[height<=1080]+bestaudio/best[height<=1080]/best',
-            'outtmpl': os.path.join(VIDEO_DIR, f'%(title)s_{unique_id}.%(ext)s') if unique_id else os.path.join(VIDEO_DIR, '%(title)s.%(ext)s')
+            'max_filesize': MAX_DOWNLOAD_SIZE_BYTES,
+            'format': video_format_spec(MAX_VIDEO_HEIGHT),
+            'outtmpl': get_output_template(VIDEO_DIR),
         })
     else:
-        # Audio settings (MP3 extraction)
+        # Audio settings (only the audio stream is downloaded)
         options.update({
             'ignoreerrors': False,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320'
-            }],
-            'outtmpl': os.path.join(AUDIO_DIR, f'%(title)s_{unique_id}.%(ext)s') if unique_id else os.path.join(AUDIO_DIR, '%(title)s.%(ext)s')
+            'max_filesize': MAX_DOWNLOAD_SIZE_BYTES,
+            'format': 'bestaudio/best',
+            'outtmpl': get_output_template(AUDIO_DIR),
         })
     return options
 
+def get_output_template(folder):
+    """yt-dlp file name template inside a folder (jobs get their own folders)"""
+    return os.path.join(folder, '%(title)s.%(ext)s')
+
+def get_profile_options(profile):
+    """yt-dlp settings of a pool profile: 'metadata', 'video' or 'audio'"""
+    if profile != 'metadata':
+        return get_ydl_options(profile, download=True)
+    options = get_ydl_options()
+    options['ignoreerrors'] = False
+    # Playlist entries are only listed; each one is extracted when its turn comes
+    options['extract_flat'] = 'in_playlist'
+    # A video opened from a playlist is downloaded as a single video
+    options['noplaylist'] = True
+    return options
+
+class YdlPool:
+    """Long-lived YoutubeDL instances per profile: extractors, cookies and keep-alive connections survive between jobs"""
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        # One cookie jar for all instances (cookies.txt is parsed once)
+        self.cookiejar = None
+        self.created = self.reused = 0
+
+    def take(self, profile):
+        """Idle instance of the profile, or a new one (blocking)"""
+        with self.lock:
+            if self.idle[profile]:
+                self.reused += 1
+                return self.idle[profile].pop()
+            self.created += 1
+        ydl = yt_dlp.YoutubeDL(get_profile_options(profile))
+        with self.lock:
+            if self.cookiejar is None:
+                self.cookiejar = ydl.cookiejar
+            else:
+                ydl.cookiejar = self.cookiejar
+        return ydl
+
+    def give_back(self, profile, ydl):
+        """Returns an instance to the pool; extra ones are closed (blocking)"""
+        with self.lock:
+            if len(self.idle[profile]) < self.max_idle:
+                self.idle[profile].append(ydl)
+                return
+        ydl.close()
+
+    @contextlib.contextmanager
+    def checkout(self, profile, format_spec=None, progress_hooks=(), **params):
+        """Lends an instance for one job, with the job's format, hooks and parameters on top of the profile (blocking)"""
+        ydl = self.take(profile)
+        saved = {key: ydl.params[key] for key in params if key in ydl.params}
+        saved_format = ydl.params.get('format'), ydl.format_selector
+        ydl.params.update(params)
+        if format_spec:
+            # The format selector is compiled when the instance is created
+            ydl.params['format'] = format_spec
+            ydl.format_selector = ydl.build_format_selector(format_spec)
+        for hook in progress_hooks:
+            ydl.add_progress_hook(hook)
+        try:
+            yield ydl
+        finally:
+            # Parameters the profile doesn't set are removed, not left as None
+            for key in params:
+                ydl.params.pop(key, None)
+            ydl.params.update(saved)
+            ydl.params['format'], ydl.format_selector = saved_format
+            # Hooks belong to the job; yt-dlp has no public way to remove them
+            ydl._progress_hooks.clear()
+            self.give_back(profile, ydl)
+
+    def close(self):
+        """Closes idle instances and saves the cookies (blocking)"""
+        with self.lock:
+            instances = [ydl for pool in self.idle.values() for ydl in pool]
+            self.idle.clear()
+        for ydl in instances:
+            ydl.close()
+
+    def stats(self):
+        """Pool usage for monitoring"""
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused, 'idle': {profile: len(pool) for profile, pool in self.idle.items()}}
+
+ydl_pool = YdlPool(YDL_POOL_SIZE)
+
 # ==========================================
 # DATABASE HELPER FUNCTIONS
 # ==========================================
 
 async def save_user(user):
     """Saves user information to the database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.write('''
         INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, date_added)
         VALUES (?, ?, ?, ?, datetime('now'))
     ''', (user.id, user.username, user.first_name, user.last_name))
-    conn.commit()
-    conn.close()
+
+def make_url_token(url):
+    """Short URL token for callback_data (urlsafe base64 of a truncated sha256)"""
+    digest = hashlib.sha256(url.encode()).digest()[:URL_TOKEN_BYTES]
+    return base64.urlsafe_b64encode(digest).decode()
+
+def remember_url(url_hash, url):
+    """Puts a token into the in-memory LRU"""
+    url_cache[url_hash] = url
+    url_cache.move_to_end(url_hash)
+    while len(url_cache) > URL_CACHE_MAX_ENTRIES:
+        url_cache.popitem(last=False)
 
 async def save_url_mapping(url):
     """Saves a URL and returns its hash for buttons"""
-    url_hash = hashlib.md5(url.encode()).hexdigest()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    url_hash = make_url_token(url)
+    remember_url(url_hash, url)
+    db.write('''
         INSERT OR REPLACE INTO url_mappings (url_hash, url, date_created)
         VALUES (?, ?, datetime('now'))
     ''', (url_hash, url))
-    conn.commit()
-    conn.close()
     return url_hash
 
 async def get_url_from_hash(url_hash):
     """Retrieves the original URL by its hash"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT url FROM url_mappings WHERE url_hash = ?', (url_hash,))
-    result = cursor.fetchone()
-    conn.close()
+    url = url_cache.get(url_hash)
+    if url:
+        url_cache_stats['hits'] += 1
+        url_cache.move_to_end(url_hash)
+        return url
+    # Not in memory (evicted, restart or an old md5 button): read the table
+    url_cache_stats['misses'] += 1
+    result = await db.fetchone('SELECT url FROM url_mappings WHERE url_hash = ?', (url_hash,))
+    if result:
+        remember_url(url_hash, result[0])
+    return result[0] if result else None
+
+def build_callback_data(format_type, url_hash, quality=None):
+    """callback_data of a download button: dl_<format>_<token>[:<quality>] (at most 64 bytes)"""
+    data = f"dl_{format_type}_{url_hash}"
+    if quality:
+        data += f":{quality}"
+    return data
+
+# ==========================================
+# SENT MEDIA CACHE (TELEGRAM FILE_ID)
+# ==========================================
+
+# Query parameters that don't change the media (tracking, share sources)
+TRACKING_PARAMS = {'si', 'feature', 'pp', 'fbclid', 'gclid', 'igshid', 'igsh', 'is_from_webapp', 'sender_device', 'share_source', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content'}
+
+def normalize_url(url):
+    """Brings a link to a canonical form so that its variants share one cache entry"""
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parsed.path.rstrip('/') or '/'
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True) if k.lower() not in TRACKING_PARAMS]
+    # Short YouTube links and Shorts lead to the same video as watch?v=
+    if host == 'youtu.be' and len(path) > 1:
+        host, path, query = 'youtube.com', '/watch', [('v', path[1:])] + query
+    elif host in ('youtube.com', 'music.youtube.com') and path.startswith('/shorts/'):
+        host, path, query = 'youtube.com', '/watch', [('v', path[len('/shorts/'):])] + query
+    return urllib.parse.urlunsplit(('https', host, path, urllib.parse.urlencode(sorted(query)), ''))
+
+def get_url_cache_key(url):
+    """Cache key known before extraction (normalized link)"""
+    return f"url:{normalize_url(url)}"
+
+def get_cache_format(format_type, quality=None):
+    """Format column of the cache: a reduced quality is cached separately from the default one"""
+    return f"{format_type}:{quality}" if quality else format_type
+
+def get_media_cache_key(info):
+    """Cache key known after extraction (extractor + video id)"""
+    if not info or not info.get('id'):
+        return None
+    return f"{info.get('extractor_key') or info.get('extractor')}:{info['id']}"
+
+def get_sent_file_id(message):
+    """Returns the file_id of a sent file (Telegram may turn a video into a document)"""
+    for media in (message.video, message.audio, message.document):
+        if media:
+            return media.file_id
+    return None
+
+async def get_cached_file_id(cache_key, format_type):
+    """Looks up a file_id that has already been sent for this source and format"""
+    result = await db.fetchone('''
+        SELECT file_id FROM media_cache
+        WHERE cache_key = ? AND format_type = ? AND date_created > datetime('now', ?)
+    ''', (cache_key, format_type, f'-{MEDIA_CACHE_TTL_DAYS} days'))
+    media_cache_stats['hits' if result else 'misses'] += 1
+    if result:
+        # Refresh the last access time for LRU eviction
+        db.write('UPDATE media_cache SET last_used = datetime(\'now\') WHERE file_id = ?', (result[0],))
     return result[0] if result else None
 
+async def save_cached_file_id(cache_keys, format_type, file_id):
+    """Stores a sent file_id under all keys of the source and evicts stale entries"""
+    for cache_key in filter(None, cache_keys):
+        db.write('''
+            INSERT OR REPLACE INTO media_cache (cache_key, format_type, file_id, date_created, last_used)
+            VALUES (?, ?, ?, datetime('now'), datetime('now'))
+        ''', (cache_key, format_type, file_id))
+    # TTL: entries older than MEDIA_CACHE_TTL_DAYS
+    db.write('DELETE FROM media_cache WHERE date_created <= datetime(\'now\', ?)', (f'-{MEDIA_CACHE_TTL_DAYS} days',))
+    # LRU: keep no more than MEDIA_CACHE_MAX_ENTRIES rows
+    db.write('''
+        DELETE FROM media_cache WHERE rowid IN (
+            SELECT rowid FROM media_cache ORDER BY last_used ASC
+            LIMIT max(0, (SELECT COUNT(*) FROM media_cache) - ?)
+        )
+    ''', (MEDIA_CACHE_MAX_ENTRIES,))
+
+async def invalidate_cached_file_id(file_id):
+    """Removes a file_id that Telegram no longer accepts (under all its keys)"""
+    db.write('DELETE FROM media_cache WHERE file_id = ?', (file_id,))
+
+def part_caption(url, index, count):
+    """Caption of a sent file, numbered when the file was split into parts"""
+    if count == 1:
+        return f"**Done!**\n{url}"
+    return f"**Part {index + 1}/{count}**\n{url}"
+
+async def send_cached_media(client, chat_id, url, format_type, file_id, delivered=None):
+    """Re-sends a cached file by file_id; drops it from the cache only when Telegram rejects it"""
+    part_ids = file_id.split(PART_SEPARATOR)
+    # Parts that reached the chat are remembered: a retry or the fallback download doesn't send them twice
+    if delivered is None:
+        delivered = {}
+    if delivered.get('count') != len(part_ids):
+        delivered.update(count=len(part_ids), file_ids=[])
+    try:
+        for index in range(len(delivered['file_ids']), len(part_ids)):
+            while True:
+                try:
+                    # Sent as the media kind stored in the file_id: Telegram may have turned a video into a document
+                    await client.send_cached_media(chat_id, part_ids[index], caption=part_caption(url, index, len(part_ids)))
+                    break
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+            delivered['file_ids'].append(part_ids[index])
+        return True
+    except (FileIdInvalid, MediaEmpty, FileReferenceExpired, FileReferenceInvalid, ValueError) as e:
+        # Telegram no longer accepts the file, or the file_id can't be decoded; other errors
+        # (blocked bot, invalid chat...) say nothing about the file and keep it cached
+        console_log(f"Cached file_id rejected for {url}: {e}")
+        await invalidate_cached_file_id(file_id)
+        return False
+    except Exception as e:
+        # Network error, timeout or a chat-side error: the file_id stays cached, this request downloads the file
+        console_log(f"Cached file_id not sent for {url}: {e}")
+        return False
+
+# ==========================================
+# DOWNLOAD ENGINE (CONNECTIONS AND BANDWIDTH)
+# ==========================================
+
+class HostLimiter:
+    """Caps simultaneous connections to each host across all jobs"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = collections.Counter()
+        self.waiters = {}
+
+    async def acquire(self, url, count=1):
+        """Waits until count more connections to the URL's host fit under the limit; returns the reservation"""
+        host = urllib.parse.urlsplit(url).hostname or ''
+        count = min(count, self.limit)
+        while self.used[host] + count > self.limit:
+            waiter = loop.create_future()
+            self.waiters.setdefault(host, []).append(waiter)
+            await waiter
+        self.used[host] += count
+        return host, count
+
+    def release(self, reservation):
+        """Returns connections to the host and wakes up the jobs waiting for it"""
+        host, count = reservation
+        self.used[host] -= count
+        if self.used[host] <= 0:
+            del self.used[host]
+        for waiter in self.waiters.pop(host, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+class BandwidthBudget:
+    """Download speed limit shared by all jobs (token bucket, thread-safe)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def reserve(self, size):
+        """Takes size bytes from the budget and returns how many seconds to wait before using them"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            # Unused budget is kept for no more than one second of burst
+            self.next_free = max(self.next_free, now - 1) + size / self.rate
+            return max(0, self.next_free - now)
+
+host_limiter = HostLimiter(HOST_MAX_CONNECTIONS)
+bandwidth_budget = BandwidthBudget(DOWNLOAD_BANDWIDTH_LIMIT)
+
+def call_in_loop(coro):
+    """Runs a coroutine on the bot's event loop from a worker thread and waits for its result (blocking)"""
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def make_throttle_hook():
+    """yt-dlp progress hook that holds download threads to the shared bandwidth budget"""
+    downloaded = {}
+
+    def hook(d):
+        if d.get('status') != 'downloading':
+            return
+        current = d.get('downloaded_bytes') or 0
+        delta = current - downloaded.get(d.get('filename'), 0)
+        downloaded[d.get('filename')] = current
+        if delta > 0:
+            time.sleep(bandwidth_budget.reserve(delta))
+    return hook
+
+def is_fragmented(fmt):
+    """Format is downloaded in fragments (HLS/DASH)"""
+    return fmt.get('protocol') in FRAGMENTED_PROTOCOLS or bool(fmt.get('fragments'))
+
+def is_rangeable(fmt):
+    """Progressive HTTP format large enough to split into parallel range requests"""
+    return fmt.get('protocol') in ('http', 'https') and bool(fmt.get('url')) and (fmt.get('filesize') or 0) >= DIRECT_SPLIT_MIN_SIZE
+
+async def download_media(job, info, format_type, progress):
+    """Download stage: direct links via aiohttp, everything else via yt-dlp in the stage thread pool"""
+    if info.get('direct'):
+        return await download_direct(job, info, format_type, progress)
+    # The folder is created here, on the loop: staging_jobs and the journal are not touched from the download thread
+    directory = get_job_dir(job, VIDEO_DIR if format_type == 'video' else AUDIO_DIR)
+    return await pipeline_stages['download'].run_in_thread(download_formats, job, info, format_type, progress.ydl_hook, directory)
+
+async def benchmark_download(url):
+    """Downloads a link with each engine mode and prints the speed (python bot_en.py --bench URL)"""
+    info = await get_media_info(url)
+    info = await pipeline_stages['resolve'].run_in_thread(select_formats, info, 'video')
+    for engine in ('single', 'segmented'):
+        job = {'unique_id': f'bench_{engine}', 'files': [], 'engine': engine}
+        started = time.monotonic()
+        try:
+            files = await download_media(job, info, 'video', ProgressReporter([]))
+            size = sum(os.path.getsize(path) for path in files)
+            elapsed = time.monotonic() - started
+            console_log(f"{engine}: {format_size(size)} in {elapsed:.2f}s ({format_size(size / elapsed)}/s)")
+        finally:
+            remove_job_dir(job)
+            staging_jobs.pop(job['unique_id'], None)
+
+# ==========================================
+# DIRECT LINKS (AIOHTTP)
+# ==========================================
+
+def get_http_session():
+    """Shared aiohttp session (keep-alive connections are reused between jobs)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HOST_MAX_CONNECTIONS)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(sock_read=60))
+    return http_session
+
+async def close_http_session():
+    """Closes the shared aiohttp session"""
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+async def probe_direct_media(url):
+    """Metadata of a direct link to a media file from a HEAD request, None if the link needs an extractor"""
+    path = urllib.parse.urlsplit(url).path
+    name, ext = os.path.splitext(os.path.basename(path))
+    ext = ext.lstrip('.').lower()
+    if ext not in DIRECT_MEDIA_EXTENSIONS:
+        return None
+    try:
+        async with get_http_session().head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=DIRECT_PROBE_TIMEOUT)) as response:
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if response.status != 200 or not (content_type.startswith(('video/', 'audio/')) or content_type == 'application/octet-stream'):
+                return None
+            final_url = str(response.url)
+            return {
+                'direct': True,
+                'url': final_url,
+                'id': make_url_token(final_url),
+                'extractor_key': 'Direct',
+                'title': urllib.parse.unquote(name) or 'media',
+                'ext': ext,
+                'vcodec': 'none' if ext in DIRECT_AUDIO_EXTENSIONS else None,
+                'filesize': response.content_length,
+                'accept_ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+            }
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+async def fetch_range(url, path, start, end, on_chunk, headers=None):
+    """Streams bytes start..end (or the whole file) into their place in the file"""
+    headers = dict(headers or {})
+    if start is not None:
+        headers['Range'] = f'bytes={start}-{end}'
+    reservation = await host_limiter.acquire(url)
+    try:
+        async with get_http_session().get(url, headers=headers) as response:
+            response.raise_for_status()
+            if start is not None and response.status != 206:
+                raise RuntimeError("Server ignored the range request")
+            # Disk writes go to the download stage's threads so a slow disk doesn't stall the loop
+            stage = pipeline_stages['download']
+            f = await stage.run_in_thread(open_range_file, path, start)
+            try:
+                async for chunk in response.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                    await stage.run_in_thread(f.write, chunk)
+                    on_chunk(len(chunk))
+                    delay = bandwidth_budget.reserve(len(chunk))
+                    if delay:
+                        await asyncio.sleep(delay)
+            finally:
+                await stage.run_in_thread(f.close)
+    finally:
+        host_limiter.release(reservation)
+
+def open_range_file(path, start):
+    """Opens the file for writing at the range start, a new file for a download without ranges (blocking)"""
+    if start is None:
+        return open(path, 'wb')
+    f = open(path, 'r+b')
+    f.seek(start)
+    return f
+
+def allocate_file(path, size):
+    """Creates the file at its full size so ranges can be written in any order (blocking)"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+async def download_ranges(url, path, size, connections, on_chunk, headers=None):
+    """Downloads a file over up to `connections` parallel range requests (one if the size is unknown or small)"""
+    if not size or connections < 2 or size < DIRECT_SPLIT_MIN_SIZE:
+        await fetch_range(url, path, None, None, on_chunk, headers)
+        return
+    await pipeline_stages['download'].run_in_thread(allocate_file, path, size)
+    part = -(-size // connections)
+    tasks = [asyncio.ensure_future(fetch_range(url, path, start, min(start + part, size) - 1, on_chunk, headers)) for start in range(0, size, part)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # One range failed: stop the others so nothing keeps writing into the file
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def download_direct(job, info, format_type, progress):
+    """Downloads a direct link, in parallel byte ranges when the server supports them"""
+    directory = get_job_dir(job, VIDEO_DIR if format_type == 'video' else AUDIO_DIR)
+    path = job['target'] = os.path.join(directory, f"{yt_dlp.utils.sanitize_filename(info['title'])}.{info['ext']}")
+    job['files'].append(path)
+    size = info.get('filesize')
+    received = 0
+
+    def on_chunk(count):
+        nonlocal received
+        received += count
+        # Without Content-Length the limit can only be checked while downloading
+        if received > MAX_DOWNLOAD_SIZE_BYTES:
+            raise ValueError(f"File is too large (limit {MAX_DOWNLOAD_SIZE_MB} MB)")
+        progress.update(received, size)
+
+    # Finished before a restart
+    if os.path.exists(path):
+        return [path]
+    connections = DIRECT_CONNECTIONS if job['engine'] == 'segmented' and info.get('accept_ranges') else 1
+    # The file gets its name only when complete: an existing file is always a finished one
+    await download_ranges(info['url'], path + '.ranges', size, connections, on_chunk)
+    os.replace(path + '.ranges', path)
+    return [path]
+
+# ==========================================
+# UPLOAD ENGINE (PARALLEL MEDIA SESSIONS)
+# ==========================================
+
+class UploadEngine:
+    """Uploads files to Telegram in parts over several media sessions at once, retrying failed parts"""
+
+    def __init__(self, connections, requests_per_connection):
+        self.connections = connections
+        self.parallel = connections * requests_per_connection
+        # Parts in flight across all uploads
+        self.slots = asyncio.Semaphore(self.parallel)
+        self.sessions = collections.defaultdict(list)
+        self.session_lock = asyncio.Lock()
+        self.next_session = 0
+        self.uploads = self.parts = self.retries = self.bytes = 0
+        self.busy_seconds = 0.0
+        self.busy_since = None
+
+    async def get_session(self, client):
+        """Media session for the next part: round-robin over sessions opened on first use"""
+        async with self.session_lock:
+            sessions = self.sessions[client]
+            if len(sessions) < self.connections:
+                session = Session(client, await client.storage.dc_id(), await client.storage.auth_key(), await client.storage.test_mode(), is_media=True)
+                await session.start()
+                sessions.append(session)
+                return session
+            self.next_session = (self.next_session + 1) % len(sessions)
+            return sessions[self.next_session]
+
+    async def send_part(self, client, mapped, file_id, index, total_parts, is_big):
+        """Sends one part, retrying it alone when it fails"""
+        async with self.slots:
+            # Read from the page cache only when the part is about to be sent
+            chunk = mapped[index * UPLOAD_PART_SIZE:(index + 1) * UPLOAD_PART_SIZE]
+            if is_big:
+                rpc = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=chunk)
+            else:
+                rpc = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=chunk)
+            attempt = 0
+            while True:
+                try:
+                    await (await self.get_session(client)).invoke(rpc)
+                    break
+                except FloodWait as e:
+                    # Telegram asked to slow down: the part didn't fail, the attempt is not counted
+                    await asyncio.sleep(e.value)
+                except (OSError, asyncio.TimeoutError, RPCError) as e:
+                    attempt += 1
+                    if attempt == UPLOAD_PART_RETRIES:
+                        raise
+                    self.retries += 1
+                    logging.info(f"Upload part {index} failed, retrying: {e}")
+                    await asyncio.sleep(UPLOAD_RETRY_DELAY * attempt)
+        self.parts += 1
+        self.bytes += len(chunk)
+        return len(chunk)
+
+    async def save_file(self, client, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """Uploads a file and returns its InputFile; with file_id only re-sends the part Telegram reported missing"""
+        size = os.path.getsize(path)
+        if size == 0:
+            raise ValueError("File size equals to 0 B")
+        total_parts = -(-size // UPLOAD_PART_SIZE)
+        is_big = size > UPLOAD_BIG_FILE_SIZE
+        # Parts are read at their offsets by concurrent workers: no shared file position, no read-ahead buffers
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if file_id is not None:
+                await self.send_part(client, mapped, file_id, file_part, total_parts, is_big)
+                return None
+            file_id = client.rnd_id()
+            await self.send_parts(client, mapped, file_id, total_parts, is_big, size, progress, progress_args)
+        if is_big:
+            return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(path))
+        # The checksum is optional: Telegram skips the check without it
+        return raw.types.InputFile(id=file_id, parts=total_parts, name=os.path.basename(path), md5_checksum='')
+
+    async def send_parts(self, client, mapped, file_id, total_parts, is_big, size, progress, progress_args):
+        """Sends all parts of a file concurrently, reporting the acknowledged bytes"""
+        parts = iter(range(total_parts))
+        uploaded = 0
+
+        async def worker():
+            nonlocal uploaded
+            for index in parts:
+                sent = await self.send_part(client, mapped, file_id, index, total_parts, is_big)
+                uploaded += sent
+                if progress:
+                    await progress(uploaded, size, *progress_args)
+
+        if not self.uploads:
+            self.busy_since = time.monotonic()
+        self.uploads += 1
+        started = time.monotonic()
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.parallel, total_parts))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # One part failed for good: stop sending the rest
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            self.uploads -= 1
+            if not self.uploads:
+                self.busy_seconds += time.monotonic() - self.busy_since
+        elapsed = time.monotonic() - started
+        metrics.observe('bot_upload_seconds', elapsed)
+        logging.info(f"Uploaded {format_size(size)} in {elapsed:.2f}s ({format_size(size / elapsed)}/s)")
+
+    async def close(self):
+        """Closes the media sessions"""
+        for sessions in self.sessions.values():
+            for session in sessions:
+                await session.stop()
+        self.sessions.clear()
+
+    def stats(self):
+        """Upload totals and the speed while anything was uploading, for tuning the connection counts"""
+        busy = self.busy_seconds + (time.monotonic() - self.busy_since if self.uploads else 0)
+        return {
+            'connections': sum(map(len, self.sessions.values())),
+            'active_uploads': self.uploads,
+            'parts': self.parts,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'bytes_per_sec': int(self.bytes / busy) if busy > 0 else None,
+        }
+
+upload_engine = UploadEngine(UPLOAD_CONNECTIONS, UPLOAD_REQUESTS_PER_CONNECTION)
+
+# ==========================================
+# FORMAT PLANNER
+# ==========================================
+
+def format_filesize(fmt, duration):
+    """Known or estimated (bitrate x duration) size of one format in bytes, None if unknown"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+def list_format_candidates(info, format_type, max_height):
+    """Single formats and video+audio pairs with a known size that could be downloaded"""
+    duration = info.get('duration')
+    formats = [fmt for fmt in info.get('formats') or [] if format_filesize(fmt, duration)]
+    audios = [fmt for fmt in formats if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    candidates = []
+    if format_type == 'audio':
+        for fmt in audios:
+            candidates.append({
+                'spec': fmt['format_id'], 'size': format_filesize(fmt, duration), 'height': 0,
+                'native': codec_family(fmt.get('acodec')) in MP4_AUDIO_CODECS, 'single': True,
+                'tbr': fmt.get('abr') or fmt.get('tbr') or 0,
+            })
+        return candidates
+    for fmt in formats:
+        if fmt.get('vcodec') == 'none' or not fmt.get('height') or fmt['height'] > max_height:
+            continue
+        size = format_filesize(fmt, duration)
+        native_video = codec_family(fmt.get('vcodec')) in MP4_VIDEO_CODECS | {None}
+        if fmt.get('acodec') != 'none':
+            # Video with sound in one file: no merge needed
+            candidates.append({
+                'spec': fmt['format_id'], 'size': size, 'height': fmt['height'],
+                'native': native_video and codec_family(fmt.get('acodec')) in MP4_AUDIO_CODECS | {None}, 'single': True,
+                'tbr': fmt.get('tbr') or 0,
+            })
+        elif FFMPEG_AVAILABLE:
+            for audio in audios:
+                candidates.append({
+                    'spec': f"{fmt['format_id']}+{audio['format_id']}", 'size': size + format_filesize(audio, duration), 'height': fmt['height'],
+                    'native': native_video and codec_family(audio.get('acodec')) in MP4_AUDIO_CODECS, 'single': False,
+                    'tbr': (fmt.get('tbr') or 0) + (audio.get('abr') or audio.get('tbr') or 0),
+                })
+    return candidates
+
+def plan_format(info, format_type, max_height=MAX_VIDEO_HEIGHT, size_limit=PLAN_SIZE_LIMIT_BYTES):
+    """yt-dlp format spec of the best choice that fits the limit, None if sizes are unknown or nothing fits"""
+    # The best quality is split into parts rather than downgraded; lower single-file qualities are offered as buttons
+    fitting = [c for c in list_format_candidates(info, format_type, max_height) if c['size'] <= size_limit]
+    if not fitting:
+        return None
+    # Resolution first, then no re-encode, then no merge, then bitrate
+    return max(fitting, key=lambda c: (c['height'], c['native'], c['single'], c['tbr']))['spec']
+
+# ==========================================
+# METADATA PREFETCH
+# ==========================================
+
+def extract_metadata(url):
+    """Extracts link metadata with the full list of formats, without downloading (blocking)"""
+    with ydl_pool.checkout('metadata') as ydl:
+        return ydl.extract_info(url, download=False)
+
+def is_batch(info):
+    """Link leads to several items (playlist, album, carousel)"""
+    return bool(info) and info.get('_type') in ('playlist', 'multi_video')
+
+# Metadata fields kept by clear_format_selection even when a format carries them too
+SELECTION_KEPT_FIELDS = ('id', 'title', 'duration', 'thumbnail', 'thumbnails', 'formats', 'webpage_url', 'original_url', 'http_headers')
+
+def select_formats(info, format_type, quality=None, size_limit=PLAN_SIZE_LIMIT_BYTES):
+    """Selects formats for a download type from already extracted metadata (blocking, no network)"""
+    if info.get('direct'):
+        # A direct link has a single format: the file itself
+        return info
+    # Without known sizes the usual format string decides
+    spec = plan_format(info, format_type, quality or MAX_VIDEO_HEIGHT, size_limit)
+    if not spec and quality:
+        spec = video_format_spec(quality)
+    with ydl_pool.checkout(format_type, spec) as ydl:
+        return ydl.process_ie_result(clear_format_selection(info), download=False)
+
+def clear_format_selection(info):
+    """Copy of metadata without the fields of the formats an earlier pass selected (the metadata pass selects too)"""
+    # A single format selected now would keep a stale requested_formats pair and its size, codecs and height
+    picked = info.get('requested_formats') or [fmt for fmt in info.get('formats') or [] if fmt.get('format_id') == info.get('format_id')]
+    stale = {key for fmt in picked for key in fmt} | {'requested_formats', 'requested_downloads', 'format', 'format_id', 'filesize_approx'}
+    return copy.deepcopy({key: value for key, value in info.items() if key not in stale or key in SELECTION_KEPT_FIELDS})
+
+def estimate_filesize(info):
+    """Estimated size of the selected formats in bytes, None if unknown"""
+    total = 0
+    for fmt in info.get('requested_formats') or [info]:
+        size = format_filesize(fmt, info.get('duration'))
+        if not size:
+            return None
+        total += size
+    return int(total)
+
+def list_lower_qualities(info):
+    """Lower video qualities to offer when the best one doesn't fit: [(height, size)] (blocking)"""
+    heights = [fmt['height'] for fmt in info.get('formats') or [] if fmt.get('height') and fmt.get('vcodec') != 'none' and fmt['height'] <= MAX_VIDEO_HEIGHT]
+    if not heights:
+        return []
+    planned = select_formats(info, 'video')
+    size = estimate_filesize(planned)
+    if not size or (size <= MAX_FILE_SIZE_BYTES and planned.get('height') == max(heights)):
+        return []
+    # Everything below the planned quality, or below the best one if even that doesn't fit
+    top = planned.get('height') if size <= MAX_FILE_SIZE_BYTES else max(heights) + 1
+    qualities = []
+    for height in QUALITY_STEPS:
+        if not top or height >= top:
+            continue
+        selected = select_formats(info, 'video', height, PLAN_FILE_SIZE_BYTES)
+        size = estimate_filesize(selected)
+        if selected.get('height') and size and size <= MAX_FILE_SIZE_BYTES and selected['height'] not in dict(qualities):
+            qualities.append((selected['height'], size))
+    return qualities
+
+async def get_media_info(url):
+    """Returns link metadata from the cache or extracts it (one extraction per link at a time)"""
+    key = normalize_url(url)
+    entry = metadata_cache.get(key)
+    if entry and entry['expires'] > time.monotonic():
+        metadata_cache.move_to_end(key)
+        metadata_cache_stats['hits'] += 1
+        return entry['info']
+    metadata_cache_stats['misses'] += 1
+    if key not in metadata_fetches:
+        metadata_fetches[key] = asyncio.ensure_future(fetch_metadata(key, url))
+    return await asyncio.shield(metadata_fetches[key])
+
+async def fetch_metadata(key, url):
+    """Extracts metadata in the resolve stage thread pool and caches it"""
+    started = time.monotonic()
+    try:
+        # Direct file links skip the yt-dlp extractors
+        info = await probe_direct_media(url)
+        if not info:
+            info = await pipeline_stages['resolve'].run_in_thread(extract_metadata, url)
+    finally:
+        del metadata_fetches[key]
+        metrics.observe('bot_extract_seconds', time.monotonic() - started)
+    if info:
+        metadata_cache[key] = {'expires': time.monotonic() + METADATA_CACHE_TTL, 'info': info, 'sizes': {}}
+        while len(metadata_cache) > METADATA_CACHE_MAX_ENTRIES:
+            metadata_cache.popitem(last=False)
+    return info
+
+async def get_estimated_size(url, format_type, quality=None):
+    """Estimated file size for a format from prefetched metadata only (None if not prefetched)"""
+    entry = metadata_cache.get(normalize_url(url))
+    if not entry or entry['expires'] <= time.monotonic() or is_batch(entry['info']):
+        return None
+    if (format_type, quality) not in entry['sizes']:
+        selected = await pipeline_stages['resolve'].run_in_thread(select_formats, entry['info'], format_type, quality)
+        entry['sizes'][(format_type, quality)] = estimate_filesize(selected)
+    return entry['sizes'][(format_type, quality)]
+
+async def get_lower_qualities(url):
+    """Lower video qualities that fit the limit, from prefetched metadata only"""
+    entry = metadata_cache.get(normalize_url(url))
+    if not entry or entry['expires'] <= time.monotonic():
+        return []
+    if 'qualities' not in entry:
+        entry['qualities'] = await pipeline_stages['resolve'].run_in_thread(list_lower_qualities, entry['info'])
+    return entry['qualities']
+
+def build_format_keyboard(url_hash, sizes=None, qualities=(), audio_only=False):
+    """Format selection buttons, with estimated sizes when they are known"""
+    sizes = sizes or {}
+    buttons = []
+    for format_type, label in (('video', "🎬 Video"), ('audio', "🎵 Audio")):
+        if audio_only and format_type == 'video':
+            continue
+        size = sizes.get(format_type)
+        if size and size > MAX_DOWNLOAD_SIZE_BYTES:
+            label += " (too large)"
+        elif size and size > MAX_FILE_SIZE_BYTES:
+            label += f" ~{format_size(size)}, {-(-size // SPLIT_PART_SIZE_BYTES)} parts"
+        elif size:
+            label += f" ~{format_size(size)}"
+        buttons.append(InlineKeyboardButton(label, callback_data=build_callback_data(format_type, url_hash)))
+    rows = [buttons]
+    if qualities:
+        rows.append([InlineKeyboardButton(f"🎬 {height}p ~{format_size(size)}", callback_data=build_callback_data('video', url_hash, height)) for height, size in qualities])
+    return InlineKeyboardMarkup(rows)
+
+async def describe_link(reply, url, url_hash):
+    """Prefetches link metadata and shows title, duration and sizes in the format selection message"""
+    try:
+        # spotDL resolves Spotify links only when the download starts
+        if is_spotify_url(url):
+            return
+        info = await get_media_info(url)
+        if not info:
+            return
+        if is_batch(info):
+            count = len(info.get('entries') or [])
+            text = f"📃 {info.get('title') or url}\n{count} items"
+            if count > BATCH_MAX_ITEMS:
+                text += f" (first {BATCH_MAX_ITEMS} will be downloaded)"
+            await reply.edit_text(text + "\n\nSelect download format:", reply_markup=build_format_keyboard(url_hash), parse_mode=ParseMode.DISABLED)
+            return
+        sizes = {format_type: await get_estimated_size(url, format_type) for format_type in ('video', 'audio')}
+        qualities = await get_lower_qualities(url)
+        text = f"🎞 {info.get('title') or url}"
+        if info.get('duration'):
+            text += f"\n⏱ {format_eta(info['duration'])}"
+        await reply.edit_text(text + "\n\nSelect download format:", reply_markup=build_format_keyboard(url_hash, sizes, qualities), parse_mode=ParseMode.DISABLED)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        console_log(f"Prefetch failed for {url}: {e}")
+    finally:
+        describe_tasks.pop((reply.chat.id, reply.id), None)
+
+# ==========================================
+# INLINE QUERY ENGINE
+# ==========================================
+
+def build_inline_results(url, url_hash, info=None):
+    """Inline results for a link, with title, duration and thumbnail when metadata is known"""
+    description = None
+    if info:
+        description = info.get('title') or url
+        if info.get('duration'):
+            description += f" ({format_eta(info['duration'])})"
+    results = []
+    for format_type, title, text, button in (
+        ('video', "Download Video", "🎬 Downloading video", "🎬 Download"),
+        ('audio', "Download Audio", "🎵 Downloading audio", "🎵 Download"),
+    ):
+        results.append(InlineQueryResultArticle(
+            id=f"{format_type}_{url_hash}",
+            title=title,
+            description=description,
+            thumb_url=(info or {}).get('thumbnail'),
+            input_message_content=InputTextMessageContent(f"{text}:\n{url}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(button, callback_data=build_callback_data(format_type, url_hash))]])
+        ))
+    return results
+
+async def answer_inline_query(inline_query, url):
+    """Answers an inline query from the result cache or after the user stops typing"""
+    key = normalize_url(url)
+    entry = inline_results.get(key)
+    if entry and entry['expires'] > time.monotonic():
+        inline_results.move_to_end(key)
+        await inline_query.answer(entry['results'], cache_time=INLINE_CACHE_TIME)
+        return
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    console_log(f"INLINE: {url} (ID: {inline_query.from_user.id})")
+    url_hash = await save_url_mapping(url)
+    # Metadata keeps loading after the timeout and is ready for the next query or button press
+    fetch = asyncio.ensure_future(get_media_info(url))
+    fetch.add_done_callback(lambda f: f.cancelled() or f.exception())
+    await asyncio.wait({fetch}, timeout=INLINE_METADATA_WAIT)
+    info = fetch.result() if fetch.done() and not fetch.cancelled() and not fetch.exception() else None
+    if is_batch(info):
+        info = None
+    results = build_inline_results(url, url_hash, info)
+    if info:
+        inline_results[key] = {'expires': time.monotonic() + INLINE_RESULTS_TTL, 'results': results}
+        while len(inline_results) > INLINE_RESULTS_MAX_ENTRIES:
+            inline_results.popitem(last=False)
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME if info else INLINE_CACHE_TIME_PARTIAL)
+
+def finish_inline_task(user_id, task):
+    """Forgets a finished inline answer and logs its error"""
+    if inline_tasks.get(user_id) is task:
+        del inline_tasks[user_id]
+    if not task.cancelled() and task.exception():
+        console_log(f"Inline query failed: {task.exception()}")
+
+# ==========================================
+# SOURCE CACHE (AUDIO FROM DOWNLOADED MEDIA)
+# ==========================================
+
+def clear_source_cache():
+    """Removes sources left by the previous run: the index lives in memory only (workers' subfolders are theirs)"""
+    for entry in os.scandir(SOURCE_CACHE_DIR):
+        if entry.is_file():
+            os.remove(entry.path)
+
+def acquire_source(media_key):
+    """Cached file with the media's audio track, protected from eviction while in use; None if there is none"""
+    entry = source_cache.get(media_key) if media_key else None
+    if not entry or not os.path.exists(entry['path']):
+        source_cache_stats['misses'] += 1
+        return None
+    source_cache_stats['hits'] += 1
+    source_cache.move_to_end(media_key)
+    entry['users'] += 1
+    return entry
+
+def release_source(entry):
+    """Ends the use of a cached source"""
+    entry['users'] -= 1
+
+def evict_sources():
+    """Drops least recently used sources above SOURCE_CACHE_MAX_BYTES and returns their paths"""
+    paths = []
+    for media_key in list(source_cache):
+        if source_cache_stats['bytes'] <= SOURCE_CACHE_MAX_BYTES:
+            break
+        entry = source_cache[media_key]
+        if entry['users']:
+            continue
+        del source_cache[media_key]
+        source_cache_stats['bytes'] -= entry['size']
+        paths.append(entry['path'])
+    return paths
+
+async def keep_source(job, media_key):
+    """Moves the job's downloaded stream with the audio track into the source cache"""
+    if not FFMPEG_AVAILABLE or not media_key or not job.get('download_source') or media_key in source_cache:
+        return
+    path, fmt = job['download_source']
+    if not os.path.exists(path) or os.path.getsize(path) > SOURCE_CACHE_MAX_FILE_BYTES:
+        return
+    # The extractor didn't report the audio codec: check that there is an audio track at all
+    if not fmt['acodec'] and not (await pipeline_stages['probe'].run_in_thread(probe_media, path))['audio']:
+        return
+    if media_key in source_cache or not os.path.exists(path):
+        return
+    size = os.path.getsize(path)
+    cache_path = os.path.join(SOURCE_CACHE_DIR, hashlib.sha256(media_key.encode()).hexdigest()[:32] + os.path.splitext(path)[1])
+    # A rename on the same disk, a copy out of tmpfs
+    await pipeline_stages['cleanup'].run_in_thread(shutil.move, path, cache_path)
+    if media_key in source_cache:
+        # Another job kept the same media meanwhile (into the same path)
+        return
+    source_cache[media_key] = {'path': cache_path, 'size': size, 'format': fmt, 'users': 0}
+    source_cache_stats['bytes'] += size
+    await pipeline_stages['cleanup'].run_in_thread(remove_files, evict_sources())
+
+# ==========================================
+# STAGING (JOB FOLDERS ON DISK AND TMPFS)
+# ==========================================
+
+def folder_size(path):
+    """Size of everything inside a folder (blocking)"""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def staging_has_room():
+    """Disk quota checked before a job is admitted: staged bytes under the quota and enough free space left"""
+    free = staging_usage['free']
+    return staging_usage['bytes'] < STAGING_QUOTA_BYTES and (free is None or free > STAGING_MIN_FREE_BYTES)
+
+def tmpfs_has_room(size):
+    """RAM staging takes the job: small file, room under the tmpfs quota and in the tmpfs itself"""
+    if not STAGING_TMPFS_DIR or not size or size > STAGING_TMPFS_MAX_FILE_BYTES:
+        return False
+    reserved = sum(job.get('tmpfs_bytes', 0) for job in staging_jobs.values())
+    return reserved + size <= STAGING_TMPFS_MAX_BYTES and shutil.disk_usage(STAGING_TMPFS_DIR).free > size
+
+def get_job_dir(job, disk_root):
+    """Job's scratch folder, created on first use: in tmpfs for small files, on disk otherwise"""
+    if 'dir' not in job:
+        # Merging and conversion keep the source and the result at the same time
+        size = 2 * job['size_hint'] if job.get('size_hint') else None
+        if tmpfs_has_room(size):
+            job['tmpfs_bytes'] = size
+            job['dir'] = os.path.join(STAGING_TMPFS_DIR, job['unique_id'])
+        else:
+            job['dir'] = os.path.join(disk_root, job['unique_id'])
+        os.makedirs(job['dir'], exist_ok=True)
+        staging_jobs[job['unique_id']] = job
+        if job.get('journaled'):
+            update_job_record(job['unique_id'], job_dir=job['dir'])
+    return job['dir']
+
+def adopt_job_dir(job, path):
+    """Takes over the folder of a job interrupted by a restart, with its partial downloads"""
+    job['dir'] = path
+    if STAGING_TMPFS_DIR and path.startswith(STAGING_TMPFS_DIR):
+        # The size is not known yet: reserve the most a tmpfs job may take
+        job['tmpfs_bytes'] = STAGING_TMPFS_MAX_FILE_BYTES
+    staging_jobs[job['unique_id']] = job
+
+def remove_job_dir(job):
+    """Deletes the job's folder with everything left in it: .part, .ytdl, merge intermediates (blocking)"""
+    if job.get('dir'):
+        shutil.rmtree(job['dir'], ignore_errors=True)
+
+def use_worker_folders(worker_name):
+    """Moves this process's job folders and kept sources into its own subfolders: each process on the host cleans up only its own files"""
+    global VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR, STAGING_TMPFS_DIR
+    folder = WORKER_DIR_PREFIX + worker_name
+    VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR = (os.path.join(root, folder, '') for root in (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR))
+    if STAGING_TMPFS_DIR:
+        STAGING_TMPFS_DIR = os.path.join(STAGING_TMPFS_DIR, folder, '')
+    for root in filter(None, (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR, STAGING_TMPFS_DIR)):
+        os.makedirs(root, exist_ok=True)
+
+def sweep_staging(active_ids):
+    """Removes folders and loose files older than STAGING_ORPHAN_AGE that no running job owns (blocking)"""
+    removed = 0
+    for root in filter(None, (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, STAGING_TMPFS_DIR)):
+        for entry in os.scandir(root):
+            try:
+                # Workers' subfolders are swept by the workers themselves
+                if entry.name in active_ids or entry.name.startswith(WORKER_DIR_PREFIX) or time.time() - entry.stat().st_mtime < STAGING_ORPHAN_AGE:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+def measure_staging(paths):
+    """Bytes in the given job folders and free disk space (blocking)"""
+    return sum(map(folder_size, paths)), shutil.disk_usage(VIDEO_DIR).free
+
+async def maintain_staging():
+    """Background task: measures staged bytes for the disk quota and sweeps orphans left by crashes and cancelled jobs (first sweep right at startup)"""
+    last_sweep = None
+    while True:
+        try:
+            if last_sweep is None or time.monotonic() - last_sweep >= STAGING_SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                # Folders of journaled jobs wait for their resume
+                journaled = {row[0] for row in await db.fetchall('SELECT job_id FROM jobs')}
+                removed = await pipeline_stages['cleanup'].run_in_thread(sweep_staging, set(staging_jobs) | journaled)
+                if removed:
+                    console_log(f"Staging cleanup: {removed} orphans removed")
+            # Folder walks run on a thread: the list of folders is taken here, on the loop
+            paths = [job['dir'] for job in staging_jobs.values() if not job.get('tmpfs_bytes')]
+            staging_usage['bytes'], staging_usage['free'] = await pipeline_stages['cleanup'].run_in_thread(measure_staging, paths)
+            # Freed space may let waiting jobs in
+            dispatch_downloads()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"Staging cleanup failed: {e}")
+        await asyncio.sleep(STAGING_MEASURE_INTERVAL)
+
+# ==========================================
+# MEDIA PIPELINE (STAGES)
+# ==========================================
+
+def download_formats(job, info, format_type, progress_hook, directory):
+    """Downloads each selected format into its own file inside the job folder (blocking)"""
+    segmented = job['engine'] == 'segmented'
+
+    def job_hook(status):
+        # Shutdown: the download thread stops, the partial file stays for the resume
+        if job.get('cancelled'):
+            raise yt_dlp.utils.DownloadCancelled()
+        progress_hook(status)
+
+    hooks = [job_hook]
+    if DOWNLOAD_BANDWIDTH_LIMIT:
+        hooks.append(make_throttle_hook())
+    outtmpl = {'default': get_output_template(directory)}
+    concurrent = FRAGMENT_CONNECTIONS if segmented else 1
+    with ydl_pool.checkout(format_type, progress_hooks=hooks, outtmpl=outtmpl, concurrent_fragment_downloads=concurrent) as ydl:
+        job['target'] = ydl.prepare_filename(info)
+        base = os.path.splitext(job['target'])[0]
+        downloaded = []
+        for fmt in info.get('requested_formats') or [info]:
+            fmt_info = dict(info)
+            fmt_info.pop('requested_formats', None)
+            fmt_info.update(fmt)
+            path = f"{base}.f{fmt['format_id'].replace('/', '_')}.{fmt['ext']}" if info.get('requested_formats') else job['target']
+            job['files'].append(path)
+            if segmented and is_rangeable(fmt) and not os.path.exists(path) and download_format_ranges(ydl, fmt, path, job_hook):
+                downloaded.append(path)
+                continue
+            reservation = call_in_loop(host_limiter.acquire(fmt.get('url') or info.get('webpage_url') or '', FRAGMENT_CONNECTIONS if segmented and is_fragmented(fmt) else 1))
+            try:
+                success, _ = ydl.dl(path, fmt_info)
+            finally:
+                loop.call_soon_threadsafe(host_limiter.release, reservation)
+            # max_filesize and similar refusals return False without an exception
+            if not success or not os.path.exists(path):
+                return []
+            downloaded.append(path)
+        return downloaded
+
+def download_format_ranges(ydl, fmt, path, progress_hook):
+    """Downloads a progressive format over parallel range requests; False if the server doesn't allow it (blocking)"""
+    headers = dict(fmt.get('http_headers') or {})
+    cookie = ydl.cookiejar.get_cookie_header(fmt['url'])
+    if cookie:
+        headers['Cookie'] = cookie
+    received = 0
+
+    def on_chunk(count):
+        nonlocal received
+        received += count
+        progress_hook({'status': 'downloading', 'downloaded_bytes': received, 'total_bytes': fmt['filesize']})
+
+    try:
+        # Renamed when complete, like yt-dlp's .part files
+        call_in_loop(download_ranges(fmt['url'], path + '.ranges', fmt['filesize'], FRAGMENT_CONNECTIONS, on_chunk, headers))
+        os.replace(path + '.ranges', path)
+        return True
+    except (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        console_log(f"Range download failed, using yt-dlp: {e}")
+        return False
+
+async def upload_media(client, chat_id, format_type, file_path, caption, progress_callback, attributes=None):
+    """Sends the file to the chat and returns its file_id"""
+    # Duration, dimensions and thumbnail from the probe stage
+    attributes = attributes or {}
+    # Send based on type
+    if not os.path.exists(file_path):
+        # file_id of a playlist entry sent before: re-sent as the media kind Telegram stored (video or document)
+        sent = await client.send_cached_media(chat_id, file_path, caption=caption)
+    elif format_type == 'video':
+        sent = await client.send_video(chat_id, video=file_path, caption=caption, progress=progress_callback, **attributes)
+    else:
+        sent = await client.send_audio(chat_id, audio=file_path, caption=caption, progress=progress_callback, **attributes)
+    return get_sent_file_id(sent)
+
+async def upload_parts(client, chat_id, url, format_type, parts, progress, attributes=None, delivered=None):
+    """Uploads the file or its parts concurrently, then sends them in part order and returns their file_ids"""
+    progress.set_stage('upload')
+    total = sum(os.path.getsize(path) for path in parts)
+    uploaded = [0] * len(parts)
+    slots = asyncio.Semaphore(SPLIT_UPLOAD_CONCURRENCY)
+    # First parts already sent from the cache before a part's file_id was rejected (same number of parts)
+    sent_before = delivered['file_ids'] if delivered and delivered['count'] == len(parts) else []
+
+    for index, path in enumerate(parts[:len(sent_before)]):
+        uploaded[index] = os.path.getsize(path)
+
+    async def upload_part(index, path):
+        async def on_progress(current, _total):
+            uploaded[index] = current
+            progress.update(sum(uploaded), total)
+        async with slots:
+            prepared_uploads[path] = await client.save_file(path, progress=on_progress)
+
+    try:
+        await asyncio.gather(*(upload_part(index, path) for index, path in enumerate(parts) if index >= len(sent_before)))
+        # Messages go one by one: parts sent concurrently would reach the chat in any order
+        file_ids = list(sent_before)
+        for index, path in enumerate(parts[len(file_ids):], len(file_ids)):
+            file_ids.append(await upload_media(client, chat_id, format_type, path, part_caption(url, index, len(parts)), None, (attributes or {}).get(path)))
+    finally:
+        for path in parts:
+            prepared_uploads.pop(path, None)
+    return PART_SEPARATOR.join(file_ids)
+
+def remove_files(paths):
+    """Deletes job files together with unfinished yt-dlp leftovers (blocking)"""
+    for path in set(paths):
+        for leftover in (path, path + '.part', path + '.ytdl'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+# ==========================================
+# POST-PROCESSING ENGINE (FFMPEG)
+# ==========================================
+
+# Codec name prefixes reported by yt-dlp -> codec family
+CODEC_FAMILIES = {
+    'h264': ('avc1', 'avc3', 'h264'),
+    'hevc': ('hvc1', 'hev1', 'hevc', 'h265'),
+    'av1': ('av01', 'av1'),
+    'vp9': ('vp09', 'vp9'),
+    'aac': ('mp4a', 'aac'),
+    'mp3': ('mp3',),
+    'opus': ('opus',),
+    'vorbis': ('vorbis',),
+}
+# Codecs that fit into MP4 as is (stream copy)
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'av1', 'vp9'}
+MP4_AUDIO_CODECS = {'aac', 'mp3'}
+# File extension hints when the extractor doesn't report codecs (direct links)
+EXT_AUDIO_CODECS = {'mp3': 'mp3', 'm4a': 'aac', 'aac': 'aac', 'opus': 'opus', 'ogg': 'vorbis'}
+VIDEO_TRANSCODE_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+AUDIO_TRANSCODE_ARGS = ['-c:a', 'aac', '-b:a', '192k']
+MP3_TRANSCODE_ARGS = ['-c:a', 'libmp3lame', '-b:a', '320k']
+
+def codec_family(codec):
+    """Brings a codec name (avc1.64001F, mp4a.40.2...) to its family, None if unknown"""
+    codec = (codec or '').lower()
+    if codec in ('', 'none'):
+        return None
+    for family, prefixes in CODEC_FAMILIES.items():
+        if codec.startswith(prefixes):
+            return family
+    return codec
+
+def run_ffmpeg(args):
+    """Runs ffmpeg and raises an error with its output if it fails (blocking)"""
+    started = time.monotonic()
+    result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y', '-threads', str(FFMPEG_THREADS), *args], capture_output=True)
+    metrics.observe('bot_ffmpeg_seconds', time.monotonic() - started)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg: {result.stderr.decode(errors='ignore').strip()[-300:]}")
+
+def run_ffmpeg_copy_or_transcode(inputs, copy_args, transcode_args, target):
+    """Tries a stream copy first and re-encodes only if the copy fails (blocking)"""
+    try:
+        run_ffmpeg([*inputs, *copy_args, target])
+    except RuntimeError as e:
+        if copy_args == transcode_args:
+            raise
+        console_log(f"Stream copy failed, transcoding: {e}")
+        run_ffmpeg([*inputs, *transcode_args, target])
+    return target
+
+def video_codec_args(vcodec, acodec):
+    """ffmpeg codec arguments for MP4: copy what fits, transcode the rest"""
+    video = ['-c:v', 'copy'] if codec_family(vcodec) in MP4_VIDEO_CODECS | {None} else VIDEO_TRANSCODE_ARGS
+    audio = ['-c:a', 'copy'] if codec_family(acodec) in MP4_AUDIO_CODECS | {None} else AUDIO_TRANSCODE_ARGS
+    return video + audio
+
+def postprocess_video(files, formats, target):
+    """Merges or remuxes video into MP4, re-encoding only incompatible streams (blocking)"""
+    ready = False
+    if len(files) == 2:
+        vcodec, acodec = formats[0].get('vcodec'), formats[1].get('acodec')
+        inputs = ['-i', files[0], '-i', files[1], '-map', '0:v:0', '-map', '1:a:0']
+    else:
+        vcodec, acodec = formats[0].get('vcodec'), formats[0].get('acodec')
+        ready = files[0].endswith('.mp4') and video_codec_args(vcodec, acodec) == ['-c:v', 'copy', '-c:a', 'copy']
+        # Already a streamable MP4 with suitable codecs: nothing to do
+        if ready and is_faststart(files[0]):
+            return files[0]
+        target = os.path.splitext(target)[0] + ('.remux.mp4' if files[0].endswith('.mp4') else '.mp4')
+        inputs = ['-i', files[0], '-map', '0:v:0', '-map', '0:a:0?']
+    codec_args = video_codec_args(vcodec, acodec)
+    # Index (moov atom) at the start: playback begins while the file is still loading
+    inputs += ['-movflags', '+faststart']
+    try:
+        return run_ffmpeg_copy_or_transcode(inputs, codec_args, codec_args if ready else VIDEO_TRANSCODE_ARGS + AUDIO_TRANSCODE_ARGS, target)
+    except RuntimeError as e:
+        if not ready:
+            raise
+        # Only the index was to be moved: a file ffmpeg can't read is sent as is
+        console_log(f"Faststart remux failed, sending the file as is: {e}")
+        return files[0]
+
+def postprocess_audio(source, fmt, target):
+    """Stream-copies MP3/AAC audio and converts everything else to MP3 320k (blocking)"""
+    ext = os.path.splitext(source)[1].lstrip('.').lower()
+    family = codec_family(fmt.get('acodec')) or EXT_AUDIO_CODECS.get(ext)
+    base = os.path.splitext(target)[0]
+    if family == 'mp3':
+        if ext == 'mp3':
+            return source
+        return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], ['-c:a', 'copy'], MP3_TRANSCODE_ARGS, base + '.mp3')
+    if family == 'aac' and AUDIO_STREAM_COPY:
+        if ext == 'm4a' and fmt.get('vcodec') in (None, 'none'):
+            return source
+        return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], ['-c:a', 'copy'], MP3_TRANSCODE_ARGS, base + ('.copy.m4a' if ext == 'm4a' else '.m4a'))
+    return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], MP3_TRANSCODE_ARGS, MP3_TRANSCODE_ARGS, base + '.mp3')
+
+def is_faststart(path):
+    """True if the MP4 index (moov atom) comes before the media data (blocking)"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = int.from_bytes(header[:4], 'big'), header[4:]
+            if kind == b'moov':
+                return True
+            if kind == b'mdat' or size == 0:
+                return False
+            if size == 1:
+                # 64-bit box size follows the type
+                size = int.from_bytes(f.read(8), 'big') - 8
+            # A broken box size would seek backwards or stay in place forever
+            if size < 8:
+                return False
+            f.seek(size - 8, 1)
+
+def probe_media(path):
+    """Duration, width, height and audio track presence via ffprobe (ffmpeg report if there is no ffprobe); unknown values are None (blocking)"""
+    if FFPROBE_PATH:
+        result = subprocess.run([FFPROBE_PATH, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path], capture_output=True)
+        if result.returncode == 0:
+            data = json.loads(result.stdout or b'{}')
+            # Embedded covers are video streams too
+            video = next((stream for stream in data.get('streams', []) if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic')), {})
+            duration = data.get('format', {}).get('duration')
+            width, height = video.get('width'), video.get('height')
+            rotation = video.get('tags', {}).get('rotate') or next((item.get('rotation') for item in video.get('side_data_list', []) if 'rotation' in item), 0)
+            if abs(int(float(rotation))) % 180 == 90:
+                width, height = height, width
+            audio = any(stream.get('codec_type') == 'audio' for stream in data.get('streams', []))
+            return {'duration': float(duration) if duration else None, 'width': width, 'height': height, 'audio': audio}
+    result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-i', path], capture_output=True)
+    media = {'duration': None, 'width': None, 'height': None, 'audio': re.search(rb'Stream #[^\n]*Audio:', result.stderr) is not None}
+    match = re.search(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        media['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = re.search(rb'Stream #[^\n]*Video: (?![^\n]*attached pic)[^\n]*?, (\d+)x(\d+)', result.stderr)
+    if match:
+        media['width'], media['height'] = int(match.group(1)), int(match.group(2))
+    return media
+
+def split_media(path, duration):
+    """Cuts a file over the Telegram limit into parts at keyframes without re-encoding; returns the part paths (blocking)"""
+    size = os.path.getsize(path)
+    if size <= MAX_FILE_SIZE_BYTES:
+        return [path]
+    duration = duration or probe_media(path)['duration']
+    if not duration:
+        raise ValueError("Can't split a file of unknown duration")
+    base, ext = os.path.splitext(path)
+    segment_time = duration * SPLIT_PART_SIZE_BYTES / size
+    for attempt in range(SPLIT_ATTEMPTS):
+        run_ffmpeg([
+            '-i', path, '-map', '0:v?', '-map', '0:a?', '-c', 'copy',
+            '-f', 'segment', '-segment_time', f'{segment_time:.3f}', '-reset_timestamps', '1',
+            *(['-segment_format_options', 'movflags=+faststart'] if ext == '.mp4' else []),
+            f'{base}.part%03d{ext}',
+        ])
+        parts = []
+        while os.path.exists(f'{base}.part{len(parts):03d}{ext}'):
+            parts.append(f'{base}.part{len(parts):03d}{ext}')
+        # Cuts happen only at keyframes: a sparse GOP can leave a part above the limit
+        if parts and all(os.path.getsize(part) <= MAX_FILE_SIZE_BYTES for part in parts):
+            return parts
+        remove_files(parts)
+        segment_time *= 0.75
+    raise ValueError("Couldn't split the file into parts under the limit")
+
+def postprocess_media(files, formats, format_type, target):
+    """Produces the file to send: MP4 video or MP3/M4A audio; returns its path (blocking)"""
+    if not FFMPEG_AVAILABLE:
+        # Without FFmpeg the file is sent in its original format
+        return files[0]
+    if format_type == 'video':
+        return postprocess_video(files, formats, target)
+    return postprocess_audio(files[0], formats[0], target)
+
+# ==========================================
+# THUMBNAILS AND MEDIA PROBE
+# ==========================================
+
+def file_fingerprint(path):
+    """Content hash of a media file: its size and the chunks at the start and at the end (blocking)"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        f.seek(max(0, size - FINGERPRINT_CHUNK_SIZE))
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    return digest.hexdigest()
+
+def make_thumbnail(source, target, position=None):
+    """Writes a JPEG thumbnail from an image, a video frame or an embedded cover (blocking)"""
+    seek = ['-ss', f'{position:.3f}'] if position else []
+    run_ffmpeg([
+        *seek, '-i', source, '-map', '0:v:0', '-frames:v', '1',
+        '-vf', f'scale={THUMB_SIZE}:{THUMB_SIZE}:force_original_aspect_ratio=decrease', '-q:v', '4', target,
+    ])
+
+def evict_thumbnails():
+    """Removes the least recently used thumbnails while the cache is above THUMB_CACHE_MAX_BYTES (blocking)"""
+    entries = []
+    for entry in os.scandir(THUMB_CACHE_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= THUMB_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cache_thumbnail(key, make):
+    """Thumbnail stored under a content hash: from the cache, or written by make(path) (blocking)"""
+    path = os.path.join(THUMB_CACHE_DIR, f"{key[:32]}.jpg")
+    if os.path.exists(path):
+        # Last use time orders the eviction
+        os.utime(path)
+        return path
+    temp_path = os.path.join(THUMB_CACHE_DIR, f"{key[:32]}_{uuid.uuid4().hex[:8]}.tmp.jpg")
+    try:
+        make(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    evict_thumbnails()
+    return path
+
+def thumbnail_from_image(data):
+    """Thumbnail of a downloaded poster or cover, keyed by the image hash (blocking)"""
+    def make(target):
+        source = target + '.src'
+        with open(source, 'wb') as f:
+            f.write(data)
+        try:
+            make_thumbnail(source, target)
+        finally:
+            os.remove(source)
+    return cache_thumbnail(hashlib.sha256(data).hexdigest(), make)
+
+def thumbnail_from_file(path, duration, format_type):
+    """Thumbnail of a video frame or of the cover embedded in audio, keyed by the file content (blocking)"""
+    position = duration * THUMB_FRAME_POSITION if format_type == 'video' and duration else None
+    return cache_thumbnail(file_fingerprint(path), lambda target: make_thumbnail(path, target, position))
+
+async def fetch_source_thumbnail(url):
+    """Downloads the source poster or cover into the thumbnail cache; None if it is unavailable"""
+    if not url:
+        return None
+    try:
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=THUMB_FETCH_TIMEOUT)) as response:
+            response.raise_for_status()
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                data += chunk
+                if len(data) > THUMB_SOURCE_MAX_BYTES:
+                    return None
+        return await pipeline_stages['probe'].run_in_thread(thumbnail_from_image, bytes(data))
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, OSError) as e:
+        console_log(f"Thumbnail not downloaded ({url}): {e}")
+        return None
+
+async def describe_media(job, info, format_type, parts):
+    """Probe stage: send_video/send_audio arguments of each file (duration, dimensions, thumbnail)"""
+    await advance_stage(job, 'probe')
+    thumb = await fetch_source_thumbnail(info.get('thumbnail')) if FFMPEG_AVAILABLE else None
+    attributes = {}
+    for path in parts:
+        media = await pipeline_stages['probe'].run_in_thread(probe_media, path) if FFMPEG_AVAILABLE else {}
+        if len(parts) == 1:
+            # The extractor's values fill in what the probe couldn't read
+            media = {key: media.get(key) or info.get(key) for key in ('duration', 'width', 'height')}
+        item = {'duration': int(media.get('duration') or 0)}
+        if format_type == 'video':
+            item.update(width=media.get('width') or 0, height=media.get('height') or 0, supports_streaming=path.endswith('.mp4'))
+        else:
+            item.update(performer=info.get('artist') or info.get('uploader'), title=info.get('track') or info.get('title'))
+        part_thumb = thumb
+        if not part_thumb and FFMPEG_AVAILABLE:
+            try:
+                part_thumb = await pipeline_stages['probe'].run_in_thread(thumbnail_from_file, path, media.get('duration'), format_type)
+            except (RuntimeError, OSError):
+                # Audio without a cover
+                part_thumb = None
+        if part_thumb:
+            item['thumb'] = part_thumb
+        attributes[path] = item
+    return attributes
+
+# ==========================================
+# JOB JOURNAL (RESUME AFTER RESTART)
+# ==========================================
+
+# Journal columns a job is started from
+JOB_COLUMNS = 'job_id, url, format_type, quality, user_id, chat_id, message_id, stage, job_dir, parts, attempts'
+
+def save_job_record(job_id, url, format_type, quality, user_id, chat_id, message_id, worker):
+    """Journals a new job: it stays in the table until the job is finished (worker None: waits for a worker)"""
+    db.write('''
+        INSERT OR REPLACE INTO jobs (job_id, url, format_type, quality, user_id, chat_id, message_id, stage, attempts, worker, date_created, date_updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, datetime('now'), datetime('now'))
+    ''', (job_id, url, format_type, quality, user_id, chat_id, message_id, worker))
+
+def update_job_record(job_id, **fields):
+    """Updates columns of a journaled job (stage, folder, finished parts)"""
+    columns = ', '.join(f'{name} = ?' for name in fields)
+    db.write(f"UPDATE jobs SET {columns}, date_updated = datetime('now') WHERE job_id = ?", (*fields.values(), job_id))
+
+def delete_job_record(job_id):
+    """Removes a finished job from the journal"""
+    db.write('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+def spawn_job(coroutine):
+    """Runs a download job in the background; on shutdown it is cancelled and resumed after the restart"""
+    task = loop.create_task(coroutine)
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+    return task
+
+async def stop_jobs():
+    """Shutdown: cancels running jobs, their journal entries and folders are kept"""
+    for task in job_tasks:
+        task.cancel()
+    if job_tasks:
+        await asyncio.wait(set(job_tasks))
+
+async def resume_jobs(client, adopt_queued=False):
+    """Startup: re-adopts this process's jobs interrupted by the previous shutdown or crash"""
+    # adopt_queued: the bot without workers also runs the jobs left in the shared queue while USE_WORKERS was on
+    rows = await db.fetchall(f'SELECT {JOB_COLUMNS}, worker FROM jobs WHERE worker = ? OR (? AND worker IS NULL) ORDER BY date_created', (WORKER_ID, adopt_queued))
+    for row in rows:
+        if row[-1] is None:
+            update_job_record(row[0], worker=WORKER_ID)
+        await adopt_job(client, row[:-1], resumed=row[-1] is not None)
+
+async def release_local_jobs():
+    """Worker mode startup: jobs the bot ran itself before USE_WORKERS was turned on go to the shared queue"""
+    released = await db.execute("UPDATE jobs SET worker = NULL WHERE worker = 'local'")
+    if released:
+        console_log(f"Jobs handed over to the workers: {released}")
+
+async def adopt_job(client, row, resumed):
+    """Starts a journaled job: a queued one, or one interrupted by a restart (resumed)"""
+    job_id, url, format_type, quality, user_id, chat_id, message_id, stage, job_dir, parts, attempts = row
+    try:
+        status_msg = await client.get_messages(chat_id, message_id)
+        if status_msg.empty:
+            status_msg = await client.send_message(chat_id, "**Downloading...**")
+        if resumed:
+            # A playlist would be sent again from the start; a job that keeps crashing the bot is not retried forever
+            if stage == 'batch' or attempts >= JOB_MAX_RESUMES:
+                delete_job_record(job_id)
+                await status_msg.edit_text("**Download was interrupted by a restart.**\nSend the link again.")
+                return
+            update_job_record(job_id, attempts=attempts + 1, message_id=status_msg.id)
+            await status_msg.edit_text("**Bot restarted, resuming download...**")
+            console_log(f"Resumed: {url} (User: {user_id})")
+        elif status_msg.id != message_id:
+            update_job_record(job_id, message_id=status_msg.id)
+    except Exception as e:
+        console_log(f"Could not start {url}: {e}")
+        delete_job_record(job_id)
+        return
+    record = {'job_id': job_id, 'job_dir': job_dir, 'parts': json.loads(parts) if parts else None}
+    spawn_job(download_and_send(client, chat_id, url, format_type, user_id, status_msg, quality, record))
+
+async def queued_jobs_count(user_id):
+    """Jobs of the user waiting in the shared queue for a worker"""
+    row = await db.fetchone('SELECT COUNT(*) FROM jobs WHERE user_id = ? AND worker IS NULL', (user_id,))
+    return row[0]
+
+def claim_job(conn):
+    """Takes the next job from the shared queue for this worker, None if there is none (database thread)"""
+    with conn:
+        # The write lock is taken before reading: two workers never get the same job
+        conn.execute('BEGIN IMMEDIATE')
+        # Users with fewer running jobs go first, each within MAX_CONCURRENT_DOWNLOADS across all workers;
+        # jobs of a silent worker don't count as running, they are waiting for a takeover
+        stale = f'-{WORKER_HEARTBEAT_TIMEOUT} seconds'
+        row = conn.execute(f'''
+            SELECT {JOB_COLUMNS}, worker FROM (
+                SELECT *, (
+                    SELECT COUNT(*) FROM jobs AS other
+                    WHERE other.user_id = jobs.user_id AND (other.worker = 'local' OR other.heartbeat >= datetime('now', ?))
+                ) AS running
+                FROM jobs
+                WHERE worker IS NULL OR (worker != 'local' AND heartbeat < datetime('now', ?))
+            )
+            WHERE running < ?
+            ORDER BY running, date_created
+            LIMIT 1
+        ''', (stale, stale, MAX_CONCURRENT_DOWNLOADS)).fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET worker = ?, heartbeat = datetime('now') WHERE job_id = ?", (WORKER_ID, row[0]))
+    return row
+
+async def run_worker(client):
+    """Worker mode: resumes own jobs, then takes jobs from the shared queue while there is room"""
+    await resume_jobs(client)
+    next_heartbeat = 0
+    while True:
+        try:
+            if time.monotonic() >= next_heartbeat:
+                # Jobs of a worker that stops marking them are taken over by the others
+                db.write("UPDATE jobs SET heartbeat = datetime('now') WHERE worker = ?", (WORKER_ID,))
+                next_heartbeat = time.monotonic() + WORKER_HEARTBEAT_INTERVAL
+            while len(job_tasks) < MAX_GLOBAL_DOWNLOADS:
+                row = await db.call(claim_job)
+                if not row:
+                    break
+                # A job taken over from a silent worker continues like one interrupted by a restart
+                await adopt_job(client, row[:-1], resumed=row[-1] is not None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"Worker queue check failed: {e}")
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+
 # ==========================================
 # COMMAND AND MESSAGE HANDLERS
 # ==========================================
@@ -284,21 +2730,21 @@ async def link_handler(client, message):
     
     url_hash = await save_url_mapping(url)
     
-    # Create format selection buttons
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🎬 Video", callback_data=f"dl_video_{url_hash}"),
-            InlineKeyboardButton("🎵 Audio", callback_data=f"dl_audio_{url_hash}")
-        ]
-    ])
+    # Create format selection buttons (Spotify has audio only)
+    keyboard = build_format_keyboard(url_hash, audio_only=is_spotify_url(url))
     
-    await message.reply_text("Select download format:", reply_markup=keyboard)
+    reply = await message.reply_text("Select download format:", reply_markup=keyboard)
+    # Metadata is fetched in the background while the user chooses a format
+    describe_tasks[(reply.chat.id, reply.id)] = asyncio.create_task(describe_link(reply, url, url_hash))
 
-@app.on_callback_query(filters.regex(r'^dl_(video|audio)_(.+)'))
+@app.on_callback_query(filters.regex(r'^dl_(video|audio)_([\w-]+)(?::(\w+))?$'))
 async def download_callback(client, callback_query):
     """Handles 'Video' or 'Audio' button clicks"""
     format_type = callback_query.matches[0].group(1)
     url_hash = callback_query.matches[0].group(2)
+    # Reduced quality button: maximum video height
+    quality = callback_query.matches[0].group(3)
+    quality = int(quality) if quality and quality.isdigit() else None
     url = await get_url_from_hash(url_hash)
     user_id = callback_query.from_user.id
     
@@ -306,51 +2752,521 @@ async def download_callback(client, callback_query):
         await callback_query.answer("Error: Link not found in database.", show_alert=True)
         return
 
-    # Check simultaneous download limits
-    download_id = await can_start_download(user_id)
-    if not download_id:
-        await callback_query.answer("Simultaneous download limit reached (max 2).", show_alert=True)
+    # Check the limit of queued downloads
+    queued = await queued_jobs_count(user_id) if USE_WORKERS else queued_count(user_id)
+    if queued >= MAX_QUEUED_PER_USER:
+        await callback_query.answer(f"Download queue limit reached (max {MAX_QUEUED_PER_USER}).", show_alert=True)
         return
 
+    # Reject a file known to be too large before downloading anything
+    size = await get_estimated_size(url, format_type, quality)
+    if size and size > MAX_DOWNLOAD_SIZE_BYTES:
+        await callback_query.answer(f"File is too large (~{format_size(size)}, limit {MAX_DOWNLOAD_SIZE_MB} MB).", show_alert=True)
+        return
+
+    # The message becomes a status message: stop adding metadata to it
+    describe_task = describe_tasks.pop((callback_query.message.chat.id, callback_query.message.id), None)
+    if describe_task:
+        describe_task.cancel()
+
     await callback_query.answer("Starting download...")
     status_msg = await callback_query.message.edit_text("**Downloading...**")
     
+    if USE_WORKERS:
+        # Worker mode: the job goes to the shared queue, a free worker takes it
+        save_job_record(str(uuid.uuid4())[:8], url, format_type, quality, user_id, callback_query.message.chat.id, status_msg.id, None)
+        return
+
     # Run download in a background task
-    asyncio.create_task(download_and_send(client, callback_query.message.chat.id, url, format_type, user_id, download_id, status_msg))
+    spawn_job(download_and_send(client, callback_query.message.chat.id, url, format_type, user_id, status_msg, quality))
+
+async def download_and_send(client, chat_id, url, format_type, user_id, status_msg, quality=None, record=None):
+    """Journals the job, runs it and removes it from the journal once it is done"""
+    if record is None:
+        record = {'job_id': str(uuid.uuid4())[:8]}
+        save_job_record(record['job_id'], url, format_type, quality, user_id, chat_id, status_msg.id, WORKER_ID)
+    started = time.monotonic()
+    try:
+        await handle_download(client, chat_id, url, format_type, user_id, status_msg, quality, record)
+    except asyncio.CancelledError:
+        # Shutdown: the job stays in the journal and is resumed after the restart
+        raise
+    except Exception as e:
+        # A status message edit failed (message deleted, FloodWait...): the job is over all the same
+        record.setdefault('result', 'failed')
+        record.setdefault('error', str(e)[:300])
+        console_log(f"Job {record['job_id']} ended with an error: {e}")
+    # Sent or failed: it must not run again after a restart
+    delete_job_record(record['job_id'])
+    log_job(record, url, format_type, quality, user_id, time.monotonic() - started)
 
-async def download_and_send(client, chat_id, url, format_type, user_id, download_id, status_msg):
+async def handle_download(client, chat_id, url, format_type, user_id, status_msg, quality, record):
     """Main function to download and send the file"""
     try:
-        unique_id = str(uuid.uuid4())[:8]
-        ydl_opts = get_ydl_options(format_type, unique_id, download=True)
-        
-        # Download file via yt-dlp in a separate thread
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(executor, lambda: ydl.extract_info(url, download=True))
-            file_path = ydl.prepare_filename(info)
-            # Adjust extension for audio
-            if format_type == 'audio':
-                file_path = os.path.splitext(file_path)[0] + ".mp3"
-
-        if os.path.exists(file_path):
-            await status_msg.edit_text("**Uploading file...**")
-            # Send based on type
-            if format_type == 'video':
-                await client.send_video(chat_id, video=file_path, caption=f"**Done!**\n{url}")
-            else:
-                await client.send_audio(chat_id, audio=file_path, caption=f"**Done!**\n{url}")
-            
+        if is_spotify_url(url):
+            # Spotify: tracks are matched and sent one by one as they finish
+            update_job_record(record['job_id'], stage='batch')
+            record['result'] = 'spotify'
+            await download_spotify(client, chat_id, url, user_id, status_msg)
+            return
+
+        # Already sent this source before: resend by file_id without downloading
+        cache_key = get_url_cache_key(url)
+        cache_format = get_cache_format(format_type, quality)
+        cached_file_id = await get_cached_file_id(cache_key, cache_format)
+        if cached_file_id and await send_cached_media(client, chat_id, url, format_type, cached_file_id, record.setdefault('delivered', {})):
+            record['result'] = 'cached'
+            await status_msg.delete()
+            return
+
+        info = await get_media_info(url)
+        if is_batch(info):
+            # Playlist, album or carousel: entries are downloaded in parallel and sent in albums
+            update_job_record(record['job_id'], stage='batch')
+            record['result'] = 'batch'
+            await download_batch(client, chat_id, url, format_type, user_id, status_msg, info)
+            return
+
+        flight_key = (cache_key, cache_format)
+        if flight_key in inflight_downloads:
+            # The same file is already being downloaded for someone else: wait for it
+            flight = inflight_downloads[flight_key]
+            await status_msg.edit_text("**This file is already being downloaded, waiting...**")
+            flight['progress'].attach(status_msg)
+            file_id = await asyncio.shield(flight['future'])
+            if file_id and await send_cached_media(client, chat_id, url, format_type, file_id):
+                record['result'] = 'joined'
+                await status_msg.delete()
+                return
+            record['result'] = 'failed'
+            await status_msg.edit_text("Error: File was not created." if not file_id else "Error: Could not send the file, please try again.")
+            return
+
+        # Nobody is downloading it yet: this request leads, the rest attach to it
+        flight = {'future': loop.create_future(), 'progress': ProgressReporter([status_msg])}
+        inflight_downloads[flight_key] = flight
+        download_id = None
+        try:
+            # Wait for a free slot in the shared queue
+            queued = time.monotonic()
+            download_id = await acquire_download_slot(user_id, status_msg)
+            record['queue_seconds'] = round(time.monotonic() - queued, 2)
+            flight['progress'].start()
+            file_id = await run_pipeline(client, chat_id, url, format_type, quality, cache_key, flight['progress'], record)
+            flight['future'].set_result(file_id)
+        except Exception as e:
+            flight['future'].set_exception(e)
+            # Mark the exception as retrieved when nobody attached to this download
+            flight['future'].exception()
+            raise
+        finally:
+            flight['progress'].close()
+            record['stages'] = flight['progress'].stage_stats
+            del inflight_downloads[flight_key]
+            # Free up slot in download queue
+            if download_id:
+                await finish_download(user_id, download_id)
+
+        record['result'] = 'sent' if file_id else 'failed'
+        if file_id:
             await status_msg.delete()
-            # Remove temporary file
-            if os.path.exists(file_path): os.remove(file_path)
         else:
             await status_msg.edit_text("Error: File was not created.")
             
     except Exception as e:
+        if record.get('result') in ('sent', 'cached', 'joined'):
+            # The file is delivered, only removing the status message failed
+            console_log(f"Status message not removed for {url}: {e}")
+            return
+        record.update(result='failed', error=str(e)[:300])
         console_log(f"Error downloading {url}: {e}")
-        await status_msg.edit_text(f"**Download error:**\n{str(e)[:100]}")
+        try:
+            await status_msg.edit_text(f"**Download error:**\n{str(e)[:100]}")
+        except Exception:
+            pass
+
+def new_job(unique_id=None):
+    """State of one pass through the pipeline"""
+    return {'unique_id': unique_id or str(uuid.uuid4())[:8], 'files': [], 'engine': DOWNLOAD_ENGINE}
+
+async def resolve_media(job, url, format_type, quality=None, size_limit=MAX_DOWNLOAD_SIZE_BYTES, info=None):
+    """Resolve stage: metadata (prefetched when the link arrived) and format selection"""
+    await advance_stage(job, 'resolve')
+    info = info or await get_media_info(url)
+    info = await pipeline_stages['resolve'].run_in_thread(select_formats, info, format_type, quality)
+    # Preflight: don't download what can't be sent anyway
+    size = estimate_filesize(info)
+    if size and size > size_limit:
+        raise ValueError(f"File is too large: ~{format_size(size)} (limit {size_limit // (1024 * 1024)} MB)")
+    # Small files are staged in RAM
+    job['size_hint'] = size
+    return info
+
+async def fetch_media(job, info, format_type, progress):
+    """Download and post-processing stages; returns the files to send, [] if nothing was downloaded"""
+    if job.get('parts') and all(os.path.exists(path) for path in job['parts']):
+        # Resumed job: downloaded and processed before the restart
+        job['files'].extend(job['parts'])
+        job['attributes'] = await describe_media(job, info, format_type, job['parts'])
+        return job['parts']
+    source = acquire_source(get_media_cache_key(info)) if format_type == 'audio' and FFMPEG_AVAILABLE else None
+    if source:
+        # Audio track of a recently downloaded file: nothing to download
+        job['source'] = source
+        files, formats = [source['path']], [source['format']]
+        job['target'] = os.path.join(get_job_dir(job, AUDIO_DIR), f"{yt_dlp.utils.sanitize_filename(info.get('title') or 'audio')}.src")
+    else:
+        # Download file via yt-dlp in the download stage thread pool
+        await advance_stage(job, 'download')
+        files = await download_media(job, info, format_type, progress)
+        if not files:
+            return []
+        formats = info.get('requested_formats') or [info]
+        # The stream with the audio track (the second one in a merge) is kept for audio requests
+        for path, fmt in reversed(list(zip(files, formats))):
+            if format_type == 'audio' or fmt.get('acodec') != 'none':
+                job['download_source'] = (path, {'acodec': fmt.get('acodec'), 'vcodec': fmt.get('vcodec')})
+                break
+
+    # FFmpeg merge/conversion without occupying download threads
+    await advance_stage(job, 'postprocess')
+    progress.set_stage('postprocess')
+    file_path = await pipeline_stages['postprocess'].run_in_thread(postprocess_media, files, formats, format_type, job['target'])
+    job['files'].append(file_path)
+    # Over the Telegram limit: parts cut by stream copy, uploaded as a numbered series
+    parts = await pipeline_stages['postprocess'].run_in_thread(split_media, file_path, info.get('duration'))
+    job['files'].extend(parts)
+    if job.get('journaled'):
+        update_job_record(job['unique_id'], parts=json.dumps(parts))
+    job['attributes'] = await describe_media(job, info, format_type, parts)
+    return parts
+
+async def release_job(job):
+    """Cleanup stage: removes the job's files and frees its place in the pipeline"""
+    source = job.pop('source', None)
+    try:
+        # Remove the job folder with all temporary files (a cached source stays in the cache)
+        await advance_stage(job, 'cleanup')
+        if not job.get('cancelled'):
+            await pipeline_stages['cleanup'].run_in_thread(remove_job_dir, job)
+    finally:
+        if source:
+            release_source(source)
+        # A folder left behind by a cancelled cleanup is picked up by the orphan sweep
+        staging_jobs.pop(job['unique_id'], None)
+        leave_stage(job)
+        dispatch_downloads()
+
+async def run_pipeline(client, chat_id, url, format_type, quality, cache_key, progress, record):
+    """Passes a job through all pipeline stages and returns the file_id of the sent file"""
+    cache_format = get_cache_format(format_type, quality)
+    job = new_job(record['job_id'])
+    # Stages, folder and finished parts go to the journal
+    job['journaled'] = True
+    if record.get('job_dir') and os.path.isdir(record['job_dir']):
+        adopt_job_dir(job, record['job_dir'])
+        job['parts'] = record.get('parts')
+    try:
+        info = await resolve_media(job, url, format_type, quality)
+        media_key = get_media_cache_key(info)
+        # A different link to an already sent video
+        cached_file_id = media_key and await get_cached_file_id(media_key, cache_format)
+        if cached_file_id and await send_cached_media(client, chat_id, url, format_type, cached_file_id, record.setdefault('delivered', {})):
+            await save_cached_file_id([cache_key], cache_format, cached_file_id)
+            return cached_file_id
+
+        parts = await fetch_media(job, info, format_type, progress)
+        if not parts:
+            return None
+
+        await advance_stage(job, 'upload')
+        file_id = await upload_parts(client, chat_id, url, format_type, parts, progress, job['attributes'], record.get('delivered'))
+        # Remember file_id for instant resends of the same source
+        await save_cached_file_id([cache_key, media_key], cache_format, file_id)
+        await keep_source(job, media_key)
+        return file_id
+    except asyncio.CancelledError:
+        # Shutdown: partial files stay for the resume after the restart
+        job['cancelled'] = True
+        raise
+    finally:
+        await release_job(job)
+
+# ==========================================
+# PLAYLISTS AND ALBUMS (BATCH MODE)
+# ==========================================
+
+def get_entry_url(entry):
+    """Own link of a playlist entry, None if the entry was extracted together with the playlist"""
+    if entry.get('_type') in ('url', 'url_transparent'):
+        return entry.get('url')
+    return None
+
+async def download_batch(client, chat_id, url, format_type, user_id, status_msg, playlist):
+    """Prepares playlist entries in parallel and sends them in albums as they become ready"""
+    entries = collections.deque(entry for entry in (playlist.get('entries') or []) if entry)
+    total = min(len(entries), BATCH_MAX_ITEMS)
+    entries = collections.deque(itertools.islice(entries, total))
+    batch = {'total': total, 'sent': 0, 'failed': 0, 'bytes': 0, 'next_edit': 0, 'pending': collections.deque(), 'lock': asyncio.Lock()}
+    if not total:
+        raise ValueError("Playlist is empty")
+    await update_batch_status(status_msg, batch, force=True)
+
+    async def worker():
+        while entries:
+            entry = entries.popleft()
+            try:
+                batch['pending'].append(await prepare_batch_entry(entry, format_type, user_id, batch))
+            except Exception as e:
+                console_log(f"Playlist entry failed ({url}): {e}")
+                batch['failed'] += 1
+                await update_batch_status(status_msg, batch)
+                continue
+            await flush_batch(client, chat_id, url, format_type, status_msg, batch)
+
+    await asyncio.gather(*(worker() for _ in range(min(BATCH_PARALLEL, total))))
+    await flush_batch(client, chat_id, url, format_type, status_msg, batch, final=True)
+    await update_batch_status(status_msg, batch, force=True)
+
+async def prepare_batch_entry(entry, format_type, user_id, batch):
+    """Brings one entry to a sendable state: cached file_ids or downloaded files"""
+    entry_url = get_entry_url(entry)
+    cache_key = get_url_cache_key(entry_url) if entry_url else get_media_cache_key(entry)
+    cached_file_id = cache_key and await get_cached_file_id(cache_key, format_type)
+    if cached_file_id:
+        return {'media': cached_file_id.split(PART_SEPARATOR), 'cache_keys': [], 'job': None}
+    size_limit = min(MAX_DOWNLOAD_SIZE_BYTES, BATCH_MAX_BYTES - batch['bytes'])
+    if size_limit <= 0:
+        raise ValueError("Playlist size limit reached")
+    # Entries share the user's download slots with the rest of their jobs
+    download_id = await acquire_download_slot(user_id, None)
+    job = new_job()
+    try:
+        info = await resolve_media(job, entry_url, format_type, size_limit=size_limit, info=None if entry_url else entry)
+        media_key = get_media_cache_key(info)
+        cached_file_id = media_key and media_key != cache_key and await get_cached_file_id(media_key, format_type)
+        if cached_file_id:
+            await release_job(job)
+            return {'media': cached_file_id.split(PART_SEPARATOR), 'cache_keys': [cache_key], 'job': None}
+        parts = await fetch_media(job, info, format_type, ProgressReporter([]))
+        if not parts:
+            raise ValueError("File was not created")
+        # Files wait for their album outside the pipeline stages
+        leave_stage(job)
+        batch['bytes'] += sum(os.path.getsize(path) for path in parts)
+        return {'media': parts, 'cache_keys': [cache_key, media_key], 'job': job}
+    except BaseException:
+        await release_job(job)
+        raise
+    finally:
+        await finish_download(user_id, download_id)
+
+async def flush_batch(client, chat_id, url, format_type, status_msg, batch, final=False):
+    """Sends full albums of ready entries (and the remainder at the end)"""
+    async with batch['lock']:
+        pending = batch['pending']
+        while pending and (final or sum(len(item['media']) for item in pending) >= MEDIA_GROUP_SIZE):
+            group = [pending.popleft()]
+            while pending and sum(len(item['media']) for item in group) + len(pending[0]['media']) <= MEDIA_GROUP_SIZE:
+                group.append(pending.popleft())
+            await send_batch_group(client, chat_id, url, format_type, group, batch)
+            await update_batch_status(status_msg, batch)
+
+async def send_batch_group(client, chat_id, url, format_type, group, batch):
+    """Sends entries as one album (one by one if the album is rejected) and caches their file_ids"""
+    media = [path for item in group for path in item['media']]
+    attributes = {}
+    for item in group:
+        if item['job']:
+            attributes.update(item['job']['attributes'])
+    file_ids = None
+    upload_job = {}
+    await advance_stage(upload_job, 'upload')
+    try:
+        if 1 < len(media) <= MEDIA_GROUP_SIZE:
+            media_class = InputMediaVideo if format_type == 'video' else InputMediaAudio
+            try:
+                messages = await client.send_media_group(chat_id, [media_class(path, caption=f"**Done!**\n{url}" if index == 0 else "", **attributes.get(path, {})) for index, path in enumerate(media)])
+                file_ids = [get_sent_file_id(message) for message in messages]
+            except Exception as e:
+                console_log(f"Album rejected, sending files one by one: {e}")
+        if file_ids is None:
+            file_ids = []
+            for path in media:
+                try:
+                    file_ids.append(await upload_media(client, chat_id, format_type, path, f"**Done!**\n{url}", None, attributes.get(path)))
+                except Exception as e:
+                    console_log(f"Playlist file failed ({url}): {e}")
+                    file_ids.append(None)
+    finally:
+        leave_stage(upload_job)
+    position = 0
+    for item in group:
+        item_ids = file_ids[position:position + len(item['media'])]
+        position += len(item['media'])
+        if all(item_ids):
+            batch['sent'] += 1
+            if item['job']:
+                await save_cached_file_id(item['cache_keys'], format_type, PART_SEPARATOR.join(item_ids))
+        else:
+            batch['failed'] += 1
+        if item['job']:
+            await release_job(item['job'])
+
+async def update_batch_status(status_msg, batch, force=False):
+    """Shows playlist progress in the status message (no more often than PROGRESS_EDIT_INTERVAL)"""
+    if not force and time.monotonic() < batch['next_edit']:
+        return
+    batch['next_edit'] = time.monotonic() + PROGRESS_EDIT_INTERVAL
+    text = f"**Playlist:** sent {batch['sent']} of {batch['total']}"
+    if batch['failed']:
+        text += f", failed {batch['failed']}"
+    try:
+        await status_msg.edit_text(text)
+    except Exception:
+        pass
+
+# ==========================================
+# SPOTIFY (SPOTDL)
+# ==========================================
+
+# spotDL downloader per worker thread: each one drives its own event loop
+spotify_threads = threading.local()
+spotify_client_lock = threading.Lock()
+spotify_client_ready = False
+
+def is_spotify_url(url):
+    """Spotify track, album or playlist link"""
+    return bool(SPOTIFY_URL_PATTERN.match(url))
+
+def init_spotify_client():
+    """Sets up the Spotify API client of spotDL once per process (blocking)"""
+    global spotify_client_ready
+    from spotdl.utils.config import DEFAULT_CONFIG
+    from spotdl.utils.spotify import SpotifyClient
+    with spotify_client_lock:
+        if not spotify_client_ready:
+            SpotifyClient.init(
+                client_id=SPOTIFY_CLIENT_ID or DEFAULT_CONFIG['client_id'],
+                client_secret=SPOTIFY_CLIENT_SECRET or DEFAULT_CONFIG['client_secret'],
+                user_auth=False,
+            )
+            spotify_client_ready = True
+
+def get_spotify_downloader():
+    """spotDL downloader of the current thread (blocking)"""
+    from spotdl.download.downloader import Downloader
+    init_spotify_client()
+    if not hasattr(spotify_threads, 'downloader'):
+        spotify_threads.downloader = Downloader(dict(SPOTDL_OPTIONS, ffmpeg=FFMPEG_PATH))
+    return spotify_threads.downloader
+
+def get_spotify_songs(url):
+    """Track metadata of a Spotify track, album or playlist (blocking)"""
+    from spotdl.utils.search import get_simple_songs
+    init_spotify_client()
+    return get_simple_songs([url])[:BATCH_MAX_ITEMS]
+
+def match_spotify_song(song):
+    """Searches the audio providers for the track's source (blocking)"""
+    return get_spotify_downloader().search(song)
+
+def download_spotify_song(song, source, directory):
+    """Downloads the matched source and tags the MP3 with metadata and cover art (blocking)"""
+    downloader = get_spotify_downloader()
+    downloader.settings['output'] = os.path.join(directory, "{artists} - {title}.{output-ext}")
+    # A known source skips spotDL's own search
+    song.download_url = source
+    _, path = downloader.download_song(song)
+    return str(path) if path else None
+
+async def get_spotify_match(song, slots):
+    """Audio source of a track: from the match cache, otherwise searched and remembered"""
+    row = await db.fetchone('''
+        SELECT source_url FROM spotify_matches
+        WHERE track_id = ? AND date_created > datetime('now', ?)
+    ''', (song.song_id, f'-{SPOTIFY_MATCH_TTL_DAYS} days'))
+    if row:
+        return row[0]
+    async with slots:
+        source = await pipeline_stages['resolve'].run_in_thread(match_spotify_song, song)
+    if not source:
+        raise ValueError(f"No audio source found for {song.display_name}")
+    db.write('''
+        INSERT OR REPLACE INTO spotify_matches (track_id, source_url, date_created)
+        VALUES (?, ?, datetime('now'))
+    ''', (song.song_id, source))
+    return source
+
+async def download_spotify(client, chat_id, url, user_id, status_msg):
+    """Resolves a Spotify link, matches its tracks in parallel and sends each track when it is ready"""
+    if not SPOTDL_AVAILABLE or not FFMPEG_AVAILABLE:
+        raise ValueError("Spotify links need spotDL and FFmpeg")
+    songs = await pipeline_stages['resolve'].run_in_thread(get_spotify_songs, url)
+    if not songs:
+        raise ValueError("No tracks found")
+    batch = {'total': len(songs), 'sent': 0, 'failed': 0, 'next_edit': 0, 'error': None}
+    if batch['total'] > 1:
+        await update_batch_status(status_msg, batch, force=True)
+    # Matching runs ahead of the downloads for the whole list
+    slots = asyncio.Semaphore(SPOTIFY_MATCH_PARALLEL)
+    matches = {}
+    for song in songs:
+        if song.song_id not in matches:
+            matches[song.song_id] = asyncio.ensure_future(get_spotify_match(song, slots))
+    songs = collections.deque(songs)
+
+    async def worker():
+        while songs:
+            song = songs.popleft()
+            try:
+                await send_spotify_song(client, chat_id, song, matches[song.song_id], user_id)
+                batch['sent'] += 1
+            except Exception as e:
+                console_log(f"Spotify track failed ({song.url}): {e}")
+                batch['failed'] += 1
+                batch['error'] = e
+            if batch['total'] > 1:
+                await update_batch_status(status_msg, batch)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(BATCH_PARALLEL, batch['total']))))
+    finally:
+        for match in matches.values():
+            # Failed matches of tracks that were sent from the cache are marked as retrieved
+            if match.done() and not match.cancelled():
+                match.exception()
+            match.cancel()
+    if batch['total'] > 1:
+        await update_batch_status(status_msg, batch, force=True)
+    elif batch['error']:
+        raise batch['error']
+    else:
+        await status_msg.delete()
+
+async def send_spotify_song(client, chat_id, song, match, user_id):
+    """Sends one track: by cached file_id, or downloaded from its matched source"""
+    cache_key = get_url_cache_key(song.url)
+    cached_file_id = await get_cached_file_id(cache_key, 'audio')
+    if cached_file_id and await send_cached_media(client, chat_id, song.url, 'audio', cached_file_id):
+        return
+    source = await asyncio.shield(match)
+    # Tracks share the user's download slots with the rest of their jobs
+    download_id = await acquire_download_slot(user_id, None)
+    job = new_job()
+    try:
+        await advance_stage(job, 'download')
+        path = await pipeline_stages['download'].run_in_thread(download_spotify_song, song, source, get_job_dir(job, SPOTIFY_DIR))
+        if not path:
+            raise ValueError("File was not created")
+        job['files'].append(path)
+        # The cover embedded by spotDL becomes the thumbnail
+        attributes = await describe_media(job, {'artist': song.artist, 'track': song.name}, 'audio', [path])
+        await advance_stage(job, 'upload')
+        file_id = await upload_media(client, chat_id, 'audio', path, f"**Done!**\n{song.url}", None, attributes[path])
+        await save_cached_file_id([cache_key], 'audio', file_id)
     finally:
-        # Free up slot in download queue
+        await release_job(job)
         await finish_download(user_id, download_id)
 
 @app.on_inline_query()
@@ -358,27 +3274,49 @@ async def inline_handler(client, inline_query):
     """Handles inline queries (when calling bot via @botname)"""
     query = inline_query.query.strip()
     user = inline_query.from_user
-    if not query: return
+    # Partial input that is not a link yet: nothing to answer and nothing to store
+    if not INLINE_URL_PATTERN.match(query): return
     
-    console_log(f"INLINE: {query} (ID: {user.id})")
-    url_hash = hashlib.md5(query.encode()).hexdigest()
-    await save_url_mapping(query)
-    
-    # Inline search results
-    results = [
-        InlineQueryResultArticle(
-            title="Download Video",
-            input_message_content=InputTextMessageContent(f"🎬 Downloading video:\n{query}"),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎬 Download", callback_data=f"dl_video_{url_hash}")]])
-        ),
-        InlineQueryResultArticle(
-            title="Download Audio",
-            input_message_content=InputTextMessageContent(f"🎵 Downloading audio:\n{query}"),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎵 Download", callback_data=f"dl_audio_{url_hash}")]])
-        )
-    ]
-    await inline_query.answer(results, cache_time=1)
+    # A newer keystroke replaces the query that is still waiting
+    previous = inline_tasks.pop(user.id, None)
+    if previous:
+        previous.cancel()
+    task = asyncio.create_task(answer_inline_query(inline_query, query))
+    inline_tasks[user.id] = task
+    task.add_done_callback(lambda t: finish_inline_task(user.id, t))
+
+def serve(client, coroutines):
+    """Runs the client and background tasks until a stop signal, then stops the running jobs"""
+    clear_source_cache()
+    client.start()
+    background_tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+    idle()
+    for task in background_tasks:
+        task.cancel()
+    # Unfinished jobs stay in the journal and continue after the restart
+    loop.run_until_complete(stop_jobs())
+    loop.run_until_complete(upload_engine.close())
+    client.stop()
 
 if __name__ == "__main__":
-    console_log("Bot started!")
-    app.run()
+    if sys.argv[1:2] == ['--bench'] and len(sys.argv) > 2:
+        # Download engine benchmark without starting the bot
+        loop.run_until_complete(benchmark_download(sys.argv[2]))
+    elif sys.argv[1:2] == ['--worker']:
+        # Download worker for the bot in worker mode: python bot_en.py --worker [name] [metrics port] (one name and port per worker on a host)
+        worker_name = sys.argv[2] if len(sys.argv) > 2 else 'worker'
+        worker_metrics_port = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        WORKER_ID = f"{socket.gethostname()}/{worker_name}"
+        use_worker_folders(worker_name)
+        console_log(f"Worker {WORKER_ID} started!")
+        # Own session without updates: messages to the bot are handled by the bot process only
+        worker = MediaClient(name=f"media_downloader_{worker_name}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True)
+        serve(worker, [maintain_staging(), run_worker(worker)] + ([serve_metrics(worker_metrics_port)] if worker_metrics_port else []))
+    else:
+        console_log("Bot started!")
+        # In worker mode the bot only queues jobs, the workers run them
+        serve(app, [maintain_database(), maintain_staging()] + ([release_local_jobs()] if USE_WORKERS else [resume_jobs(app, adopt_queued=True)]) + ([serve_metrics(METRICS_PORT)] if METRICS_PORT else []))
+    loop.run_until_complete(close_http_session())
+    ydl_pool.close()
+    # Commit writes still waiting in the write-behind queue
+    loop.run_until_complete(db.close())
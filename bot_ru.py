@@ -1,16 +1,36 @@
 import yt_dlp
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+import aiohttp
+from aiohttp import web
+from pyrogram import Client, filters, idle, raw
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, FloodWait, MediaEmpty, RPCError
+from pyrogram.session import Session
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, InputMediaVideo, InputMediaAudio
 import logging
+import logging.handlers
 import asyncio
 import concurrent.futures
+import contextlib
 import os
 import config
 import hashlib
+import base64
 import subprocess
 import sqlite3
 import uuid
+import re
 import sys
+import itertools
+import copy
+import time
+import shutil
+import socket
+import json
+import bisect
+import mmap
+import threading
+import collections
+import urllib.parse
 
 # ==========================================
 # КОНФИГУРАЦИЯ И ЛОГИРОВАНИЕ
@@ -66,42 +86,423 @@ def check_spotdl():
 
 SPOTDL_AVAILABLE = check_spotdl()
 
+def check_ffprobe():
+    """Проверяет наличие ffprobe рядом с найденным FFmpeg (для чтения параметров медиа)"""
+    if not FFMPEG_PATH:
+        return None
+    path = os.path.join(os.path.dirname(FFMPEG_PATH), 'ffprobe') if os.path.dirname(FFMPEG_PATH) else 'ffprobe'
+    try:
+        subprocess.run([path, '-version'], capture_output=True, check=True)
+        return path
+    except:
+        return None
+
+FFPROBE_PATH = check_ffprobe()
+
 # Загрузка настроек из config.py
 API_ID = config.API_ID
 API_HASH = config.API_HASH
 BOT_TOKEN = config.BOT_TOKEN
 ALLOWED_USERS = getattr(config, 'ALLOWED_USERS', [])
+# Ключи Spotify API для spotDL (пусто: встроенные ключи spotDL)
+SPOTIFY_CLIENT_ID = getattr(config, 'SPOTIFY_CLIENT_ID', '')
+SPOTIFY_CLIENT_SECRET = getattr(config, 'SPOTIFY_CLIENT_SECRET', '')
+# Режим воркеров: бот только ставит задачи в очередь, процессы `--worker` скачивают и отправляют их
+USE_WORKERS = getattr(config, 'USE_WORKERS', False)
+# Порт эндпоинта метрик (0 - без эндпоинта); воркеры берут свой из командной строки
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9464)
+METRICS_HOST = '127.0.0.1' # Только локально: его опрашивает Prometheus или агент на том же хосте
 
 # Пути к папкам
 VIDEO_DIR = "./downloads/video/"
 AUDIO_DIR = "./downloads/audio/"
 DB_DIR = "./database/"
 THUMB_CACHE_DIR = "./thumbs_cache/"
+SOURCE_CACHE_DIR = "./downloads/sources/"
+# Небольшие файлы размещаются в RAM (tmpfs) и не касаются диска; None отключает это
+STAGING_TMPFS_DIR = "/dev/shm/media_downloader_bot/" if os.path.isdir("/dev/shm") else None
 SPOTIFY_DIR = "./downloads/spotify/"
+LOG_DIR = "./logs/"
+DB_PATH = os.path.join(DB_DIR, "bot_database.db")
 
 # Лимиты файлов (2 ГБ для Telegram)
 MAX_FILE_SIZE_BYTES = 2000 * 1024 * 1024
 MAX_FILE_SIZE_MB = 1950
+# Файлы больше лимита режутся на части по ключевым кадрам (нужен FFmpeg)
+SPLIT_OVERSIZE = True
+SPLIT_PART_SIZE_BYTES = 1900 * 1024 * 1024 # Целевой размер части, с запасом на расстояние между ключевыми кадрами
+MAX_SPLIT_PARTS = 4
+SPLIT_ATTEMPTS = 3 # Повторы с более короткими сегментами, если часть всё равно вышла слишком большой
+SPLIT_UPLOAD_CONCURRENCY = 2 # Частей одного файла, загружаемых одновременно
+PART_SEPARATOR = ',' # Между file_id частей файла в кэше
+# Отправка в Telegram: файл уходит частями сразу по нескольким медиа-соединениям
+UPLOAD_CONNECTIONS = 4 # Медиа-сессии, открытые для отправки
+UPLOAD_REQUESTS_PER_CONNECTION = 2 # Частей в полете на каждой сессии
+UPLOAD_PART_SIZE = 512 * 1024 # Самая большая часть, которую принимает Telegram
+UPLOAD_BIG_FILE_SIZE = 10 * 1024 * 1024 # Файлы больше отправляются как "большие" (правило Telegram)
+UPLOAD_PART_RETRIES = 5 # Попыток на часть, прежде чем отправка завершится ошибкой
+UPLOAD_RETRY_DELAY = 1 # Секунд, умножается на номер попытки
+MAX_DOWNLOAD_SIZE_BYTES = MAX_SPLIT_PARTS * SPLIT_PART_SIZE_BYTES if SPLIT_OVERSIZE and FFMPEG_AVAILABLE else MAX_FILE_SIZE_BYTES
+MAX_DOWNLOAD_SIZE_MB = MAX_DOWNLOAD_SIZE_BYTES // (1024 * 1024) if SPLIT_OVERSIZE and FFMPEG_AVAILABLE else MAX_FILE_SIZE_MB
+# Оценки размера, которые принимает планировщик форматов, с запасом MAX_FILE_SIZE_MB до жестких лимитов
+PLAN_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024 # Отправляется одним файлом
+PLAN_SIZE_LIMIT_BYTES = MAX_DOWNLOAD_SIZE_BYTES - (MAX_FILE_SIZE_BYTES - PLAN_FILE_SIZE_BYTES) # При необходимости делится на части
+
+# Рабочие папки: каждая задача работает в своей папке, которая удаляется по завершении задачи
+STAGING_QUOTA_BYTES = 20 * 1024 * 1024 * 1024 # Задачи ждут в очереди, пока папки задач занимают больше этого
+STAGING_MIN_FREE_BYTES = 1024 * 1024 * 1024 # ...или пока свободного места на диске меньше этого
+STAGING_TMPFS_MAX_FILE_BYTES = 64 * 1024 * 1024 # Самая большая задача (источник и результат вместе), размещаемая в RAM
+STAGING_TMPFS_MAX_BYTES = 512 * 1024 * 1024 # RAM, занимаемая всеми размещенными задачами вместе
+STAGING_SWEEP_INTERVAL = 600 # Секунд между очистками осиротевших файлов
+STAGING_MEASURE_INTERVAL = 5 # Секунд между замерами занятого рабочими папками места для дисковой квоты
+STAGING_ORPHAN_AGE = 3600 # Папки и файлы без работающей задачи старше этого (секунд) удаляются
+
+# Кэш отправленных файлов (повторная отправка по file_id Telegram вместо новой загрузки)
+MEDIA_CACHE_TTL_DAYS = 30
+MEDIA_CACHE_MAX_ENTRIES = 50000
+
+# Недавно скачанные источники: запросы аудио берут из них звуковую дорожку вместо повторной загрузки
+SOURCE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Сверх этого размера удаляются давно не использованные источники
+SOURCE_CACHE_MAX_FILE_BYTES = 512 * 1024 * 1024 # Файлы больше этого не сохраняются
+
+# Постобработка FFmpeg: количество одновременных процессов ffmpeg и потоков для каждого,
+# чтобы вместе они занимали доступные боту ядра
+CPU_CORES = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 2)
+FFMPEG_MAX_PROCESSES = max(1, CPU_CORES // 2)
+FFMPEG_THREADS = max(1, CPU_CORES // FFMPEG_MAX_PROCESSES)
+AUDIO_STREAM_COPY = True # Отправлять AAC-аудио как M4A без перекодирования в MP3
+
+# Миниатюры, отправляемые с файлами, кэшируются по хэшу содержимого
+THUMB_SIZE = 320 # Лимит Telegram для длинной стороны
+THUMB_CACHE_MAX_BYTES = 200 * 1024 * 1024 # Сверх этого размера удаляются давно не использованные миниатюры
+THUMB_SOURCE_MAX_BYTES = 5 * 1024 * 1024 # Исходные изображения (постеры, обложки) больше этого пропускаются
+THUMB_FETCH_TIMEOUT = 15 # Секунд на загрузку исходного изображения
+THUMB_FRAME_POSITION = 0.1 # Доля длительности, на которой берется кадр видео, если нет постера
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024 # Байт с начала и с конца файла, хэшируемых как ключ его содержимого
+
+# Качество видео: планировщик выбирает лучшее, которое укладывается в MAX_FILE_SIZE_MB или в части, когда файлы делятся
+MAX_VIDEO_HEIGHT = 1080
+QUALITY_STEPS = (720, 480, 360, 240) # Кнопки пониженного качества, если лучшее качество не влезает
+
+# Плейлисты, альбомы и карусели
+BATCH_MAX_ITEMS = 50 # Сколько элементов берётся из одного плейлиста
+BATCH_MAX_BYTES = 4 * 1024 * 1024 * 1024 # Общий объём скачивания одного плейлиста
+BATCH_PARALLEL = 3 # Элементов, готовящихся одновременно (также ограничено слотами загрузки пользователя)
+MEDIA_GROUP_SIZE = 10 # Лимит альбома Telegram
+
+# Spotify: spotDL подбирает трекам аудиоисточники, скачивает их и тегирует как MP3
+SPOTIFY_URL_PATTERN = re.compile(r'^https?://open\.spotify\.com/(?:intl-[\w-]+/)?(?:track|album|playlist)/\w+')
+SPOTIFY_MATCH_PARALLEL = 2 # Треков одной ссылки, подбираемых одновременно (идет впереди загрузок)
+SPOTIFY_MATCH_TTL_DAYS = 30 # Дней, которые соответствие трек -> источник используется без повторного поиска
+SPOTDL_OPTIONS = {
+    'format': 'mp3',
+    'bitrate': '320k',
+    'audio_providers': ['youtube-music', 'youtube'],
+    'lyrics_providers': [],
+    'threads': 1, # Параллельность дают этапы конвейера
+    'overwrite': 'force',
+    'simple_tui': True,
+    'log_level': 'ERROR',
+}
+
+# Метаданные ссылки, загружаемые заранее при её получении
+METADATA_CACHE_TTL = 600 # Секунды
+METADATA_CACHE_MAX_ENTRIES = 500
 
 # Создание необходимых папок
 os.makedirs(VIDEO_DIR, exist_ok=True)
 os.makedirs(AUDIO_DIR, exist_ok=True)
 os.makedirs(DB_DIR, exist_ok=True)
 os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+if STAGING_TMPFS_DIR:
+    os.makedirs(STAGING_TMPFS_DIR, exist_ok=True)
 os.makedirs(SPOTIFY_DIR, exist_ok=True)
+os.makedirs(LOG_DIR, exist_ok=True)
 
 # Инициализация клиента Pyrogram
-app = Client(name="media_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Файлы, загруженные до отправки их сообщений: путь -> InputFile, используется отправкой один раз
+prepared_uploads = {}
+
+class MediaClient(Client):
+    """Клиент Pyrogram, отправляющий файлы с диска через upload_engine"""
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """Файлы с диска уходят параллельными частями, файлы в памяти - стандартным способом"""
+        if not isinstance(path, str):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+        if file_id is None and path in prepared_uploads:
+            return prepared_uploads.pop(path)
+        return await upload_engine.save_file(self, path, file_id, file_part, progress, progress_args)
+
+app = MediaClient(name="media_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # Настройки для работы с YouTube
 YOUTUBE_COOKIES_FILE = './cookies.txt'
+YDL_POOL_SIZE = 4 # Простаивающих экземпляров YoutubeDL, хранимых на профиль (metadata, video, audio)
 loop = asyncio.get_event_loop()
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
 
 # Управление очередью загрузок
 active_downloads = {}
 downloads_lock = asyncio.Lock()
 MAX_CONCURRENT_DOWNLOADS = 2 # Максимум одновременных загрузок на одного пользователя
+MAX_GLOBAL_DOWNLOADS = 6 # Максимум одновременных загрузок на весь бот
+MAX_QUEUED_PER_USER = 5 # Максимум задач в очереди на одного пользователя
+QUEUE_STATUS_INTERVAL = 5 # Секунды между обновлениями позиции в очереди
+# Работающие задачи загрузки: отменяются при остановке и возобновляются из таблицы jobs после перезапуска
+job_tasks = set()
+JOB_MAX_RESUMES = 3 # Сколько перезапусков задача переживает, потом от нее отказываются
+JOB_JOURNAL_DAYS = 2 # Записи журнала старше этого удаляются при очистке БД
+# Кто выполняет задачи этого процесса: 'local' для самого бота, "хост/имя" для процесса `--worker`
+WORKER_ID = 'local'
+WORKER_POLL_INTERVAL = 2 # Секунд между проверками общей очереди
+WORKER_HEARTBEAT_INTERVAL = 10 # Секунд между отметками воркера "жив" на его задачах
+WORKER_HEARTBEAT_TIMEOUT = 60 # Задачи воркера, молчащего столько секунд, забирают другие воркеры
+WORKER_DIR_PREFIX = 'worker_' # Воркеры хранят свои рабочие папки и источники в подпапках "worker_<имя>"
+# Этапы конвейера (метаданные -> скачивание из сети -> ffmpeg -> анализ и миниатюра -> отправка в Telegram -> очистка):
+# у каждого свой лимит параллельности и ограниченная очередь перед ним
+STAGE_LIMITS = {'resolve': 4, 'download': 4, 'postprocess': FFMPEG_MAX_PROCESSES, 'probe': 2, 'upload': 3, 'cleanup': 2}
+STAGE_QUEUE_SIZES = {'resolve': 16, 'download': 4, 'postprocess': 2, 'probe': 4, 'upload': 2, 'cleanup': 16}
+# Ожидающие задачи: user_id -> очередь заявок, плюс круговой порядок пользователей
+job_queues = {}
+queue_order = collections.deque()
+
+PROGRESS_EDIT_INTERVAL = 4 # Минимум секунд между правками одного сообщения о статусе
+
+# Одинаковые загрузки в процессе: (ключ кэша, формат) -> future с file_id отправленного файла и его прогресс
+inflight_downloads = {}
+
+# Заранее загруженные метаданные: нормализованная ссылка -> {'expires', 'info', 'sizes'}, плюс извлечения в процессе
+metadata_cache = collections.OrderedDict()
+metadata_fetches = {}
+metadata_cache_stats = {'hits': 0, 'misses': 0}
+# Фоновые задачи, добавляющие метаданные в сообщения выбора формата: (chat_id, message_id) -> задача
+describe_tasks = {}
+
+# Токены ссылок для кнопок: LRU в памяти перед таблицей url_mappings
+URL_TOKEN_BYTES = 9 # Байт дайджеста в токене (12 символов base64)
+URL_CACHE_MAX_ENTRIES = 10000
+url_cache = collections.OrderedDict()
+url_cache_stats = {'hits': 0, 'misses': 0}
+# Поиск уже отправленных файлов (таблица media_cache)
+media_cache_stats = {'hits': 0, 'misses': 0}
+
+# Задачи, у которых есть рабочая папка: unique_id -> задача
+staging_jobs = {}
+# Байты в рабочих папках на диске и свободное место, замеряются вне цикла событий в maintain_staging
+staging_usage = {'bytes': 0, 'free': None}
+
+# Кэш источников: ключ медиа -> {'path', 'size', 'format', 'users'} в порядке LRU
+source_cache = collections.OrderedDict()
+source_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+# Прямые ссылки на медиафайлы: скачиваются через aiohttp без экстракторов yt-dlp
+DIRECT_MEDIA_EXTENSIONS = {'mp4', 'm4v', 'mov', 'webm', 'mkv', 'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac', 'wav'}
+DIRECT_AUDIO_EXTENSIONS = {'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac', 'wav'}
+DIRECT_PROBE_TIMEOUT = 10 # Секунды на HEAD-запрос
+DIRECT_CHUNK_SIZE = 1024 * 1024 # Байт, читаемых из сокета за раз
+DIRECT_CONNECTIONS = 4 # Параллельных запросов диапазонов на файл
+DIRECT_SPLIT_MIN_SIZE = 16 * 1024 * 1024 # Файлы меньше скачиваются одним соединением
+HTTP_MAX_CONNECTIONS = 64
+http_session = None
+
+# Движок загрузки: 'segmented' качает фрагменты и большие файлы в несколько соединений, 'single' в одно
+DOWNLOAD_ENGINE = 'segmented'
+FRAGMENT_CONNECTIONS = 4 # Параллельных загрузок фрагментов HLS/DASH на файл
+FRAGMENTED_PROTOCOLS = ('m3u8', 'm3u8_native', 'http_dash_segments')
+HOST_MAX_CONNECTIONS = 8 # Соединений с одним хостом на все задачи
+DOWNLOAD_BANDWIDTH_LIMIT = 0 # Байт/сек на все активные загрузки, 0 = без ограничения
+
+# Инлайн-режим
+INLINE_URL_PATTERN = re.compile(r'^https?://[^\s/]+\.[^\s/]+(/\S*)?$')
+INLINE_DEBOUNCE = 0.6 # Секунды без нового ввода, после которых отвечаем на запрос
+INLINE_METADATA_WAIT = 2 # Секунды ожидания метаданных ссылки, после которых отвечаем без них
+INLINE_CACHE_TIME = 300 # Секунды, в течение которых Telegram может повторно использовать наш ответ на тот же запрос
+INLINE_CACHE_TIME_PARTIAL = 10 # То же для ответа без метаданных
+INLINE_RESULTS_TTL = 600 # Секунды
+INLINE_RESULTS_MAX_ENTRIES = 1000
+# Готовые ответы: нормализованная ссылка -> {'expires', 'results'}, и ожидающие ответы: user_id -> задача
+inline_results = collections.OrderedDict()
+inline_tasks = {}
+
+# ==========================================
+# МЕТРИКИ И ЖУРНАЛ ЗАДАЧ
+# ==========================================
+
+# Метрика -> (тип, описание, корзины гистограммы)
+METRIC_SECONDS_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+METRIC_SPEED_BUCKETS = tuple(64 * 1024 * 2 ** power for power in range(12)) # 64 KB/s .. 128 MB/s
+METRIC_DEFINITIONS = {
+    'bot_extract_seconds': ('histogram', "Время извлечения метаданных ссылки", METRIC_SECONDS_BUCKETS),
+    'bot_queue_wait_seconds': ('histogram', "Ожидание места загрузки в честной очереди", METRIC_SECONDS_BUCKETS),
+    'bot_stage_wait_seconds': ('histogram', "Ожидание места на этапе конвейера", METRIC_SECONDS_BUCKETS),
+    'bot_stage_seconds': ('histogram', "Время, которое задача занимает место на этапе конвейера", METRIC_SECONDS_BUCKETS),
+    'bot_ffmpeg_seconds': ('histogram', "Время работы одного процесса ffmpeg", METRIC_SECONDS_BUCKETS),
+    'bot_upload_seconds': ('histogram', "Время отправки одного файла в Telegram", METRIC_SECONDS_BUCKETS),
+    'bot_transfer_bytes_per_second': ('histogram', "Скорость задачи на этапах загрузки и отправки", METRIC_SPEED_BUCKETS),
+    'bot_transfer_bytes_total': ('counter', "Байт, скачанных и отправленных задачами", None),
+    'bot_db_seconds': ('histogram', "Задержка SQLite: запросы глазами вызывающего кода, коммиты пакетов отложенной записи", METRIC_SECONDS_BUCKETS),
+    'bot_jobs_total': ('counter', "Завершенные задачи по результату", None),
+    'bot_job_seconds': ('histogram', "Время задачи от нажатия кнопки до результата", METRIC_SECONDS_BUCKETS),
+    # Читаются из состояния бота при каждом опросе
+    'bot_cache_requests_total': ('counter', "Обращения к кэшам по кэшу и результату", None),
+    'bot_upload_parts_total': ('counter', "Части, отправленные движком отправки", None),
+    'bot_upload_part_retries_total': ('counter', "Части, отправленные повторно после ошибки", None),
+    'bot_upload_engine_bytes_total': ('counter', "Байт, отправленных движком отправки", None),
+    'bot_ydl_instances_total': ('counter', "Экземпляры YoutubeDL, взятые из пула: созданные или повторно использованные", None),
+    'bot_active_downloads': ('gauge', "Задачи, занимающие место загрузки", None),
+    'bot_queued_downloads': ('gauge', "Задачи, ожидающие в честной очереди", None),
+    'bot_stage_active': ('gauge', "Задачи, выполняемые на этапе конвейера", None),
+    'bot_stage_waiting': ('gauge', "Задачи в очереди на место этапа конвейера", None),
+    'bot_stage_limit': ('gauge', "Лимит параллельности (потоков) этапа конвейера", None),
+    'bot_db_pending_writes': ('gauge', "Записи, ожидающие в очереди отложенной записи", None),
+    'bot_upload_connections': ('gauge', "Открытые медиа-сессии движка отправки", None),
+    'bot_upload_active': ('gauge', "Файлы, которые сейчас отправляет движок отправки", None),
+    'bot_upload_engine_bytes_per_second': ('gauge', "Скорость движка отправки за время, когда что-то отправлялось", None),
+    'bot_source_cache_bytes': ('gauge', "Размер сохраненных исходников загрузок", None),
+    'bot_ydl_idle': ('gauge', "Свободные экземпляры YoutubeDL в пуле по профилям", None),
+}
+
+# JSON-журнал задач, один объект на строку (пишется независимо от MINIMAL_LOGGING)
+JOB_LOG_PATH = os.path.join(LOG_DIR, "jobs.log")
+JOB_LOG_MAX_BYTES = 10 * 1024 * 1024
+JOB_LOG_BACKUPS = 3
+
+class Metrics:
+    """Счетчики и гистограммы в текстовом формате Prometheus (потокобезопасно: потоки этапов и БД тоже пишут)"""
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Записывает одно наблюдение гистограммы"""
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.values.setdefault(key, {'counts': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0})
+            series['counts'][bisect.bisect_left(buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, samples):
+        """Текстовая выдача всех рядов плюс значений, прочитанных при опросе"""
+        with self.lock:
+            values = copy.deepcopy(self.values)
+        series = collections.defaultdict(list)
+        for (name, labels), value in values.items():
+            series[name].append((labels, value))
+        for name, labels, value in samples:
+            series[name].append((tuple(sorted(labels.items())), value))
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            if name not in series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in series[name]:
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                # В формате выдачи корзины накопительные
+                for bound, count in zip(buckets + ('+Inf',), itertools.accumulate(value['counts'])):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    """Набор меток Prometheus: {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in labels) + '}'
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+job_log = logging.getLogger('jobs')
+job_log.setLevel(logging.INFO)
+job_log.propagate = False
+job_log.addHandler(logging.handlers.RotatingFileHandler(JOB_LOG_PATH, maxBytes=JOB_LOG_MAX_BYTES, backupCount=JOB_LOG_BACKUPS, encoding='utf-8'))
+
+def log_job(record, url, format_type, quality, user_id, seconds):
+    """Записывает завершенную задачу в JSON-журнал задач и метрики задач"""
+    result = record.get('result', 'failed')
+    metrics.inc('bot_jobs_total', result=result)
+    metrics.observe('bot_job_seconds', seconds, result=result)
+    job_log.info(json.dumps({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'job_id': record['job_id'],
+        'worker': WORKER_ID,
+        'user_id': user_id,
+        'url': url,
+        'format': format_type,
+        'quality': quality,
+        'result': result,
+        'error': record.get('error'),
+        'seconds': round(seconds, 2),
+        'queue_seconds': record.get('queue_seconds'),
+        'stages': record.get('stages', {}),
+    }, ensure_ascii=False))
+
+def collect_metrics():
+    """Показатели и счетчики кэшей, читаемые из состояния бота при опросе"""
+    upload_stats = upload_engine.stats()
+    samples = [
+        ('bot_active_downloads', {}, sum(map(len, active_downloads.values()))),
+        ('bot_queued_downloads', {}, sum(map(len, job_queues.values()))),
+        ('bot_db_pending_writes', {}, len(db.pending)),
+        ('bot_upload_connections', {}, upload_stats['connections']),
+        ('bot_upload_active', {}, upload_stats['active_uploads']),
+        ('bot_upload_parts_total', {}, upload_stats['parts']),
+        ('bot_upload_part_retries_total', {}, upload_stats['retries']),
+        ('bot_upload_engine_bytes_total', {}, upload_stats['bytes']),
+        ('bot_source_cache_bytes', {}, source_cache_stats['bytes']),
+    ]
+    if upload_stats['bytes_per_sec'] is not None:
+        samples.append(('bot_upload_engine_bytes_per_second', {}, upload_stats['bytes_per_sec']))
+    pool_stats = ydl_pool.stats()
+    samples += [
+        ('bot_ydl_instances_total', {'result': 'created'}, pool_stats['created']),
+        ('bot_ydl_instances_total', {'result': 'reused'}, pool_stats['reused']),
+    ]
+    samples += [('bot_ydl_idle', {'profile': profile}, idle) for profile, idle in pool_stats['idle'].items()]
+    for stage, stats in get_pipeline_stats().items():
+        samples += [
+            ('bot_stage_active', {'stage': stage}, stats['active']),
+            ('bot_stage_waiting', {'stage': stage}, stats['waiting']),
+            ('bot_stage_limit', {'stage': stage}, stats['limit']),
+        ]
+    for cache, stats in (('url', url_cache_stats), ('metadata', metadata_cache_stats), ('media', media_cache_stats), ('source', source_cache_stats)):
+        samples += [
+            ('bot_cache_requests_total', {'cache': cache, 'result': 'hit'}, stats['hits']),
+            ('bot_cache_requests_total', {'cache': cache, 'result': 'miss'}, stats['misses']),
+        ]
+    return samples
+
+async def metrics_handler(request):
+    """GET /metrics"""
+    return web.Response(body=metrics.render(collect_metrics()).encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def serve_metrics(port):
+    """Фоновая задача: отдает /metrics на METRICS_HOST до отмены"""
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        console_log(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+        await loop.create_future()
+    except OSError as e:
+        console_log(f"Эндпоинт метрик не запущен: {e}")
+    finally:
+        await runner.cleanup()
 
 # ==========================================
 # РАБОТА С БАЗОЙ ДАННЫХ (SQLITE)
@@ -109,12 +510,25 @@ MAX_CONCURRENT_DOWNLOADS = 2 # Максимум одновременных за
 
 def get_db_connection():
     """Создает подключение к БД"""
-    DB_PATH = os.path.join(DB_DIR, "bot_database.db")
     return sqlite3.connect(DB_PATH)
 
+# Срок хранения в БД: таблица -> сколько дней хранятся строки, и столбец даты, по которому считается возраст
+DB_RETENTION_DAYS = {'url_mappings': 30, 'captions': 30, 'command_limits': 90, 'media_cache': MEDIA_CACHE_TTL_DAYS, 'spotify_matches': SPOTIFY_MATCH_TTL_DAYS, 'jobs': JOB_JOURNAL_DAYS}
+DB_RETENTION_COLUMNS = {'url_mappings': 'date_created', 'captions': 'date_created', 'command_limits': 'usage_date', 'media_cache': 'date_created', 'spotify_matches': 'date_created', 'jobs': 'date_created'}
+DB_MAINTENANCE_INTERVAL = 3600 # Секунды между проходами очистки
+DB_DELETE_CHUNK = 1000 # Строк на одну транзакцию удаления, чтобы блокировки записи были короткими
+DB_DELETE_PAUSE = 0.05 # Секунды между порциями, чтобы проходили другие записи
+DB_VACUUM_PAGES = 2000 # Свободных страниц, возвращаемых ОС за проход
+
 def init_db():
     """Создает таблицы, если они не существуют"""
     conn = get_db_connection()
+    # Освобождённые страницы возвращаются ОС через incremental_vacuum (существующий файл перестраивается один раз)
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    # WAL: читатели не ждут писателей, коммиты не переписывают основной файл
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     # Таблица пользователей
     cursor.execute('''
@@ -142,6 +556,47 @@ def init_db():
             date_created TEXT
         )
     ''')
+    # Кэш отправленных файлов (ключ источника + формат -> file_id Telegram)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            cache_key TEXT,
+            format_type TEXT,
+            file_id TEXT,
+            date_created TEXT,
+            last_used TEXT,
+            PRIMARY KEY (cache_key, format_type)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache (last_used)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_file_id ON media_cache (file_id)')
+    # Трек Spotify -> подобранный аудиоисточник (популярные треки обходятся без поиска)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS spotify_matches (
+            track_id TEXT PRIMARY KEY,
+            source_url TEXT,
+            date_created TEXT
+        )
+    ''')
+    # Журнал задач: незавершенные задачи с этапом, папкой и готовыми частями, возобновляются после перезапуска
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            url TEXT,
+            format_type TEXT,
+            quality INTEGER,
+            user_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            stage TEXT,
+            job_dir TEXT,
+            parts TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            heartbeat TEXT,
+            date_created TEXT,
+            date_updated TEXT
+        )
+    ''')
     # Таблица лимитов использования (на будущее)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS command_limits (
@@ -151,25 +606,220 @@ def init_db():
             PRIMARY KEY (user_id, usage_date)
         )
     ''')
+    # Индексы по датам для очистки устаревших строк
+    for table, column in DB_RETENTION_COLUMNS.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})')
     conn.commit()
     conn.close()
 
 init_db()
 
+# Настройки отложенной записи
+DB_FLUSH_INTERVAL = 0.5 # Секунды, которые запись может ждать, чтобы сгруппироваться с другими
+DB_BATCH_SIZE = 200 # Число записей в транзакции, при котором сброс происходит сразу
+
+class Database:
+    """Долгоживущее подключение SQLite в отдельном потоке с пакетной отложенной записью"""
+
+    def __init__(self, path):
+        self.path = path
+        # Подключением владеет один поток: запросы выполняются строго в порядке отправки
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn = None
+        self.pending = []
+        self.flush_handle = None
+
+    def _run(self, func):
+        """Выполняет func(conn) в потоке БД, открывая подключение при первом использовании"""
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('PRAGMA busy_timeout=5000')
+        return func(self.conn)
+
+    async def call(self, func):
+        """Выполняет func(conn) в потоке БД после всех записей, поставленных в очередь раньше"""
+        self.flush()
+        started = time.monotonic()
+        try:
+            return await loop.run_in_executor(self.executor, self._run, func)
+        finally:
+            metrics.observe('bot_db_seconds', time.monotonic() - started, operation='query')
+
+    async def fetchone(self, sql, params=()):
+        """Читает одну строку"""
+        return await self.call(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        """Читает все строки"""
+        return await self.call(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Записывает сразу в отдельной транзакции и возвращает число изменённых строк"""
+        def work(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.call(work)
+
+    def write(self, sql, params=()):
+        """Ставит запись в очередь; записи из очереди коммитятся вместе одной транзакцией"""
+        self.pending.append((sql, params))
+        if len(self.pending) >= DB_BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(DB_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """Отправляет записи из очереди в поток БД одним пакетом"""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return None
+        batch, self.pending = self.pending, []
+        future = loop.run_in_executor(self.executor, self._run, lambda conn: self._write_batch(conn, batch))
+        future.add_done_callback(self._report_batch)
+        return future
+
+    @staticmethod
+    def _write_batch(conn, batch):
+        """Коммитит пакет; подряд идущие одинаковые запросы выполняются через executemany"""
+        started = time.monotonic()
+        with conn:
+            for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                conn.executemany(sql, [params for _, params in group])
+        metrics.observe('bot_db_seconds', time.monotonic() - started, operation='write_batch')
+
+    @staticmethod
+    def _report_batch(future):
+        """Записывает в лог неудачный пакет отложенной записи"""
+        if not future.cancelled() and future.exception():
+            console_log(f"Ошибка записи в БД: {future.exception()}")
+
+    async def close(self):
+        """Коммитит записи из очереди и закрывает подключение"""
+        future = self.flush()
+        if future:
+            await asyncio.wait({future})
+        if self.conn is not None:
+            await loop.run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+
+db = Database(DB_PATH)
+
+async def purge_expired_rows(table, column, days):
+    """Удаляет строки старше срока хранения небольшими порциями и возвращает число удалённых"""
+    removed = 0
+    while True:
+        count = await db.execute(f'''
+            DELETE FROM {table} WHERE rowid IN (
+                SELECT rowid FROM {table} WHERE {column} < datetime('now', ?) LIMIT ?
+            )
+        ''', (f'-{days} days', DB_DELETE_CHUNK))
+        removed += count
+        if count < DB_DELETE_CHUNK:
+            return removed
+        await asyncio.sleep(DB_DELETE_PAUSE)
+
+async def maintain_database():
+    """Фоновая задача: применяет сроки хранения таблиц и возвращает освобождённые страницы ОС"""
+    while True:
+        try:
+            for table, days in DB_RETENTION_DAYS.items():
+                removed = await purge_expired_rows(table, DB_RETENTION_COLUMNS[table], days)
+                if removed:
+                    console_log(f"Очистка БД: {table} -{removed} строк")
+            await db.call(lambda conn: conn.execute(f'PRAGMA incremental_vacuum({DB_VACUUM_PAGES})').fetchall())
+            # Не даём файлу WAL расти между автоматическими контрольными точками
+            await db.call(lambda conn: conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"Ошибка обслуживания БД: {e}")
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+
 # ==========================================
 # УПРАВЛЕНИЕ ПОТОКАМИ ЗАГРУЗКИ
 # ==========================================
 
-async def can_start_download(user_id):
-    """Проверяет, может ли пользователь начать новую загрузку"""
+async def acquire_download_slot(user_id, status_msg):
+    """Ставит задачу в честную очередь и ждёт её хода, показывая позицию (если есть сообщение статуса)"""
+    ticket = {'user_id': user_id, 'download_id': str(uuid.uuid4()), 'future': loop.create_future()}
+    queued = time.monotonic()
     async with downloads_lock:
-        if user_id not in active_downloads:
-            active_downloads[user_id] = set()
-        if len(active_downloads[user_id]) >= MAX_CONCURRENT_DOWNLOADS:
-            return False
-        download_id = str(uuid.uuid4())
-        active_downloads[user_id].add(download_id)
-        return download_id
+        job_queues.setdefault(user_id, collections.deque()).append(ticket)
+        if user_id not in queue_order:
+            queue_order.append(user_id)
+        dispatch_downloads()
+    last_position = None
+    try:
+        while not ticket['future'].done():
+            position = get_queue_position(ticket)
+            if status_msg and position and position != last_position:
+                await status_msg.edit_text(f"**В очереди:** #{position}\nЗагрузка начнётся автоматически.")
+                last_position = position
+            await asyncio.wait({ticket['future']}, timeout=QUEUE_STATUS_INTERVAL)
+    except BaseException:
+        drop_ticket(ticket)
+        raise
+    metrics.observe('bot_queue_wait_seconds', time.monotonic() - queued)
+    if last_position:
+        await status_msg.edit_text("**Загрузка началась...**")
+    return ticket['download_id']
+
+def dispatch_downloads():
+    """Запускает ожидающие задачи, пока есть свободные места (по кругу между пользователями)"""
+    running = sum(len(ids) for ids in active_downloads.values())
+    skipped = 0
+    while queue_order and running < MAX_GLOBAL_DOWNLOADS and skipped < len(queue_order):
+        # Квота диска: пока работают другие задачи, новые ждут освобождения места
+        if running and not staging_has_room():
+            break
+        user_id = queue_order[0]
+        queue_order.rotate(-1)
+        # Пользователь уже использует свой личный лимит: ход переходит к следующему
+        if len(active_downloads.get(user_id, ())) >= MAX_CONCURRENT_DOWNLOADS:
+            skipped += 1
+            continue
+        ticket = job_queues[user_id].popleft()
+        if not job_queues[user_id]:
+            del job_queues[user_id]
+            queue_order.remove(user_id)
+        active_downloads.setdefault(user_id, set()).add(ticket['download_id'])
+        ticket['future'].set_result(True)
+        running += 1
+        skipped = 0
+
+def get_queue_position(ticket):
+    """Возвращает позицию задачи в очереди (1 = следующая на запуск)"""
+    queues = [job_queues[user_id] for user_id in queue_order]
+    position = 0
+    for depth in range(max(map(len, queues), default=0)):
+        for queue in queues:
+            if depth < len(queue):
+                position += 1
+                if queue[depth] is ticket:
+                    return position
+    return 0
+
+def queued_count(user_id):
+    """Количество задач пользователя, ожидающих в очереди"""
+    return len(job_queues.get(user_id, ()))
+
+def drop_ticket(ticket):
+    """Убирает отменённую задачу из очереди или освобождает её место"""
+    user_id = ticket['user_id']
+    if ticket['future'].done():
+        active_downloads.get(user_id, set()).discard(ticket['download_id'])
+        if not active_downloads.get(user_id, True):
+            del active_downloads[user_id]
+    elif ticket in job_queues.get(user_id, ()):
+        job_queues[user_id].remove(ticket)
+        if not job_queues[user_id]:
+            del job_queues[user_id]
+            queue_order.remove(user_id)
+    dispatch_downloads()
 
 async def finish_download(user_id, download_id):
     """Удаляет загрузку из списка активных по завершении"""
@@ -178,12 +828,233 @@ async def finish_download(user_id, download_id):
             active_downloads[user_id].remove(download_id)
             if not active_downloads[user_id]:
                 del active_downloads[user_id]
+        # Освободившееся место получает следующая задача в очереди
+        dispatch_downloads()
+
+class PipelineStage:
+    """Этап конвейера: свой лимит параллельности, ограниченная входная очередь и пул потоков"""
+
+    def __init__(self, name, limit, queue_size):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(limit)
+        # Места = выполняющиеся + ожидающие задачи; полная очередь держит задачу на предыдущем этапе (обратное давление)
+        self.seats = asyncio.Semaphore(limit + queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"stage_{name}")
+        self.waiting = self.active = self.completed = 0
+        self.busy_seconds = self.wait_seconds = 0.0
+
+    async def enter(self):
+        """Занимает место в очереди этапа"""
+        await self.seats.acquire()
+        self.waiting += 1
+
+    async def start(self):
+        """Ждёт в очереди свободного слота и возвращает время начала"""
+        queued = time.monotonic()
+        try:
+            await self.slots.acquire()
+        except BaseException:
+            self.waiting -= 1
+            self.seats.release()
+            raise
+        started = time.monotonic()
+        self.waiting -= 1
+        self.active += 1
+        self.wait_seconds += started - queued
+        metrics.observe('bot_stage_wait_seconds', started - queued, stage=self.name)
+        return started
+
+    def leave(self, started):
+        """Освобождает слот и место в очереди"""
+        self.active -= 1
+        self.completed += 1
+        self.busy_seconds += time.monotonic() - started
+        metrics.observe('bot_stage_seconds', time.monotonic() - started, stage=self.name)
+        self.slots.release()
+        self.seats.release()
+
+    async def run_in_thread(self, func, *args):
+        """Выполняет блокирующую работу в собственном пуле потоков этапа"""
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def stats(self):
+        """Загруженность этапа для мониторинга"""
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'completed': self.completed,
+            'busy_seconds': round(self.busy_seconds, 1),
+            'wait_seconds': round(self.wait_seconds, 1),
+        }
+
+pipeline_stages = {name: PipelineStage(name, limit, STAGE_QUEUE_SIZES[name]) for name, limit in STAGE_LIMITS.items()}
+
+async def advance_stage(job, stage_name):
+    """Переводит задачу на следующий этап; пока очередь того этапа полна, задача держит текущий слот"""
+    stage = pipeline_stages[stage_name]
+    await stage.enter()
+    leave_stage(job)
+    job['stage_started'] = await stage.start()
+    job['stage'] = stage_name
+    if job.get('journaled') and not job.get('cancelled'):
+        update_job_record(job['unique_id'], stage=stage_name)
+
+def leave_stage(job):
+    """Освобождает этап, который сейчас занимает задача"""
+    if job.get('stage'):
+        pipeline_stages[job.pop('stage')].leave(job['stage_started'])
+
+def get_pipeline_stats():
+    """Загруженность всех этапов конвейера"""
+    return {name: stage.stats() for name, stage in pipeline_stages.items()}
+
+# ==========================================
+# ОТОБРАЖЕНИЕ ПРОГРЕССА
+# ==========================================
+
+STAGE_TITLES = {
+    'download': "**Загрузка началась...**",
+    'postprocess': "**Обработка файла...**",
+    'upload': "**Отправка файла...**",
+}
+
+def format_size(size):
+    """Форматирует количество байт в читаемый вид"""
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_eta(seconds):
+    """Форматирует оставшиеся секунды как М:СС или Ч:ММ:СС"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class ProgressReporter:
+    """Собирает прогресс загрузки/отправки и правит сообщения о статусе с ограниченной частотой"""
+
+    def __init__(self, status_msgs):
+        self.status_msgs = list(status_msgs)
+        self.shown_text = {}
+        self.stage = 'download'
+        self.current = self.total = 0
+        self.speed = self.eta = None
+        self.stage_started = time.monotonic()
+        self.stage_stats = {}
+        self.next_edit = 0
+        self.pending = None
+        self.started = self.closed = False
+
+    def start(self):
+        """Начинает показывать прогресс (задача вышла из очереди)"""
+        self.started = True
+        self.set_stage('download')
+
+    def attach(self, status_msg):
+        """Добавляет ещё одно сообщение для обновления (присоединившийся запрос)"""
+        self.status_msgs.append(status_msg)
+        self.schedule()
+
+    def set_stage(self, stage):
+        """Переключает на следующий этап и записывает скорость предыдущего"""
+        self.record_stage()
+        self.stage = stage
+        self.current = self.total = 0
+        self.speed = self.eta = None
+        self.stage_started = time.monotonic()
+        self.schedule()
+
+    def update(self, current, total=None, speed=None, eta=None):
+        """Сохраняет новые значения прогресса; сообщение правится позже через schedule()"""
+        elapsed = time.monotonic() - self.stage_started
+        self.current = current or 0
+        self.total = total or self.total
+        self.speed = speed if speed is not None else (self.current / elapsed if elapsed > 0 else None)
+        if eta is None and self.speed and self.total:
+            eta = (self.total - self.current) / self.speed
+        self.eta = eta
+        self.schedule()
+
+    def ydl_hook(self, d):
+        """Хук прогресса yt-dlp (вызывается из потока загрузки)"""
+        if d.get('status') == 'downloading':
+            loop.call_soon_threadsafe(self.update, d.get('downloaded_bytes'), d.get('total_bytes') or d.get('total_bytes_estimate'), d.get('speed'), d.get('eta'))
+
+    def render(self):
+        """Собирает текст статуса для текущего этапа"""
+        text = STAGE_TITLES[self.stage]
+        if self.total:
+            text += f" {min(self.current / self.total, 1) * 100:.1f}%\n`{format_size(self.current)} / {format_size(self.total)}`"
+        elif self.current:
+            text += f"\n`{format_size(self.current)}`"
+        if self.speed:
+            text += f" · {format_size(self.speed)}/с"
+        if self.eta is not None and self.total:
+            text += f" · осталось {format_eta(self.eta)}"
+        return text
+
+    def schedule(self):
+        """Планирует правку сообщения не раньше, чем через PROGRESS_EDIT_INTERVAL после предыдущей"""
+        if not self.started or self.closed or self.pending:
+            return
+        delay = max(0, self.next_edit - time.monotonic())
+        self.pending = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """Правит каждое сообщение о статусе, текст которого изменился"""
+        text = self.render()
+        try:
+            for status_msg in list(self.status_msgs):
+                if self.closed:
+                    break
+                if self.shown_text.get(id(status_msg)) == text:
+                    continue
+                try:
+                    await status_msg.edit_text(text)
+                    self.shown_text[id(status_msg)] = text
+                except FloodWait as e:
+                    # Telegram просит притормозить: пропускаем правки на указанное время
+                    self.next_edit = time.monotonic() + e.value
+                    return
+                except Exception:
+                    pass
+            self.next_edit = time.monotonic() + PROGRESS_EDIT_INTERVAL
+        finally:
+            self.pending = None
+
+    def record_stage(self):
+        """Сохраняет байт/сек завершённого этапа"""
+        elapsed = time.monotonic() - self.stage_started
+        if self.current and elapsed > 0:
+            self.stage_stats[self.stage] = {'bytes': int(self.current), 'seconds': round(elapsed, 2), 'bytes_per_sec': int(self.current / elapsed)}
+            metrics.observe('bot_transfer_bytes_per_second', self.current / elapsed, stage=self.stage)
+            metrics.inc('bot_transfer_bytes_total', int(self.current), stage=self.stage)
+
+    def close(self):
+        """Прекращает дальнейшие правки; скорость задачи остается в stage_stats для журнала задач"""
+        self.record_stage()
+        self.closed = True
+        if self.pending:
+            self.pending.cancel()
+            self.pending = None
 
 # ==========================================
 # НАСТРОЙКИ YT-DLP (ЗАГРУЗЧИК)
 # ==========================================
 
-def get_ydl_options(format_type='video', unique_id=None, download=False):
+def video_format_spec(max_height):
+    """Строка формата yt-dlp для видео не выше max_height"""
+    # Без FFmpeg отдельные потоки видео и аудио не склеить
+    if FFMPEG_AVAILABLE:
+        return f'bestvideo[height<={max_height}]+bestaudio/best[height<={max_height}]/best'
+    return f'best[height<={max_height}]/best'
+
+def get_ydl_options(format_type='video', download=False):
     """Возвращает словарь с настройками для yt-dlp"""
     options = {
         'quiet': True,
@@ -201,67 +1072,1642 @@ def get_ydl_options(format_type='video', unique_id=None, download=False):
     }
     if not download:
         return options
+    # Склейку и конвертацию в MP3 выполняет этап постобработки, а не yt-dlp
     options.update({
         'extract_flat': False,
         'merge_output_format': 'mp4',
+        'noprogress': True,
+        # .part файлы прерванной задачи докачиваются, готовые файлы не скачиваются заново
+        'continuedl': True,
     })
     if format_type == 'video':
         options.update({
             'ignoreerrors': False,
-            'max_filesize': MAX_FILE_SIZE_BYTES,
-            'format': 'bestvideo[height<=1080]+bestaudio/best[height<=1080]/best',
-            'outtmpl': os.path.join(VIDEO_DIR, f'%(title)s_{unique_id}.%(ext)s') if unique_id else os.path.join(VIDEO_DIR, '%(title)s.%(ext)s')
+            'max_filesize': MAX_DOWNLOAD_SIZE_BYTES,
+            'format': video_format_spec(MAX_VIDEO_HEIGHT),
+            'outtmpl': get_output_template(VIDEO_DIR),
         })
     else:
-        # Настройки для аудио (извлечение MP3)
+        # Настройки для аудио (скачивается только аудиопоток)
         options.update({
             'ignoreerrors': False,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320'
-            }],
-            'outtmpl': os.path.join(AUDIO_DIR, f'%(title)s_{unique_id}.%(ext)s') if unique_id else os.path.join(AUDIO_DIR, '%(title)s.%(ext)s')
+            'max_filesize': MAX_DOWNLOAD_SIZE_BYTES,
+            'format': 'bestaudio/best',
+            'outtmpl': get_output_template(AUDIO_DIR),
         })
     return options
 
+def get_output_template(folder):
+    """Шаблон имени файла yt-dlp внутри папки (у задач свои папки)"""
+    return os.path.join(folder, '%(title)s.%(ext)s')
+
+def get_profile_options(profile):
+    """Настройки yt-dlp для профиля пула: 'metadata', 'video' или 'audio'"""
+    if profile != 'metadata':
+        return get_ydl_options(profile, download=True)
+    options = get_ydl_options()
+    options['ignoreerrors'] = False
+    # Элементы плейлиста только перечисляются; каждый извлекается, когда до него дойдёт очередь
+    options['extract_flat'] = 'in_playlist'
+    # Видео, открытое из плейлиста, скачивается как одиночное видео
+    options['noplaylist'] = True
+    return options
+
+class YdlPool:
+    """Долгоживущие экземпляры YoutubeDL по профилям: экстракторы, cookies и keep-alive соединения сохраняются между задачами"""
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        # Одно хранилище cookies для всех экземпляров (cookies.txt разбирается один раз)
+        self.cookiejar = None
+        self.created = self.reused = 0
+
+    def take(self, profile):
+        """Свободный экземпляр профиля или новый (блокирующая)"""
+        with self.lock:
+            if self.idle[profile]:
+                self.reused += 1
+                return self.idle[profile].pop()
+            self.created += 1
+        ydl = yt_dlp.YoutubeDL(get_profile_options(profile))
+        with self.lock:
+            if self.cookiejar is None:
+                self.cookiejar = ydl.cookiejar
+            else:
+                ydl.cookiejar = self.cookiejar
+        return ydl
+
+    def give_back(self, profile, ydl):
+        """Возвращает экземпляр в пул; лишние закрываются (блокирующая)"""
+        with self.lock:
+            if len(self.idle[profile]) < self.max_idle:
+                self.idle[profile].append(ydl)
+                return
+        ydl.close()
+
+    @contextlib.contextmanager
+    def checkout(self, profile, format_spec=None, progress_hooks=(), **params):
+        """Выдает экземпляр на одну задачу с ее форматом, хуками и параметрами поверх профиля (блокирующая)"""
+        ydl = self.take(profile)
+        saved = {key: ydl.params[key] for key in params if key in ydl.params}
+        saved_format = ydl.params.get('format'), ydl.format_selector
+        ydl.params.update(params)
+        if format_spec:
+            # Селектор формата компилируется при создании экземпляра
+            ydl.params['format'] = format_spec
+            ydl.format_selector = ydl.build_format_selector(format_spec)
+        for hook in progress_hooks:
+            ydl.add_progress_hook(hook)
+        try:
+            yield ydl
+        finally:
+            # Параметры, которых нет в профиле, удаляются, а не остаются равными None
+            for key in params:
+                ydl.params.pop(key, None)
+            ydl.params.update(saved)
+            ydl.params['format'], ydl.format_selector = saved_format
+            # Хуки принадлежат задаче; публичного способа убрать их в yt-dlp нет
+            ydl._progress_hooks.clear()
+            self.give_back(profile, ydl)
+
+    def close(self):
+        """Закрывает свободные экземпляры и сохраняет cookies (блокирующая)"""
+        with self.lock:
+            instances = [ydl for pool in self.idle.values() for ydl in pool]
+            self.idle.clear()
+        for ydl in instances:
+            ydl.close()
+
+    def stats(self):
+        """Использование пула для мониторинга"""
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused, 'idle': {profile: len(pool) for profile, pool in self.idle.items()}}
+
+ydl_pool = YdlPool(YDL_POOL_SIZE)
+
 # ==========================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ БАЗЫ
 # ==========================================
 
 async def save_user(user):
     """Сохраняет информацию о пользователе в БД"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    db.write('''
         INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, date_added)
         VALUES (?, ?, ?, ?, datetime('now'))
     ''', (user.id, user.username, user.first_name, user.last_name))
-    conn.commit()
-    conn.close()
+
+def make_url_token(url):
+    """Короткий токен ссылки для callback_data (urlsafe base64 от усечённого sha256)"""
+    digest = hashlib.sha256(url.encode()).digest()[:URL_TOKEN_BYTES]
+    return base64.urlsafe_b64encode(digest).decode()
+
+def remember_url(url_hash, url):
+    """Помещает токен в LRU в памяти"""
+    url_cache[url_hash] = url
+    url_cache.move_to_end(url_hash)
+    while len(url_cache) > URL_CACHE_MAX_ENTRIES:
+        url_cache.popitem(last=False)
 
 async def save_url_mapping(url):
     """Сохраняет ссылку и возвращает её хэш для кнопок"""
-    url_hash = hashlib.md5(url.encode()).hexdigest()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    url_hash = make_url_token(url)
+    remember_url(url_hash, url)
+    db.write('''
         INSERT OR REPLACE INTO url_mappings (url_hash, url, date_created)
         VALUES (?, ?, datetime('now'))
     ''', (url_hash, url))
-    conn.commit()
-    conn.close()
     return url_hash
 
 async def get_url_from_hash(url_hash):
     """Получает оригинальную ссылку по её хэшу"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT url FROM url_mappings WHERE url_hash = ?', (url_hash,))
-    result = cursor.fetchone()
-    conn.close()
+    url = url_cache.get(url_hash)
+    if url:
+        url_cache_stats['hits'] += 1
+        url_cache.move_to_end(url_hash)
+        return url
+    # Нет в памяти (вытеснен, перезапуск или старая кнопка с md5): читаем таблицу
+    url_cache_stats['misses'] += 1
+    result = await db.fetchone('SELECT url FROM url_mappings WHERE url_hash = ?', (url_hash,))
+    if result:
+        remember_url(url_hash, result[0])
+    return result[0] if result else None
+
+def build_callback_data(format_type, url_hash, quality=None):
+    """callback_data кнопки загрузки: dl_<формат>_<токен>[:<качество>] (не больше 64 байт)"""
+    data = f"dl_{format_type}_{url_hash}"
+    if quality:
+        data += f":{quality}"
+    return data
+
+# ==========================================
+# КЭШ ОТПРАВЛЕННЫХ ФАЙЛОВ (FILE_ID TELEGRAM)
+# ==========================================
+
+# Параметры ссылки, которые не влияют на медиа (трекинг, источники «поделиться»)
+TRACKING_PARAMS = {'si', 'feature', 'pp', 'fbclid', 'gclid', 'igshid', 'igsh', 'is_from_webapp', 'sender_device', 'share_source', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content'}
+
+def normalize_url(url):
+    """Приводит ссылку к каноничному виду, чтобы её варианты попадали в одну запись кэша"""
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parsed.path.rstrip('/') or '/'
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True) if k.lower() not in TRACKING_PARAMS]
+    # Короткие ссылки YouTube и Shorts ведут на то же видео, что и watch?v=
+    if host == 'youtu.be' and len(path) > 1:
+        host, path, query = 'youtube.com', '/watch', [('v', path[1:])] + query
+    elif host in ('youtube.com', 'music.youtube.com') and path.startswith('/shorts/'):
+        host, path, query = 'youtube.com', '/watch', [('v', path[len('/shorts/'):])] + query
+    return urllib.parse.urlunsplit(('https', host, path, urllib.parse.urlencode(sorted(query)), ''))
+
+def get_url_cache_key(url):
+    """Ключ кэша, известный до извлечения (нормализованная ссылка)"""
+    return f"url:{normalize_url(url)}"
+
+def get_cache_format(format_type, quality=None):
+    """Столбец формата в кэше: пониженное качество кэшируется отдельно от обычного"""
+    return f"{format_type}:{quality}" if quality else format_type
+
+def get_media_cache_key(info):
+    """Ключ кэша, известный после извлечения (экстрактор + id видео)"""
+    if not info or not info.get('id'):
+        return None
+    return f"{info.get('extractor_key') or info.get('extractor')}:{info['id']}"
+
+def get_sent_file_id(message):
+    """Возвращает file_id отправленного файла (Telegram может превратить видео в документ)"""
+    for media in (message.video, message.audio, message.document):
+        if media:
+            return media.file_id
+    return None
+
+async def get_cached_file_id(cache_key, format_type):
+    """Ищет file_id, уже отправленный для этого источника и формата"""
+    result = await db.fetchone('''
+        SELECT file_id FROM media_cache
+        WHERE cache_key = ? AND format_type = ? AND date_created > datetime('now', ?)
+    ''', (cache_key, format_type, f'-{MEDIA_CACHE_TTL_DAYS} days'))
+    media_cache_stats['hits' if result else 'misses'] += 1
+    if result:
+        # Обновляем время последнего обращения для вытеснения по LRU
+        db.write('UPDATE media_cache SET last_used = datetime(\'now\') WHERE file_id = ?', (result[0],))
     return result[0] if result else None
 
+async def save_cached_file_id(cache_keys, format_type, file_id):
+    """Сохраняет отправленный file_id под всеми ключами источника и вытесняет устаревшие записи"""
+    for cache_key in filter(None, cache_keys):
+        db.write('''
+            INSERT OR REPLACE INTO media_cache (cache_key, format_type, file_id, date_created, last_used)
+            VALUES (?, ?, ?, datetime('now'), datetime('now'))
+        ''', (cache_key, format_type, file_id))
+    # TTL: записи старше MEDIA_CACHE_TTL_DAYS
+    db.write('DELETE FROM media_cache WHERE date_created <= datetime(\'now\', ?)', (f'-{MEDIA_CACHE_TTL_DAYS} days',))
+    # LRU: храним не больше MEDIA_CACHE_MAX_ENTRIES строк
+    db.write('''
+        DELETE FROM media_cache WHERE rowid IN (
+            SELECT rowid FROM media_cache ORDER BY last_used ASC
+            LIMIT max(0, (SELECT COUNT(*) FROM media_cache) - ?)
+        )
+    ''', (MEDIA_CACHE_MAX_ENTRIES,))
+
+async def invalidate_cached_file_id(file_id):
+    """Удаляет file_id, который Telegram больше не принимает (под всеми его ключами)"""
+    db.write('DELETE FROM media_cache WHERE file_id = ?', (file_id,))
+
+def part_caption(url, index, count):
+    """Подпись отправленного файла, с номером, если файл разрезан на части"""
+    if count == 1:
+        return f"**Готово!**\n{url}"
+    return f"**Часть {index + 1}/{count}**\n{url}"
+
+async def send_cached_media(client, chat_id, url, format_type, file_id, delivered=None):
+    """Повторно отправляет кэшированный файл по file_id; удаляет его из кэша, только если Telegram его отклонил"""
+    part_ids = file_id.split(PART_SEPARATOR)
+    # Части, дошедшие до чата, запоминаются: повтор или запасная загрузка не отправят их второй раз
+    if delivered is None:
+        delivered = {}
+    if delivered.get('count') != len(part_ids):
+        delivered.update(count=len(part_ids), file_ids=[])
+    try:
+        for index in range(len(delivered['file_ids']), len(part_ids)):
+            while True:
+                try:
+                    # Отправляется как тип медиа из file_id: Telegram мог превратить видео в документ
+                    await client.send_cached_media(chat_id, part_ids[index], caption=part_caption(url, index, len(part_ids)))
+                    break
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+            delivered['file_ids'].append(part_ids[index])
+        return True
+    except (FileIdInvalid, MediaEmpty, FileReferenceExpired, FileReferenceInvalid, ValueError) as e:
+        # Telegram больше не принимает файл, или file_id не удается разобрать; другие ошибки
+        # (бот заблокирован, неверный чат...) ничего не говорят о файле, и он остается в кэше
+        console_log(f"Кэшированный file_id отклонён для {url}: {e}")
+        await invalidate_cached_file_id(file_id)
+        return False
+    except Exception as e:
+        # Ошибка сети, тайм-аут или ошибка со стороны чата: file_id остается в кэше, этот запрос скачивает файл
+        console_log(f"Кэшированный file_id не отправлен для {url}: {e}")
+        return False
+
+# ==========================================
+# ДВИЖОК ЗАГРУЗКИ (СОЕДИНЕНИЯ И ПОЛОСА)
+# ==========================================
+
+class HostLimiter:
+    """Ограничивает число одновременных соединений с каждым хостом на все задачи"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = collections.Counter()
+        self.waiters = {}
+
+    async def acquire(self, url, count=1):
+        """Ждёт, пока ещё count соединений с хостом ссылки влезут в лимит; возвращает резерв"""
+        host = urllib.parse.urlsplit(url).hostname or ''
+        count = min(count, self.limit)
+        while self.used[host] + count > self.limit:
+            waiter = loop.create_future()
+            self.waiters.setdefault(host, []).append(waiter)
+            await waiter
+        self.used[host] += count
+        return host, count
+
+    def release(self, reservation):
+        """Возвращает соединения хоста и будит задачи, которые его ждут"""
+        host, count = reservation
+        self.used[host] -= count
+        if self.used[host] <= 0:
+            del self.used[host]
+        for waiter in self.waiters.pop(host, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+class BandwidthBudget:
+    """Общий для всех задач лимит скорости загрузки (token bucket, потокобезопасный)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def reserve(self, size):
+        """Забирает size байт из бюджета и возвращает, сколько секунд ждать перед их использованием"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            # Неиспользованный бюджет копится не больше чем на секунду всплеска
+            self.next_free = max(self.next_free, now - 1) + size / self.rate
+            return max(0, self.next_free - now)
+
+host_limiter = HostLimiter(HOST_MAX_CONNECTIONS)
+bandwidth_budget = BandwidthBudget(DOWNLOAD_BANDWIDTH_LIMIT)
+
+def call_in_loop(coro):
+    """Выполняет корутину в цикле событий бота из рабочего потока и ждёт результат (блокирующая)"""
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def make_throttle_hook():
+    """Хук прогресса yt-dlp, удерживающий потоки загрузки в рамках общего бюджета полосы"""
+    downloaded = {}
+
+    def hook(d):
+        if d.get('status') != 'downloading':
+            return
+        current = d.get('downloaded_bytes') or 0
+        delta = current - downloaded.get(d.get('filename'), 0)
+        downloaded[d.get('filename')] = current
+        if delta > 0:
+            time.sleep(bandwidth_budget.reserve(delta))
+    return hook
+
+def is_fragmented(fmt):
+    """Формат скачивается фрагментами (HLS/DASH)"""
+    return fmt.get('protocol') in FRAGMENTED_PROTOCOLS or bool(fmt.get('fragments'))
+
+def is_rangeable(fmt):
+    """Прогрессивный HTTP-формат, достаточно большой, чтобы разбить его на параллельные запросы диапазонов"""
+    return fmt.get('protocol') in ('http', 'https') and bool(fmt.get('url')) and (fmt.get('filesize') or 0) >= DIRECT_SPLIT_MIN_SIZE
+
+async def download_media(job, info, format_type, progress):
+    """Этап загрузки: прямые ссылки через aiohttp, всё остальное через yt-dlp в пуле потоков этапа"""
+    if info.get('direct'):
+        return await download_direct(job, info, format_type, progress)
+    # Папка создается здесь, в цикле событий: поток загрузки не трогает staging_jobs и журнал
+    directory = get_job_dir(job, VIDEO_DIR if format_type == 'video' else AUDIO_DIR)
+    return await pipeline_stages['download'].run_in_thread(download_formats, job, info, format_type, progress.ydl_hook, directory)
+
+async def benchmark_download(url):
+    """Скачивает ссылку в каждом режиме движка и печатает скорость (python bot_ru.py --bench URL)"""
+    info = await get_media_info(url)
+    info = await pipeline_stages['resolve'].run_in_thread(select_formats, info, 'video')
+    for engine in ('single', 'segmented'):
+        job = {'unique_id': f'bench_{engine}', 'files': [], 'engine': engine}
+        started = time.monotonic()
+        try:
+            files = await download_media(job, info, 'video', ProgressReporter([]))
+            size = sum(os.path.getsize(path) for path in files)
+            elapsed = time.monotonic() - started
+            console_log(f"{engine}: {format_size(size)} за {elapsed:.2f} с ({format_size(size / elapsed)}/с)")
+        finally:
+            remove_job_dir(job)
+            staging_jobs.pop(job['unique_id'], None)
+
+# ==========================================
+# ПРЯМЫЕ ССЫЛКИ (AIOHTTP)
+# ==========================================
+
+def get_http_session():
+    """Общая сессия aiohttp (keep-alive соединения переиспользуются между задачами)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HOST_MAX_CONNECTIONS)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(sock_read=60))
+    return http_session
+
+async def close_http_session():
+    """Закрывает общую сессию aiohttp"""
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+async def probe_direct_media(url):
+    """Метаданные прямой ссылки на медиафайл по HEAD-запросу, None если ссылке нужен экстрактор"""
+    path = urllib.parse.urlsplit(url).path
+    name, ext = os.path.splitext(os.path.basename(path))
+    ext = ext.lstrip('.').lower()
+    if ext not in DIRECT_MEDIA_EXTENSIONS:
+        return None
+    try:
+        async with get_http_session().head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=DIRECT_PROBE_TIMEOUT)) as response:
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if response.status != 200 or not (content_type.startswith(('video/', 'audio/')) or content_type == 'application/octet-stream'):
+                return None
+            final_url = str(response.url)
+            return {
+                'direct': True,
+                'url': final_url,
+                'id': make_url_token(final_url),
+                'extractor_key': 'Direct',
+                'title': urllib.parse.unquote(name) or 'media',
+                'ext': ext,
+                'vcodec': 'none' if ext in DIRECT_AUDIO_EXTENSIONS else None,
+                'filesize': response.content_length,
+                'accept_ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+            }
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+async def fetch_range(url, path, start, end, on_chunk, headers=None):
+    """Потоково записывает байты start..end (или весь файл) на их место в файле"""
+    headers = dict(headers or {})
+    if start is not None:
+        headers['Range'] = f'bytes={start}-{end}'
+    reservation = await host_limiter.acquire(url)
+    try:
+        async with get_http_session().get(url, headers=headers) as response:
+            response.raise_for_status()
+            if start is not None and response.status != 206:
+                raise RuntimeError("Сервер проигнорировал запрос диапазона")
+            # Запись на диск идет в потоках стадии загрузки, чтобы медленный диск не останавливал цикл событий
+            stage = pipeline_stages['download']
+            f = await stage.run_in_thread(open_range_file, path, start)
+            try:
+                async for chunk in response.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                    await stage.run_in_thread(f.write, chunk)
+                    on_chunk(len(chunk))
+                    delay = bandwidth_budget.reserve(len(chunk))
+                    if delay:
+                        await asyncio.sleep(delay)
+            finally:
+                await stage.run_in_thread(f.close)
+    finally:
+        host_limiter.release(reservation)
+
+def open_range_file(path, start):
+    """Открывает файл для записи с начала диапазона, новый файл для загрузки без диапазонов (блокирующая)"""
+    if start is None:
+        return open(path, 'wb')
+    f = open(path, 'r+b')
+    f.seek(start)
+    return f
+
+def allocate_file(path, size):
+    """Создает файл полного размера, чтобы диапазоны записывались в любом порядке (блокирующая)"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+async def download_ranges(url, path, size, connections, on_chunk, headers=None):
+    """Скачивает файл не более чем `connections` параллельными запросами диапазонов (одним, если размер неизвестен или мал)"""
+    if not size or connections < 2 or size < DIRECT_SPLIT_MIN_SIZE:
+        await fetch_range(url, path, None, None, on_chunk, headers)
+        return
+    await pipeline_stages['download'].run_in_thread(allocate_file, path, size)
+    part = -(-size // connections)
+    tasks = [asyncio.ensure_future(fetch_range(url, path, start, min(start + part, size) - 1, on_chunk, headers)) for start in range(0, size, part)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Один диапазон упал: останавливаем остальные, чтобы никто не продолжал писать в файл
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def download_direct(job, info, format_type, progress):
+    """Скачивает прямую ссылку параллельными диапазонами байт, если сервер их поддерживает"""
+    directory = get_job_dir(job, VIDEO_DIR if format_type == 'video' else AUDIO_DIR)
+    path = job['target'] = os.path.join(directory, f"{yt_dlp.utils.sanitize_filename(info['title'])}.{info['ext']}")
+    job['files'].append(path)
+    size = info.get('filesize')
+    received = 0
+
+    def on_chunk(count):
+        nonlocal received
+        received += count
+        # Без Content-Length лимит можно проверить только во время загрузки
+        if received > MAX_DOWNLOAD_SIZE_BYTES:
+            raise ValueError(f"Файл слишком большой (лимит {MAX_DOWNLOAD_SIZE_MB} МБ)")
+        progress.update(received, size)
+
+    # Скачан до перезапуска
+    if os.path.exists(path):
+        return [path]
+    connections = DIRECT_CONNECTIONS if job['engine'] == 'segmented' and info.get('accept_ranges') else 1
+    # Файл получает свое имя только целиком: существующий файл всегда готов
+    await download_ranges(info['url'], path + '.ranges', size, connections, on_chunk)
+    os.replace(path + '.ranges', path)
+    return [path]
+
+# ==========================================
+# ДВИЖОК ОТПРАВКИ (ПАРАЛЛЕЛЬНЫЕ МЕДИА-СЕССИИ)
+# ==========================================
+
+class UploadEngine:
+    """Отправляет файлы в Telegram частями сразу по нескольким медиа-сессиям, повторяя неудачные части"""
+
+    def __init__(self, connections, requests_per_connection):
+        self.connections = connections
+        self.parallel = connections * requests_per_connection
+        # Частей в полете по всем отправкам
+        self.slots = asyncio.Semaphore(self.parallel)
+        self.sessions = collections.defaultdict(list)
+        self.session_lock = asyncio.Lock()
+        self.next_session = 0
+        self.uploads = self.parts = self.retries = self.bytes = 0
+        self.busy_seconds = 0.0
+        self.busy_since = None
+
+    async def get_session(self, client):
+        """Медиа-сессия для следующей части: по кругу среди сессий, открытых при первом использовании"""
+        async with self.session_lock:
+            sessions = self.sessions[client]
+            if len(sessions) < self.connections:
+                session = Session(client, await client.storage.dc_id(), await client.storage.auth_key(), await client.storage.test_mode(), is_media=True)
+                await session.start()
+                sessions.append(session)
+                return session
+            self.next_session = (self.next_session + 1) % len(sessions)
+            return sessions[self.next_session]
+
+    async def send_part(self, client, mapped, file_id, index, total_parts, is_big):
+        """Отправляет одну часть, при ошибке повторяя только ее"""
+        async with self.slots:
+            # Чтение из кэша страниц только когда часть вот-вот отправится
+            chunk = mapped[index * UPLOAD_PART_SIZE:(index + 1) * UPLOAD_PART_SIZE]
+            if is_big:
+                rpc = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=chunk)
+            else:
+                rpc = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=chunk)
+            attempt = 0
+            while True:
+                try:
+                    await (await self.get_session(client)).invoke(rpc)
+                    break
+                except FloodWait as e:
+                    # Telegram попросил замедлиться: часть не провалилась, попытка не засчитывается
+                    await asyncio.sleep(e.value)
+                except (OSError, asyncio.TimeoutError, RPCError) as e:
+                    attempt += 1
+                    if attempt == UPLOAD_PART_RETRIES:
+                        raise
+                    self.retries += 1
+                    logging.info(f"Ошибка отправки части {index}, повтор: {e}")
+                    await asyncio.sleep(UPLOAD_RETRY_DELAY * attempt)
+        self.parts += 1
+        self.bytes += len(chunk)
+        return len(chunk)
+
+    async def save_file(self, client, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """Отправляет файл и возвращает его InputFile; с file_id только досылает часть, которую Telegram не получил"""
+        size = os.path.getsize(path)
+        if size == 0:
+            raise ValueError("Размер файла равен 0 Б")
+        total_parts = -(-size // UPLOAD_PART_SIZE)
+        is_big = size > UPLOAD_BIG_FILE_SIZE
+        # Части читаются по своим смещениям параллельными обработчиками: без общей позиции в файле и буферов упреждающего чтения
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if file_id is not None:
+                await self.send_part(client, mapped, file_id, file_part, total_parts, is_big)
+                return None
+            file_id = client.rnd_id()
+            await self.send_parts(client, mapped, file_id, total_parts, is_big, size, progress, progress_args)
+        if is_big:
+            return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(path))
+        # Контрольная сумма необязательна: без нее Telegram пропускает проверку
+        return raw.types.InputFile(id=file_id, parts=total_parts, name=os.path.basename(path), md5_checksum='')
+
+    async def send_parts(self, client, mapped, file_id, total_parts, is_big, size, progress, progress_args):
+        """Отправляет все части файла одновременно, сообщая подтвержденные байты"""
+        parts = iter(range(total_parts))
+        uploaded = 0
+
+        async def worker():
+            nonlocal uploaded
+            for index in parts:
+                sent = await self.send_part(client, mapped, file_id, index, total_parts, is_big)
+                uploaded += sent
+                if progress:
+                    await progress(uploaded, size, *progress_args)
+
+        if not self.uploads:
+            self.busy_since = time.monotonic()
+        self.uploads += 1
+        started = time.monotonic()
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.parallel, total_parts))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Одна часть не отправилась окончательно: останавливаем остальные
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            self.uploads -= 1
+            if not self.uploads:
+                self.busy_seconds += time.monotonic() - self.busy_since
+        elapsed = time.monotonic() - started
+        metrics.observe('bot_upload_seconds', elapsed)
+        logging.info(f"Отправлено {format_size(size)} за {elapsed:.2f} с ({format_size(size / elapsed)}/с)")
+
+    async def close(self):
+        """Закрывает медиа-сессии"""
+        for sessions in self.sessions.values():
+            for session in sessions:
+                await session.stop()
+        self.sessions.clear()
+
+    def stats(self):
+        """Итоги отправки и скорость за время, пока что-то отправлялось, для подбора числа соединений"""
+        busy = self.busy_seconds + (time.monotonic() - self.busy_since if self.uploads else 0)
+        return {
+            'connections': sum(map(len, self.sessions.values())),
+            'active_uploads': self.uploads,
+            'parts': self.parts,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'bytes_per_sec': int(self.bytes / busy) if busy > 0 else None,
+        }
+
+upload_engine = UploadEngine(UPLOAD_CONNECTIONS, UPLOAD_REQUESTS_PER_CONNECTION)
+
+# ==========================================
+# ПЛАНИРОВЩИК ФОРМАТОВ
+# ==========================================
+
+def format_filesize(fmt, duration):
+    """Известный или оценённый (битрейт x длительность) размер одного формата в байтах, None если неизвестен"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+def list_format_candidates(info, format_type, max_height):
+    """Одиночные форматы и пары видео+аудио с известным размером, которые можно скачать"""
+    duration = info.get('duration')
+    formats = [fmt for fmt in info.get('formats') or [] if format_filesize(fmt, duration)]
+    audios = [fmt for fmt in formats if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    candidates = []
+    if format_type == 'audio':
+        for fmt in audios:
+            candidates.append({
+                'spec': fmt['format_id'], 'size': format_filesize(fmt, duration), 'height': 0,
+                'native': codec_family(fmt.get('acodec')) in MP4_AUDIO_CODECS, 'single': True,
+                'tbr': fmt.get('abr') or fmt.get('tbr') or 0,
+            })
+        return candidates
+    for fmt in formats:
+        if fmt.get('vcodec') == 'none' or not fmt.get('height') or fmt['height'] > max_height:
+            continue
+        size = format_filesize(fmt, duration)
+        native_video = codec_family(fmt.get('vcodec')) in MP4_VIDEO_CODECS | {None}
+        if fmt.get('acodec') != 'none':
+            # Видео со звуком в одном файле: склейка не нужна
+            candidates.append({
+                'spec': fmt['format_id'], 'size': size, 'height': fmt['height'],
+                'native': native_video and codec_family(fmt.get('acodec')) in MP4_AUDIO_CODECS | {None}, 'single': True,
+                'tbr': fmt.get('tbr') or 0,
+            })
+        elif FFMPEG_AVAILABLE:
+            for audio in audios:
+                candidates.append({
+                    'spec': f"{fmt['format_id']}+{audio['format_id']}", 'size': size + format_filesize(audio, duration), 'height': fmt['height'],
+                    'native': native_video and codec_family(audio.get('acodec')) in MP4_AUDIO_CODECS, 'single': False,
+                    'tbr': (fmt.get('tbr') or 0) + (audio.get('abr') or audio.get('tbr') or 0),
+                })
+    return candidates
+
+def plan_format(info, format_type, max_height=MAX_VIDEO_HEIGHT, size_limit=PLAN_SIZE_LIMIT_BYTES):
+    """Формат yt-dlp лучшего варианта, который влезает в лимит; None, если размеры неизвестны или ничего не влезает"""
+    # Лучшее качество делится на части, а не понижается; пониженные качества одним файлом предлагаются кнопками
+    fitting = [c for c in list_format_candidates(info, format_type, max_height) if c['size'] <= size_limit]
+    if not fitting:
+        return None
+    # Сначала разрешение, затем отсутствие перекодирования, затем отсутствие склейки, затем битрейт
+    return max(fitting, key=lambda c: (c['height'], c['native'], c['single'], c['tbr']))['spec']
+
+# ==========================================
+# ПРЕДЗАГРУЗКА МЕТАДАННЫХ
+# ==========================================
+
+def extract_metadata(url):
+    """Извлекает метаданные ссылки с полным списком форматов, без скачивания (блокирующая)"""
+    with ydl_pool.checkout('metadata') as ydl:
+        return ydl.extract_info(url, download=False)
+
+def is_batch(info):
+    """Ссылка ведёт на несколько элементов (плейлист, альбом, карусель)"""
+    return bool(info) and info.get('_type') in ('playlist', 'multi_video')
+
+# Поля метаданных, которые clear_format_selection оставляет, даже если они есть и у формата
+SELECTION_KEPT_FIELDS = ('id', 'title', 'duration', 'thumbnail', 'thumbnails', 'formats', 'webpage_url', 'original_url', 'http_headers')
+
+def select_formats(info, format_type, quality=None, size_limit=PLAN_SIZE_LIMIT_BYTES):
+    """Выбирает форматы для типа загрузки из уже извлечённых метаданных (блокирующая, без сети)"""
+    if info.get('direct'):
+        # У прямой ссылки один формат: сам файл
+        return info
+    # Без известных размеров решает обычная строка формата
+    spec = plan_format(info, format_type, quality or MAX_VIDEO_HEIGHT, size_limit)
+    if not spec and quality:
+        spec = video_format_spec(quality)
+    with ydl_pool.checkout(format_type, spec) as ydl:
+        return ydl.process_ie_result(clear_format_selection(info), download=False)
+
+def clear_format_selection(info):
+    """Копия метаданных без полей форматов, выбранных прошлым проходом (проход метаданных тоже выбирает)"""
+    # Выбранный сейчас одиночный формат сохранил бы устаревшую пару requested_formats и ее размер, кодеки и высоту
+    picked = info.get('requested_formats') or [fmt for fmt in info.get('formats') or [] if fmt.get('format_id') == info.get('format_id')]
+    stale = {key for fmt in picked for key in fmt} | {'requested_formats', 'requested_downloads', 'format', 'format_id', 'filesize_approx'}
+    return copy.deepcopy({key: value for key, value in info.items() if key not in stale or key in SELECTION_KEPT_FIELDS})
+
+def estimate_filesize(info):
+    """Примерный размер выбранных форматов в байтах, None если неизвестен"""
+    total = 0
+    for fmt in info.get('requested_formats') or [info]:
+        size = format_filesize(fmt, info.get('duration'))
+        if not size:
+            return None
+        total += size
+    return int(total)
+
+def list_lower_qualities(info):
+    """Пониженные качества видео, которые предлагаются, если лучшее не влезает: [(высота, размер)] (блокирующая)"""
+    heights = [fmt['height'] for fmt in info.get('formats') or [] if fmt.get('height') and fmt.get('vcodec') != 'none' and fmt['height'] <= MAX_VIDEO_HEIGHT]
+    if not heights:
+        return []
+    planned = select_formats(info, 'video')
+    size = estimate_filesize(planned)
+    if not size or (size <= MAX_FILE_SIZE_BYTES and planned.get('height') == max(heights)):
+        return []
+    # Всё ниже выбранного качества, или ниже лучшего, если не влезает даже выбранное
+    top = planned.get('height') if size <= MAX_FILE_SIZE_BYTES else max(heights) + 1
+    qualities = []
+    for height in QUALITY_STEPS:
+        if not top or height >= top:
+            continue
+        selected = select_formats(info, 'video', height, PLAN_FILE_SIZE_BYTES)
+        size = estimate_filesize(selected)
+        if selected.get('height') and size and size <= MAX_FILE_SIZE_BYTES and selected['height'] not in dict(qualities):
+            qualities.append((selected['height'], size))
+    return qualities
+
+async def get_media_info(url):
+    """Возвращает метаданные ссылки из кэша или извлекает их (одно извлечение на ссылку одновременно)"""
+    key = normalize_url(url)
+    entry = metadata_cache.get(key)
+    if entry and entry['expires'] > time.monotonic():
+        metadata_cache.move_to_end(key)
+        metadata_cache_stats['hits'] += 1
+        return entry['info']
+    metadata_cache_stats['misses'] += 1
+    if key not in metadata_fetches:
+        metadata_fetches[key] = asyncio.ensure_future(fetch_metadata(key, url))
+    return await asyncio.shield(metadata_fetches[key])
+
+async def fetch_metadata(key, url):
+    """Извлекает метаданные в пуле потоков этапа resolve и кэширует их"""
+    started = time.monotonic()
+    try:
+        # Прямые ссылки на файлы обходят экстракторы yt-dlp
+        info = await probe_direct_media(url)
+        if not info:
+            info = await pipeline_stages['resolve'].run_in_thread(extract_metadata, url)
+    finally:
+        del metadata_fetches[key]
+        metrics.observe('bot_extract_seconds', time.monotonic() - started)
+    if info:
+        metadata_cache[key] = {'expires': time.monotonic() + METADATA_CACHE_TTL, 'info': info, 'sizes': {}}
+        while len(metadata_cache) > METADATA_CACHE_MAX_ENTRIES:
+            metadata_cache.popitem(last=False)
+    return info
+
+async def get_estimated_size(url, format_type, quality=None):
+    """Примерный размер файла для формата только по заранее загруженным метаданным (None, если их нет)"""
+    entry = metadata_cache.get(normalize_url(url))
+    if not entry or entry['expires'] <= time.monotonic() or is_batch(entry['info']):
+        return None
+    if (format_type, quality) not in entry['sizes']:
+        selected = await pipeline_stages['resolve'].run_in_thread(select_formats, entry['info'], format_type, quality)
+        entry['sizes'][(format_type, quality)] = estimate_filesize(selected)
+    return entry['sizes'][(format_type, quality)]
+
+async def get_lower_qualities(url):
+    """Пониженные качества видео, которые влезают в лимит, только из заранее загруженных метаданных"""
+    entry = metadata_cache.get(normalize_url(url))
+    if not entry or entry['expires'] <= time.monotonic():
+        return []
+    if 'qualities' not in entry:
+        entry['qualities'] = await pipeline_stages['resolve'].run_in_thread(list_lower_qualities, entry['info'])
+    return entry['qualities']
+
+def build_format_keyboard(url_hash, sizes=None, qualities=(), audio_only=False):
+    """Кнопки выбора формата, с примерными размерами, если они известны"""
+    sizes = sizes or {}
+    buttons = []
+    for format_type, label in (('video', "🎬 Видео"), ('audio', "🎵 Аудио")):
+        if audio_only and format_type == 'video':
+            continue
+        size = sizes.get(format_type)
+        if size and size > MAX_DOWNLOAD_SIZE_BYTES:
+            label += " (слишком большой)"
+        elif size and size > MAX_FILE_SIZE_BYTES:
+            label += f" ~{format_size(size)}, {-(-size // SPLIT_PART_SIZE_BYTES)} частей"
+        elif size:
+            label += f" ~{format_size(size)}"
+        buttons.append(InlineKeyboardButton(label, callback_data=build_callback_data(format_type, url_hash)))
+    rows = [buttons]
+    if qualities:
+        rows.append([InlineKeyboardButton(f"🎬 {height}p ~{format_size(size)}", callback_data=build_callback_data('video', url_hash, height)) for height, size in qualities])
+    return InlineKeyboardMarkup(rows)
+
+async def describe_link(reply, url, url_hash):
+    """Заранее загружает метаданные ссылки и показывает название, длительность и размеры в сообщении выбора формата"""
+    try:
+        # Ссылки Spotify spotDL разбирает только при запуске загрузки
+        if is_spotify_url(url):
+            return
+        info = await get_media_info(url)
+        if not info:
+            return
+        if is_batch(info):
+            count = len(info.get('entries') or [])
+            text = f"📃 {info.get('title') or url}\nЭлементов: {count}"
+            if count > BATCH_MAX_ITEMS:
+                text += f" (будут скачаны первые {BATCH_MAX_ITEMS})"
+            await reply.edit_text(text + "\n\nВыберите формат загрузки:", reply_markup=build_format_keyboard(url_hash), parse_mode=ParseMode.DISABLED)
+            return
+        sizes = {format_type: await get_estimated_size(url, format_type) for format_type in ('video', 'audio')}
+        qualities = await get_lower_qualities(url)
+        text = f"🎞 {info.get('title') or url}"
+        if info.get('duration'):
+            text += f"\n⏱ {format_eta(info['duration'])}"
+        await reply.edit_text(text + "\n\nВыберите формат загрузки:", reply_markup=build_format_keyboard(url_hash, sizes, qualities), parse_mode=ParseMode.DISABLED)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        console_log(f"Не удалось загрузить метаданные для {url}: {e}")
+    finally:
+        describe_tasks.pop((reply.chat.id, reply.id), None)
+
+# ==========================================
+# ДВИЖОК ИНЛАЙН-ЗАПРОСОВ
+# ==========================================
+
+def build_inline_results(url, url_hash, info=None):
+    """Инлайн-результаты для ссылки с названием, длительностью и превью, если метаданные известны"""
+    description = None
+    if info:
+        description = info.get('title') or url
+        if info.get('duration'):
+            description += f" ({format_eta(info['duration'])})"
+    results = []
+    for format_type, title, text, button in (
+        ('video', "Скачать Видео", "🎬 Downloading video", "🎬 Скачать"),
+        ('audio', "Скачать Аудио", "🎵 Downloading audio", "🎵 Скачать"),
+    ):
+        results.append(InlineQueryResultArticle(
+            id=f"{format_type}_{url_hash}",
+            title=title,
+            description=description,
+            thumb_url=(info or {}).get('thumbnail'),
+            input_message_content=InputTextMessageContent(f"{text}:\n{url}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(button, callback_data=build_callback_data(format_type, url_hash))]])
+        ))
+    return results
+
+async def answer_inline_query(inline_query, url):
+    """Отвечает на инлайн-запрос из кэша результатов или после того, как пользователь перестал печатать"""
+    key = normalize_url(url)
+    entry = inline_results.get(key)
+    if entry and entry['expires'] > time.monotonic():
+        inline_results.move_to_end(key)
+        await inline_query.answer(entry['results'], cache_time=INLINE_CACHE_TIME)
+        return
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    console_log(f"INLINE: {url} (ID: {inline_query.from_user.id})")
+    url_hash = await save_url_mapping(url)
+    # Метаданные продолжают загружаться после таймаута и будут готовы к следующему запросу или нажатию кнопки
+    fetch = asyncio.ensure_future(get_media_info(url))
+    fetch.add_done_callback(lambda f: f.cancelled() or f.exception())
+    await asyncio.wait({fetch}, timeout=INLINE_METADATA_WAIT)
+    info = fetch.result() if fetch.done() and not fetch.cancelled() and not fetch.exception() else None
+    if is_batch(info):
+        info = None
+    results = build_inline_results(url, url_hash, info)
+    if info:
+        inline_results[key] = {'expires': time.monotonic() + INLINE_RESULTS_TTL, 'results': results}
+        while len(inline_results) > INLINE_RESULTS_MAX_ENTRIES:
+            inline_results.popitem(last=False)
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME if info else INLINE_CACHE_TIME_PARTIAL)
+
+def finish_inline_task(user_id, task):
+    """Забывает завершённый инлайн-ответ и пишет в лог его ошибку"""
+    if inline_tasks.get(user_id) is task:
+        del inline_tasks[user_id]
+    if not task.cancelled() and task.exception():
+        console_log(f"Ошибка инлайн-запроса: {task.exception()}")
+
+# ==========================================
+# КЭШ ИСТОЧНИКОВ (АУДИО ИЗ СКАЧАННЫХ МЕДИА)
+# ==========================================
+
+def clear_source_cache():
+    """Удаляет источники, оставшиеся от прошлого запуска: индекс хранится только в памяти (подпапки воркеров принадлежат им)"""
+    for entry in os.scandir(SOURCE_CACHE_DIR):
+        if entry.is_file():
+            os.remove(entry.path)
+
+def acquire_source(media_key):
+    """Файл из кэша со звуковой дорожкой медиа, защищенный от вытеснения на время использования; None, если его нет"""
+    entry = source_cache.get(media_key) if media_key else None
+    if not entry or not os.path.exists(entry['path']):
+        source_cache_stats['misses'] += 1
+        return None
+    source_cache_stats['hits'] += 1
+    source_cache.move_to_end(media_key)
+    entry['users'] += 1
+    return entry
+
+def release_source(entry):
+    """Завершает использование источника из кэша"""
+    entry['users'] -= 1
+
+def evict_sources():
+    """Убирает давно не использованные источники сверх SOURCE_CACHE_MAX_BYTES и возвращает их пути"""
+    paths = []
+    for media_key in list(source_cache):
+        if source_cache_stats['bytes'] <= SOURCE_CACHE_MAX_BYTES:
+            break
+        entry = source_cache[media_key]
+        if entry['users']:
+            continue
+        del source_cache[media_key]
+        source_cache_stats['bytes'] -= entry['size']
+        paths.append(entry['path'])
+    return paths
+
+async def keep_source(job, media_key):
+    """Переносит скачанный задачей поток со звуковой дорожкой в кэш источников"""
+    if not FFMPEG_AVAILABLE or not media_key or not job.get('download_source') or media_key in source_cache:
+        return
+    path, fmt = job['download_source']
+    if not os.path.exists(path) or os.path.getsize(path) > SOURCE_CACHE_MAX_FILE_BYTES:
+        return
+    # Экстрактор не сообщил аудиокодек: проверяется, есть ли звуковая дорожка вообще
+    if not fmt['acodec'] and not (await pipeline_stages['probe'].run_in_thread(probe_media, path))['audio']:
+        return
+    if media_key in source_cache or not os.path.exists(path):
+        return
+    size = os.path.getsize(path)
+    cache_path = os.path.join(SOURCE_CACHE_DIR, hashlib.sha256(media_key.encode()).hexdigest()[:32] + os.path.splitext(path)[1])
+    # Переименование на том же диске, копирование из tmpfs
+    await pipeline_stages['cleanup'].run_in_thread(shutil.move, path, cache_path)
+    if media_key in source_cache:
+        # Другая задача тем временем сохранила то же медиа (по тому же пути)
+        return
+    source_cache[media_key] = {'path': cache_path, 'size': size, 'format': fmt, 'users': 0}
+    source_cache_stats['bytes'] += size
+    await pipeline_stages['cleanup'].run_in_thread(remove_files, evict_sources())
+
+# ==========================================
+# РАБОЧИЕ ПАПКИ (НА ДИСКЕ И В TMPFS)
+# ==========================================
+
+def folder_size(path):
+    """Размер всего содержимого папки (блокирующая)"""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def staging_has_room():
+    """Квота диска, проверяемая перед допуском задачи: занятые байты ниже квоты и свободного места достаточно"""
+    free = staging_usage['free']
+    return staging_usage['bytes'] < STAGING_QUOTA_BYTES and (free is None or free > STAGING_MIN_FREE_BYTES)
+
+def tmpfs_has_room(size):
+    """Задача помещается в RAM: небольшой файл, есть место в квоте tmpfs и в самом tmpfs"""
+    if not STAGING_TMPFS_DIR or not size or size > STAGING_TMPFS_MAX_FILE_BYTES:
+        return False
+    reserved = sum(job.get('tmpfs_bytes', 0) for job in staging_jobs.values())
+    return reserved + size <= STAGING_TMPFS_MAX_BYTES and shutil.disk_usage(STAGING_TMPFS_DIR).free > size
+
+def get_job_dir(job, disk_root):
+    """Рабочая папка задачи, создается при первом использовании: в tmpfs для небольших файлов, иначе на диске"""
+    if 'dir' not in job:
+        # При слиянии и конвертации источник и результат хранятся одновременно
+        size = 2 * job['size_hint'] if job.get('size_hint') else None
+        if tmpfs_has_room(size):
+            job['tmpfs_bytes'] = size
+            job['dir'] = os.path.join(STAGING_TMPFS_DIR, job['unique_id'])
+        else:
+            job['dir'] = os.path.join(disk_root, job['unique_id'])
+        os.makedirs(job['dir'], exist_ok=True)
+        staging_jobs[job['unique_id']] = job
+        if job.get('journaled'):
+            update_job_record(job['unique_id'], job_dir=job['dir'])
+    return job['dir']
+
+def adopt_job_dir(job, path):
+    """Забирает папку задачи, прерванной перезапуском, вместе с недокачанными файлами"""
+    job['dir'] = path
+    if STAGING_TMPFS_DIR and path.startswith(STAGING_TMPFS_DIR):
+        # Размер еще неизвестен: резервируем максимум для задачи в tmpfs
+        job['tmpfs_bytes'] = STAGING_TMPFS_MAX_FILE_BYTES
+    staging_jobs[job['unique_id']] = job
+
+def remove_job_dir(job):
+    """Удаляет папку задачи со всем, что в ней осталось: .part, .ytdl, промежуточные файлы слияния (блокирующая)"""
+    if job.get('dir'):
+        shutil.rmtree(job['dir'], ignore_errors=True)
+
+def use_worker_folders(worker_name):
+    """Переносит рабочие папки и источники этого процесса в его собственные подпапки: каждый процесс на хосте убирает только свои файлы"""
+    global VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR, STAGING_TMPFS_DIR
+    folder = WORKER_DIR_PREFIX + worker_name
+    VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR = (os.path.join(root, folder, '') for root in (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR))
+    if STAGING_TMPFS_DIR:
+        STAGING_TMPFS_DIR = os.path.join(STAGING_TMPFS_DIR, folder, '')
+    for root in filter(None, (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, SOURCE_CACHE_DIR, STAGING_TMPFS_DIR)):
+        os.makedirs(root, exist_ok=True)
+
+def sweep_staging(active_ids):
+    """Удаляет папки и отдельные файлы старше STAGING_ORPHAN_AGE, которые не принадлежат работающим задачам (блокирующая)"""
+    removed = 0
+    for root in filter(None, (VIDEO_DIR, AUDIO_DIR, SPOTIFY_DIR, STAGING_TMPFS_DIR)):
+        for entry in os.scandir(root):
+            try:
+                # Подпапки воркеров очищают сами воркеры
+                if entry.name in active_ids or entry.name.startswith(WORKER_DIR_PREFIX) or time.time() - entry.stat().st_mtime < STAGING_ORPHAN_AGE:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+def measure_staging(paths):
+    """Байты в указанных рабочих папках и свободное место на диске (блокирующая)"""
+    return sum(map(folder_size, paths)), shutil.disk_usage(VIDEO_DIR).free
+
+async def maintain_staging():
+    """Фоновая задача: замеряет занятое место для дисковой квоты и удаляет брошенные файлы после сбоев и отмененных задач (первая очистка сразу при запуске)"""
+    last_sweep = None
+    while True:
+        try:
+            if last_sweep is None or time.monotonic() - last_sweep >= STAGING_SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                # Папки задач из журнала ждут возобновления
+                journaled = {row[0] for row in await db.fetchall('SELECT job_id FROM jobs')}
+                removed = await pipeline_stages['cleanup'].run_in_thread(sweep_staging, set(staging_jobs) | journaled)
+                if removed:
+                    console_log(f"Очистка рабочих папок: удалено {removed}")
+            # Обход папок идет в потоке: список папок берется здесь, в цикле событий
+            paths = [job['dir'] for job in staging_jobs.values() if not job.get('tmpfs_bytes')]
+            staging_usage['bytes'], staging_usage['free'] = await pipeline_stages['cleanup'].run_in_thread(measure_staging, paths)
+            # Освободившееся место может пропустить ожидающие задачи
+            dispatch_downloads()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"Ошибка очистки рабочих папок: {e}")
+        await asyncio.sleep(STAGING_MEASURE_INTERVAL)
+
+# ==========================================
+# КОНВЕЙЕР ОБРАБОТКИ (ЭТАПЫ)
+# ==========================================
+
+def download_formats(job, info, format_type, progress_hook, directory):
+    """Скачивает каждый выбранный формат в отдельный файл в папке задачи (блокирующая)"""
+    segmented = job['engine'] == 'segmented'
+
+    def job_hook(status):
+        # Остановка: поток загрузки останавливается, недокачанный файл остается для возобновления
+        if job.get('cancelled'):
+            raise yt_dlp.utils.DownloadCancelled()
+        progress_hook(status)
+
+    hooks = [job_hook]
+    if DOWNLOAD_BANDWIDTH_LIMIT:
+        hooks.append(make_throttle_hook())
+    outtmpl = {'default': get_output_template(directory)}
+    concurrent = FRAGMENT_CONNECTIONS if segmented else 1
+    with ydl_pool.checkout(format_type, progress_hooks=hooks, outtmpl=outtmpl, concurrent_fragment_downloads=concurrent) as ydl:
+        job['target'] = ydl.prepare_filename(info)
+        base = os.path.splitext(job['target'])[0]
+        downloaded = []
+        for fmt in info.get('requested_formats') or [info]:
+            fmt_info = dict(info)
+            fmt_info.pop('requested_formats', None)
+            fmt_info.update(fmt)
+            path = f"{base}.f{fmt['format_id'].replace('/', '_')}.{fmt['ext']}" if info.get('requested_formats') else job['target']
+            job['files'].append(path)
+            if segmented and is_rangeable(fmt) and not os.path.exists(path) and download_format_ranges(ydl, fmt, path, job_hook):
+                downloaded.append(path)
+                continue
+            reservation = call_in_loop(host_limiter.acquire(fmt.get('url') or info.get('webpage_url') or '', FRAGMENT_CONNECTIONS if segmented and is_fragmented(fmt) else 1))
+            try:
+                success, _ = ydl.dl(path, fmt_info)
+            finally:
+                loop.call_soon_threadsafe(host_limiter.release, reservation)
+            # max_filesize и похожие отказы возвращают False без исключения
+            if not success or not os.path.exists(path):
+                return []
+            downloaded.append(path)
+        return downloaded
+
+def download_format_ranges(ydl, fmt, path, progress_hook):
+    """Скачивает прогрессивный формат параллельными запросами диапазонов; False, если сервер этого не позволяет (блокирующая)"""
+    headers = dict(fmt.get('http_headers') or {})
+    cookie = ydl.cookiejar.get_cookie_header(fmt['url'])
+    if cookie:
+        headers['Cookie'] = cookie
+    received = 0
+
+    def on_chunk(count):
+        nonlocal received
+        received += count
+        progress_hook({'status': 'downloading', 'downloaded_bytes': received, 'total_bytes': fmt['filesize']})
+
+    try:
+        # Переименовывается по готовности, как .part файлы yt-dlp
+        call_in_loop(download_ranges(fmt['url'], path + '.ranges', fmt['filesize'], FRAGMENT_CONNECTIONS, on_chunk, headers))
+        os.replace(path + '.ranges', path)
+        return True
+    except (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        console_log(f"Загрузка диапазонами не удалась, используем yt-dlp: {e}")
+        return False
+
+async def upload_media(client, chat_id, format_type, file_path, caption, progress_callback, attributes=None):
+    """Отправляет файл в чат и возвращает его file_id"""
+    # Длительность, размеры и миниатюра с этапа анализа
+    attributes = attributes or {}
+    # Отправка в зависимости от типа
+    if not os.path.exists(file_path):
+        # file_id ранее отправленного элемента плейлиста: отправляется как тип медиа, сохраненный Telegram (видео или документ)
+        sent = await client.send_cached_media(chat_id, file_path, caption=caption)
+    elif format_type == 'video':
+        sent = await client.send_video(chat_id, video=file_path, caption=caption, progress=progress_callback, **attributes)
+    else:
+        sent = await client.send_audio(chat_id, audio=file_path, caption=caption, progress=progress_callback, **attributes)
+    return get_sent_file_id(sent)
+
+async def upload_parts(client, chat_id, url, format_type, parts, progress, attributes=None, delivered=None):
+    """Загружает файл или его части параллельно, затем отправляет их по порядку частей и возвращает их file_id"""
+    progress.set_stage('upload')
+    total = sum(os.path.getsize(path) for path in parts)
+    uploaded = [0] * len(parts)
+    slots = asyncio.Semaphore(SPLIT_UPLOAD_CONCURRENCY)
+    # Первые части, уже отправленные из кэша до отклонения file_id одной из частей (при том же числе частей)
+    sent_before = delivered['file_ids'] if delivered and delivered['count'] == len(parts) else []
+
+    for index, path in enumerate(parts[:len(sent_before)]):
+        uploaded[index] = os.path.getsize(path)
+
+    async def upload_part(index, path):
+        async def on_progress(current, _total):
+            uploaded[index] = current
+            progress.update(sum(uploaded), total)
+        async with slots:
+            prepared_uploads[path] = await client.save_file(path, progress=on_progress)
+
+    try:
+        await asyncio.gather(*(upload_part(index, path) for index, path in enumerate(parts) if index >= len(sent_before)))
+        # Сообщения идут по одному: части, отправленные параллельно, пришли бы в чат в любом порядке
+        file_ids = list(sent_before)
+        for index, path in enumerate(parts[len(file_ids):], len(file_ids)):
+            file_ids.append(await upload_media(client, chat_id, format_type, path, part_caption(url, index, len(parts)), None, (attributes or {}).get(path)))
+    finally:
+        for path in parts:
+            prepared_uploads.pop(path, None)
+    return PART_SEPARATOR.join(file_ids)
+
+def remove_files(paths):
+    """Удаляет файлы задачи вместе с недокачанными остатками yt-dlp (блокирующая)"""
+    for path in set(paths):
+        for leftover in (path, path + '.part', path + '.ytdl'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+# ==========================================
+# ДВИЖОК ПОСТОБРАБОТКИ (FFMPEG)
+# ==========================================
+
+# Префиксы названий кодеков от yt-dlp -> семейство кодека
+CODEC_FAMILIES = {
+    'h264': ('avc1', 'avc3', 'h264'),
+    'hevc': ('hvc1', 'hev1', 'hevc', 'h265'),
+    'av1': ('av01', 'av1'),
+    'vp9': ('vp09', 'vp9'),
+    'aac': ('mp4a', 'aac'),
+    'mp3': ('mp3',),
+    'opus': ('opus',),
+    'vorbis': ('vorbis',),
+}
+# Кодеки, которые помещаются в MP4 как есть (копирование потока)
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'av1', 'vp9'}
+MP4_AUDIO_CODECS = {'aac', 'mp3'}
+# Подсказки по расширению файла, когда экстрактор не сообщает кодеки (прямые ссылки)
+EXT_AUDIO_CODECS = {'mp3': 'mp3', 'm4a': 'aac', 'aac': 'aac', 'opus': 'opus', 'ogg': 'vorbis'}
+VIDEO_TRANSCODE_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+AUDIO_TRANSCODE_ARGS = ['-c:a', 'aac', '-b:a', '192k']
+MP3_TRANSCODE_ARGS = ['-c:a', 'libmp3lame', '-b:a', '320k']
+
+def codec_family(codec):
+    """Приводит название кодека (avc1.64001F, mp4a.40.2...) к семейству, None если неизвестен"""
+    codec = (codec or '').lower()
+    if codec in ('', 'none'):
+        return None
+    for family, prefixes in CODEC_FAMILIES.items():
+        if codec.startswith(prefixes):
+            return family
+    return codec
+
+def run_ffmpeg(args):
+    """Запускает ffmpeg и при сбое выбрасывает ошибку с его выводом (блокирующая)"""
+    started = time.monotonic()
+    result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y', '-threads', str(FFMPEG_THREADS), *args], capture_output=True)
+    metrics.observe('bot_ffmpeg_seconds', time.monotonic() - started)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg: {result.stderr.decode(errors='ignore').strip()[-300:]}")
+
+def run_ffmpeg_copy_or_transcode(inputs, copy_args, transcode_args, target):
+    """Сначала пробует копирование потока и перекодирует, только если оно не удалось (блокирующая)"""
+    try:
+        run_ffmpeg([*inputs, *copy_args, target])
+    except RuntimeError as e:
+        if copy_args == transcode_args:
+            raise
+        console_log(f"Копирование потока не удалось, перекодирование: {e}")
+        run_ffmpeg([*inputs, *transcode_args, target])
+    return target
+
+def video_codec_args(vcodec, acodec):
+    """Аргументы кодеков ffmpeg для MP4: копируем подходящее, остальное перекодируем"""
+    video = ['-c:v', 'copy'] if codec_family(vcodec) in MP4_VIDEO_CODECS | {None} else VIDEO_TRANSCODE_ARGS
+    audio = ['-c:a', 'copy'] if codec_family(acodec) in MP4_AUDIO_CODECS | {None} else AUDIO_TRANSCODE_ARGS
+    return video + audio
+
+def postprocess_video(files, formats, target):
+    """Склеивает или перепаковывает видео в MP4, перекодируя только несовместимые потоки (блокирующая)"""
+    ready = False
+    if len(files) == 2:
+        vcodec, acodec = formats[0].get('vcodec'), formats[1].get('acodec')
+        inputs = ['-i', files[0], '-i', files[1], '-map', '0:v:0', '-map', '1:a:0']
+    else:
+        vcodec, acodec = formats[0].get('vcodec'), formats[0].get('acodec')
+        ready = files[0].endswith('.mp4') and video_codec_args(vcodec, acodec) == ['-c:v', 'copy', '-c:a', 'copy']
+        # Уже потоковый MP4 с подходящими кодеками: делать нечего
+        if ready and is_faststart(files[0]):
+            return files[0]
+        target = os.path.splitext(target)[0] + ('.remux.mp4' if files[0].endswith('.mp4') else '.mp4')
+        inputs = ['-i', files[0], '-map', '0:v:0', '-map', '0:a:0?']
+    codec_args = video_codec_args(vcodec, acodec)
+    # Индекс (атом moov) в начале: воспроизведение начинается, пока файл еще загружается
+    inputs += ['-movflags', '+faststart']
+    try:
+        return run_ffmpeg_copy_or_transcode(inputs, codec_args, codec_args if ready else VIDEO_TRANSCODE_ARGS + AUDIO_TRANSCODE_ARGS, target)
+    except RuntimeError as e:
+        if not ready:
+            raise
+        # Нужно было только перенести индекс: файл, который ffmpeg не читает, отправляется как есть
+        console_log(f"Перенос индекса не удался, файл отправляется как есть: {e}")
+        return files[0]
+
+def postprocess_audio(source, fmt, target):
+    """Копирует поток MP3/AAC без перекодирования, всё остальное конвертирует в MP3 320k (блокирующая)"""
+    ext = os.path.splitext(source)[1].lstrip('.').lower()
+    family = codec_family(fmt.get('acodec')) or EXT_AUDIO_CODECS.get(ext)
+    base = os.path.splitext(target)[0]
+    if family == 'mp3':
+        if ext == 'mp3':
+            return source
+        return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], ['-c:a', 'copy'], MP3_TRANSCODE_ARGS, base + '.mp3')
+    if family == 'aac' and AUDIO_STREAM_COPY:
+        if ext == 'm4a' and fmt.get('vcodec') in (None, 'none'):
+            return source
+        return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], ['-c:a', 'copy'], MP3_TRANSCODE_ARGS, base + ('.copy.m4a' if ext == 'm4a' else '.m4a'))
+    return run_ffmpeg_copy_or_transcode(['-i', source, '-vn'], MP3_TRANSCODE_ARGS, MP3_TRANSCODE_ARGS, base + '.mp3')
+
+def is_faststart(path):
+    """True, если индекс MP4 (атом moov) идет перед медиаданными (блокирующая)"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = int.from_bytes(header[:4], 'big'), header[4:]
+            if kind == b'moov':
+                return True
+            if kind == b'mdat' or size == 0:
+                return False
+            if size == 1:
+                # После типа идет 64-битный размер блока
+                size = int.from_bytes(f.read(8), 'big') - 8
+            # С испорченным размером блока чтение шло бы назад или стояло на месте бесконечно
+            if size < 8:
+                return False
+            f.seek(size - 8, 1)
+
+def probe_media(path):
+    """Длительность, ширина, высота и наличие звуковой дорожки через ffprobe (по отчету ffmpeg, если ffprobe нет); неизвестные значения равны None (блокирующая)"""
+    if FFPROBE_PATH:
+        result = subprocess.run([FFPROBE_PATH, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path], capture_output=True)
+        if result.returncode == 0:
+            data = json.loads(result.stdout or b'{}')
+            # Встроенные обложки тоже являются видеопотоками
+            video = next((stream for stream in data.get('streams', []) if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic')), {})
+            duration = data.get('format', {}).get('duration')
+            width, height = video.get('width'), video.get('height')
+            rotation = video.get('tags', {}).get('rotate') or next((item.get('rotation') for item in video.get('side_data_list', []) if 'rotation' in item), 0)
+            if abs(int(float(rotation))) % 180 == 90:
+                width, height = height, width
+            audio = any(stream.get('codec_type') == 'audio' for stream in data.get('streams', []))
+            return {'duration': float(duration) if duration else None, 'width': width, 'height': height, 'audio': audio}
+    result = subprocess.run([FFMPEG_PATH, '-hide_banner', '-i', path], capture_output=True)
+    media = {'duration': None, 'width': None, 'height': None, 'audio': re.search(rb'Stream #[^\n]*Audio:', result.stderr) is not None}
+    match = re.search(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        media['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = re.search(rb'Stream #[^\n]*Video: (?![^\n]*attached pic)[^\n]*?, (\d+)x(\d+)', result.stderr)
+    if match:
+        media['width'], media['height'] = int(match.group(1)), int(match.group(2))
+    return media
+
+def split_media(path, duration):
+    """Режет файл больше лимита Telegram на части по ключевым кадрам без перекодирования; возвращает пути частей (блокирующая)"""
+    size = os.path.getsize(path)
+    if size <= MAX_FILE_SIZE_BYTES:
+        return [path]
+    duration = duration or probe_media(path)['duration']
+    if not duration:
+        raise ValueError("Нельзя разрезать файл неизвестной длительности")
+    base, ext = os.path.splitext(path)
+    segment_time = duration * SPLIT_PART_SIZE_BYTES / size
+    for attempt in range(SPLIT_ATTEMPTS):
+        run_ffmpeg([
+            '-i', path, '-map', '0:v?', '-map', '0:a?', '-c', 'copy',
+            '-f', 'segment', '-segment_time', f'{segment_time:.3f}', '-reset_timestamps', '1',
+            *(['-segment_format_options', 'movflags=+faststart'] if ext == '.mp4' else []),
+            f'{base}.part%03d{ext}',
+        ])
+        parts = []
+        while os.path.exists(f'{base}.part{len(parts):03d}{ext}'):
+            parts.append(f'{base}.part{len(parts):03d}{ext}')
+        # Разрез возможен только по ключевым кадрам: при редких ключевых кадрах часть может превысить лимит
+        if parts and all(os.path.getsize(part) <= MAX_FILE_SIZE_BYTES for part in parts):
+            return parts
+        remove_files(parts)
+        segment_time *= 0.75
+    raise ValueError("Не удалось разрезать файл на части в пределах лимита")
+
+def postprocess_media(files, formats, format_type, target):
+    """Готовит файл для отправки: видео MP4 или аудио MP3/M4A; возвращает его путь (блокирующая)"""
+    if not FFMPEG_AVAILABLE:
+        # Без FFmpeg файл отправляется в исходном формате
+        return files[0]
+    if format_type == 'video':
+        return postprocess_video(files, formats, target)
+    return postprocess_audio(files[0], formats[0], target)
+
+# ==========================================
+# МИНИАТЮРЫ И АНАЛИЗ МЕДИА
+# ==========================================
+
+def file_fingerprint(path):
+    """Хэш содержимого медиафайла: его размер и фрагменты в начале и в конце (блокирующая)"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        f.seek(max(0, size - FINGERPRINT_CHUNK_SIZE))
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    return digest.hexdigest()
+
+def make_thumbnail(source, target, position=None):
+    """Записывает JPEG-миниатюру из изображения, кадра видео или встроенной обложки (блокирующая)"""
+    seek = ['-ss', f'{position:.3f}'] if position else []
+    run_ffmpeg([
+        *seek, '-i', source, '-map', '0:v:0', '-frames:v', '1',
+        '-vf', f'scale={THUMB_SIZE}:{THUMB_SIZE}:force_original_aspect_ratio=decrease', '-q:v', '4', target,
+    ])
+
+def evict_thumbnails():
+    """Удаляет давно не использованные миниатюры, пока кэш больше THUMB_CACHE_MAX_BYTES (блокирующая)"""
+    entries = []
+    for entry in os.scandir(THUMB_CACHE_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= THUMB_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cache_thumbnail(key, make):
+    """Миниатюра под хэшем содержимого: из кэша или записанная make(path) (блокирующая)"""
+    path = os.path.join(THUMB_CACHE_DIR, f"{key[:32]}.jpg")
+    if os.path.exists(path):
+        # Время последнего использования задает порядок вытеснения
+        os.utime(path)
+        return path
+    temp_path = os.path.join(THUMB_CACHE_DIR, f"{key[:32]}_{uuid.uuid4().hex[:8]}.tmp.jpg")
+    try:
+        make(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    evict_thumbnails()
+    return path
+
+def thumbnail_from_image(data):
+    """Миниатюра скачанного постера или обложки с ключом по хэшу изображения (блокирующая)"""
+    def make(target):
+        source = target + '.src'
+        with open(source, 'wb') as f:
+            f.write(data)
+        try:
+            make_thumbnail(source, target)
+        finally:
+            os.remove(source)
+    return cache_thumbnail(hashlib.sha256(data).hexdigest(), make)
+
+def thumbnail_from_file(path, duration, format_type):
+    """Миниатюра из кадра видео или встроенной в аудио обложки с ключом по содержимому файла (блокирующая)"""
+    position = duration * THUMB_FRAME_POSITION if format_type == 'video' and duration else None
+    return cache_thumbnail(file_fingerprint(path), lambda target: make_thumbnail(path, target, position))
+
+async def fetch_source_thumbnail(url):
+    """Скачивает постер или обложку источника в кэш миниатюр; None, если они недоступны"""
+    if not url:
+        return None
+    try:
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=THUMB_FETCH_TIMEOUT)) as response:
+            response.raise_for_status()
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(DIRECT_CHUNK_SIZE):
+                data += chunk
+                if len(data) > THUMB_SOURCE_MAX_BYTES:
+                    return None
+        return await pipeline_stages['probe'].run_in_thread(thumbnail_from_image, bytes(data))
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, OSError) as e:
+        console_log(f"Миниатюра не скачана ({url}): {e}")
+        return None
+
+async def describe_media(job, info, format_type, parts):
+    """Этап анализа: аргументы send_video/send_audio для каждого файла (длительность, размеры, миниатюра)"""
+    await advance_stage(job, 'probe')
+    thumb = await fetch_source_thumbnail(info.get('thumbnail')) if FFMPEG_AVAILABLE else None
+    attributes = {}
+    for path in parts:
+        media = await pipeline_stages['probe'].run_in_thread(probe_media, path) if FFMPEG_AVAILABLE else {}
+        if len(parts) == 1:
+            # Значения экстрактора дополняют то, что не удалось прочитать анализом
+            media = {key: media.get(key) or info.get(key) for key in ('duration', 'width', 'height')}
+        item = {'duration': int(media.get('duration') or 0)}
+        if format_type == 'video':
+            item.update(width=media.get('width') or 0, height=media.get('height') or 0, supports_streaming=path.endswith('.mp4'))
+        else:
+            item.update(performer=info.get('artist') or info.get('uploader'), title=info.get('track') or info.get('title'))
+        part_thumb = thumb
+        if not part_thumb and FFMPEG_AVAILABLE:
+            try:
+                part_thumb = await pipeline_stages['probe'].run_in_thread(thumbnail_from_file, path, media.get('duration'), format_type)
+            except (RuntimeError, OSError):
+                # Аудио без обложки
+                part_thumb = None
+        if part_thumb:
+            item['thumb'] = part_thumb
+        attributes[path] = item
+    return attributes
+
+# ==========================================
+# ЖУРНАЛ ЗАДАЧ (ВОЗОБНОВЛЕНИЕ ПОСЛЕ ПЕРЕЗАПУСКА)
+# ==========================================
+
+# Поля журнала, по которым запускается задача
+JOB_COLUMNS = 'job_id, url, format_type, quality, user_id, chat_id, message_id, stage, job_dir, parts, attempts'
+
+def save_job_record(job_id, url, format_type, quality, user_id, chat_id, message_id, worker):
+    """Записывает новую задачу в журнал: она остается в таблице до завершения (worker None: ждет воркера)"""
+    db.write('''
+        INSERT OR REPLACE INTO jobs (job_id, url, format_type, quality, user_id, chat_id, message_id, stage, attempts, worker, date_created, date_updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, datetime('now'), datetime('now'))
+    ''', (job_id, url, format_type, quality, user_id, chat_id, message_id, worker))
+
+def update_job_record(job_id, **fields):
+    """Обновляет поля задачи в журнале (этап, папка, готовые части)"""
+    columns = ', '.join(f'{name} = ?' for name in fields)
+    db.write(f"UPDATE jobs SET {columns}, date_updated = datetime('now') WHERE job_id = ?", (*fields.values(), job_id))
+
+def delete_job_record(job_id):
+    """Удаляет завершенную задачу из журнала"""
+    db.write('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+def spawn_job(coroutine):
+    """Запускает задачу загрузки в фоне; при остановке она отменяется и возобновляется после перезапуска"""
+    task = loop.create_task(coroutine)
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+    return task
+
+async def stop_jobs():
+    """Остановка: отменяет работающие задачи, их записи в журнале и папки сохраняются"""
+    for task in job_tasks:
+        task.cancel()
+    if job_tasks:
+        await asyncio.wait(set(job_tasks))
+
+async def resume_jobs(client, adopt_queued=False):
+    """Запуск: подхватывает задачи этого процесса, прерванные прошлой остановкой или сбоем"""
+    # adopt_queued: бот без воркеров выполняет и задачи, оставшиеся в общей очереди, пока был включен USE_WORKERS
+    rows = await db.fetchall(f'SELECT {JOB_COLUMNS}, worker FROM jobs WHERE worker = ? OR (? AND worker IS NULL) ORDER BY date_created', (WORKER_ID, adopt_queued))
+    for row in rows:
+        if row[-1] is None:
+            update_job_record(row[0], worker=WORKER_ID)
+        await adopt_job(client, row[:-1], resumed=row[-1] is not None)
+
+async def release_local_jobs():
+    """Запуск в режиме воркеров: задачи, которые бот выполнял сам до включения USE_WORKERS, уходят в общую очередь"""
+    released = await db.execute("UPDATE jobs SET worker = NULL WHERE worker = 'local'")
+    if released:
+        console_log(f"Задач передано воркерам: {released}")
+
+async def adopt_job(client, row, resumed):
+    """Запускает задачу из журнала: из очереди или прерванную перезапуском (resumed)"""
+    job_id, url, format_type, quality, user_id, chat_id, message_id, stage, job_dir, parts, attempts = row
+    try:
+        status_msg = await client.get_messages(chat_id, message_id)
+        if status_msg.empty:
+            status_msg = await client.send_message(chat_id, "**Загрузка началась...**")
+        if resumed:
+            # Плейлист отправился бы заново с начала; задача, которая раз за разом роняет бота, не повторяется вечно
+            if stage == 'batch' or attempts >= JOB_MAX_RESUMES:
+                delete_job_record(job_id)
+                await status_msg.edit_text("**Загрузка прервана перезапуском.**\nОтправьте ссылку еще раз.")
+                return
+            update_job_record(job_id, attempts=attempts + 1, message_id=status_msg.id)
+            await status_msg.edit_text("**Бот перезапущен, загрузка продолжается...**")
+            console_log(f"Возобновлено: {url} (User: {user_id})")
+        elif status_msg.id != message_id:
+            update_job_record(job_id, message_id=status_msg.id)
+    except Exception as e:
+        console_log(f"Не удалось запустить {url}: {e}")
+        delete_job_record(job_id)
+        return
+    record = {'job_id': job_id, 'job_dir': job_dir, 'parts': json.loads(parts) if parts else None}
+    spawn_job(download_and_send(client, chat_id, url, format_type, user_id, status_msg, quality, record))
+
+async def queued_jobs_count(user_id):
+    """Задачи пользователя, ждущие воркера в общей очереди"""
+    row = await db.fetchone('SELECT COUNT(*) FROM jobs WHERE user_id = ? AND worker IS NULL', (user_id,))
+    return row[0]
+
+def claim_job(conn):
+    """Забирает следующую задачу из общей очереди для этого воркера, None если ее нет (поток БД)"""
+    with conn:
+        # Блокировка записи берется до чтения: два воркера никогда не получат одну задачу
+        conn.execute('BEGIN IMMEDIATE')
+        # Первыми идут пользователи с меньшим числом работающих задач, каждый в пределах MAX_CONCURRENT_DOWNLOADS на всех воркерах;
+        # задачи молчащего воркера не считаются выполняемыми, они ждут перехвата
+        stale = f'-{WORKER_HEARTBEAT_TIMEOUT} seconds'
+        row = conn.execute(f'''
+            SELECT {JOB_COLUMNS}, worker FROM (
+                SELECT *, (
+                    SELECT COUNT(*) FROM jobs AS other
+                    WHERE other.user_id = jobs.user_id AND (other.worker = 'local' OR other.heartbeat >= datetime('now', ?))
+                ) AS running
+                FROM jobs
+                WHERE worker IS NULL OR (worker != 'local' AND heartbeat < datetime('now', ?))
+            )
+            WHERE running < ?
+            ORDER BY running, date_created
+            LIMIT 1
+        ''', (stale, stale, MAX_CONCURRENT_DOWNLOADS)).fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET worker = ?, heartbeat = datetime('now') WHERE job_id = ?", (WORKER_ID, row[0]))
+    return row
+
+async def run_worker(client):
+    """Режим воркера: возобновляет свои задачи, затем берет задачи из общей очереди, пока есть место"""
+    await resume_jobs(client)
+    next_heartbeat = 0
+    while True:
+        try:
+            if time.monotonic() >= next_heartbeat:
+                # Задачи воркера, который перестал их отмечать, забирают остальные
+                db.write("UPDATE jobs SET heartbeat = datetime('now') WHERE worker = ?", (WORKER_ID,))
+                next_heartbeat = time.monotonic() + WORKER_HEARTBEAT_INTERVAL
+            while len(job_tasks) < MAX_GLOBAL_DOWNLOADS:
+                row = await db.call(claim_job)
+                if not row:
+                    break
+                # Задача, забранная у молчащего воркера, продолжается как прерванная перезапуском
+                await adopt_job(client, row[:-1], resumed=row[-1] is not None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            console_log(f"Ошибка проверки очереди воркера: {e}")
+        await asyncio.sleep(WORKER_POLL_INTERVAL)
+
 # ==========================================
 # ОБРАБОТЧИКИ КОМАНД И СООБЩЕНИЙ
 # ==========================================
@@ -284,21 +2730,21 @@ async def link_handler(client, message):
     
     url_hash = await save_url_mapping(url)
     
-    # Создание кнопок выбора формата
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🎬 Видео", callback_data=f"dl_video_{url_hash}"),
-            InlineKeyboardButton("🎵 Аудио", callback_data=f"dl_audio_{url_hash}")
-        ]
-    ])
+    # Создание кнопок выбора формата (у Spotify только аудио)
+    keyboard = build_format_keyboard(url_hash, audio_only=is_spotify_url(url))
     
-    await message.reply_text("Выберите формат загрузки:", reply_markup=keyboard)
+    reply = await message.reply_text("Выберите формат загрузки:", reply_markup=keyboard)
+    # Метаданные загружаются в фоне, пока пользователь выбирает формат
+    describe_tasks[(reply.chat.id, reply.id)] = asyncio.create_task(describe_link(reply, url, url_hash))
 
-@app.on_callback_query(filters.regex(r'^dl_(video|audio)_(.+)'))
+@app.on_callback_query(filters.regex(r'^dl_(video|audio)_([\w-]+)(?::(\w+))?$'))
 async def download_callback(client, callback_query):
     """Обработка нажатия на кнопки 'Видео' или 'Аудио'"""
     format_type = callback_query.matches[0].group(1)
     url_hash = callback_query.matches[0].group(2)
+    # Кнопка пониженного качества: максимальная высота видео
+    quality = callback_query.matches[0].group(3)
+    quality = int(quality) if quality and quality.isdigit() else None
     url = await get_url_from_hash(url_hash)
     user_id = callback_query.from_user.id
     
@@ -306,51 +2752,521 @@ async def download_callback(client, callback_query):
         await callback_query.answer("Ошибка: Ссылка не найдена в базе.", show_alert=True)
         return
 
-    # Проверка лимитов на одновременные загрузки
-    download_id = await can_start_download(user_id)
-    if not download_id:
-        await callback_query.answer("Достигнут лимит одновременных загрузок (макс. 2).", show_alert=True)
+    # Проверка лимита загрузок в очереди
+    queued = await queued_jobs_count(user_id) if USE_WORKERS else queued_count(user_id)
+    if queued >= MAX_QUEUED_PER_USER:
+        await callback_query.answer(f"Достигнут лимит очереди загрузок (макс. {MAX_QUEUED_PER_USER}).", show_alert=True)
         return
 
+    # Отклоняем заведомо слишком большой файл до начала скачивания
+    size = await get_estimated_size(url, format_type, quality)
+    if size and size > MAX_DOWNLOAD_SIZE_BYTES:
+        await callback_query.answer(f"Файл слишком большой (~{format_size(size)}, лимит {MAX_DOWNLOAD_SIZE_MB} МБ).", show_alert=True)
+        return
+
+    # Сообщение становится сообщением о статусе: больше не добавляем в него метаданные
+    describe_task = describe_tasks.pop((callback_query.message.chat.id, callback_query.message.id), None)
+    if describe_task:
+        describe_task.cancel()
+
     await callback_query.answer("Начинаю загрузку...")
     status_msg = await callback_query.message.edit_text("**Загрузка началась...**")
     
+    if USE_WORKERS:
+        # Режим воркеров: задача уходит в общую очередь, ее заберет свободный воркер
+        save_job_record(str(uuid.uuid4())[:8], url, format_type, quality, user_id, callback_query.message.chat.id, status_msg.id, None)
+        return
+
     # Запуск загрузки в фоновой задаче
-    asyncio.create_task(download_and_send(client, callback_query.message.chat.id, url, format_type, user_id, download_id, status_msg))
+    spawn_job(download_and_send(client, callback_query.message.chat.id, url, format_type, user_id, status_msg, quality))
+
+async def download_and_send(client, chat_id, url, format_type, user_id, status_msg, quality=None, record=None):
+    """Записывает задачу в журнал, выполняет ее и удаляет из журнала по завершении"""
+    if record is None:
+        record = {'job_id': str(uuid.uuid4())[:8]}
+        save_job_record(record['job_id'], url, format_type, quality, user_id, chat_id, status_msg.id, WORKER_ID)
+    started = time.monotonic()
+    try:
+        await handle_download(client, chat_id, url, format_type, user_id, status_msg, quality, record)
+    except asyncio.CancelledError:
+        # Остановка: задача остается в журнале и возобновится после перезапуска
+        raise
+    except Exception as e:
+        # Не удалось изменить сообщение статуса (сообщение удалено, FloodWait...): задача все равно завершена
+        record.setdefault('result', 'failed')
+        record.setdefault('error', str(e)[:300])
+        console_log(f"Задача {record['job_id']} завершилась с ошибкой: {e}")
+    # Отправлена или не удалась: после перезапуска она не должна запуститься снова
+    delete_job_record(record['job_id'])
+    log_job(record, url, format_type, quality, user_id, time.monotonic() - started)
 
-async def download_and_send(client, chat_id, url, format_type, user_id, download_id, status_msg):
+async def handle_download(client, chat_id, url, format_type, user_id, status_msg, quality, record):
     """Основная функция загрузки и отправки файла"""
     try:
-        unique_id = str(uuid.uuid4())[:8]
-        ydl_opts = get_ydl_options(format_type, unique_id, download=True)
-        
-        # Скачивание файла через yt-dlp в отдельном потоке
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(executor, lambda: ydl.extract_info(url, download=True))
-            file_path = ydl.prepare_filename(info)
-            # Корректировка расширения для аудио
-            if format_type == 'audio':
-                file_path = os.path.splitext(file_path)[0] + ".mp3"
-
-        if os.path.exists(file_path):
-            await status_msg.edit_text("**Отправка файла...**")
-            # Отправка в зависимости от типа
-            if format_type == 'video':
-                await client.send_video(chat_id, video=file_path, caption=f"**Готово!**\n{url}")
-            else:
-                await client.send_audio(chat_id, audio=file_path, caption=f"**Готово!**\n{url}")
-            
+        if is_spotify_url(url):
+            # Spotify: треки подбираются и отправляются по одному по мере готовности
+            update_job_record(record['job_id'], stage='batch')
+            record['result'] = 'spotify'
+            await download_spotify(client, chat_id, url, user_id, status_msg)
+            return
+
+        # Этот источник уже отправлялся: повторная отправка по file_id без загрузки
+        cache_key = get_url_cache_key(url)
+        cache_format = get_cache_format(format_type, quality)
+        cached_file_id = await get_cached_file_id(cache_key, cache_format)
+        if cached_file_id and await send_cached_media(client, chat_id, url, format_type, cached_file_id, record.setdefault('delivered', {})):
+            record['result'] = 'cached'
+            await status_msg.delete()
+            return
+
+        info = await get_media_info(url)
+        if is_batch(info):
+            # Плейлист, альбом или карусель: элементы скачиваются параллельно и отправляются альбомами
+            update_job_record(record['job_id'], stage='batch')
+            record['result'] = 'batch'
+            await download_batch(client, chat_id, url, format_type, user_id, status_msg, info)
+            return
+
+        flight_key = (cache_key, cache_format)
+        if flight_key in inflight_downloads:
+            # Этот же файл уже скачивается для кого-то другого: ждём его
+            flight = inflight_downloads[flight_key]
+            await status_msg.edit_text("**Этот файл уже скачивается, ожидание...**")
+            flight['progress'].attach(status_msg)
+            file_id = await asyncio.shield(flight['future'])
+            if file_id and await send_cached_media(client, chat_id, url, format_type, file_id):
+                record['result'] = 'joined'
+                await status_msg.delete()
+                return
+            record['result'] = 'failed'
+            await status_msg.edit_text("Ошибка: Файл не был создан." if not file_id else "Ошибка: Не удалось отправить файл, попробуйте еще раз.")
+            return
+
+        # Файл ещё никто не качает: этот запрос ведущий, остальные присоединяются к нему
+        flight = {'future': loop.create_future(), 'progress': ProgressReporter([status_msg])}
+        inflight_downloads[flight_key] = flight
+        download_id = None
+        try:
+            # Ждём свободного места в общей очереди
+            queued = time.monotonic()
+            download_id = await acquire_download_slot(user_id, status_msg)
+            record['queue_seconds'] = round(time.monotonic() - queued, 2)
+            flight['progress'].start()
+            file_id = await run_pipeline(client, chat_id, url, format_type, quality, cache_key, flight['progress'], record)
+            flight['future'].set_result(file_id)
+        except Exception as e:
+            flight['future'].set_exception(e)
+            # Помечаем исключение полученным, если к загрузке никто не присоединился
+            flight['future'].exception()
+            raise
+        finally:
+            flight['progress'].close()
+            record['stages'] = flight['progress'].stage_stats
+            del inflight_downloads[flight_key]
+            # Освобождаем место в очереди загрузок
+            if download_id:
+                await finish_download(user_id, download_id)
+
+        record['result'] = 'sent' if file_id else 'failed'
+        if file_id:
             await status_msg.delete()
-            # Удаление временного файла
-            if os.path.exists(file_path): os.remove(file_path)
         else:
             await status_msg.edit_text("Ошибка: Файл не был создан.")
             
     except Exception as e:
+        if record.get('result') in ('sent', 'cached', 'joined'):
+            # Файл доставлен, не удалось только убрать сообщение статуса
+            console_log(f"Сообщение статуса не удалено для {url}: {e}")
+            return
+        record.update(result='failed', error=str(e)[:300])
         console_log(f"Error downloading {url}: {e}")
-        await status_msg.edit_text(f"**Ошибка при загрузке:**\n{str(e)[:100]}")
+        try:
+            await status_msg.edit_text(f"**Ошибка при загрузке:**\n{str(e)[:100]}")
+        except Exception:
+            pass
+
+def new_job(unique_id=None):
+    """Состояние одного прохода через конвейер"""
+    return {'unique_id': unique_id or str(uuid.uuid4())[:8], 'files': [], 'engine': DOWNLOAD_ENGINE}
+
+async def resolve_media(job, url, format_type, quality=None, size_limit=MAX_DOWNLOAD_SIZE_BYTES, info=None):
+    """Этап resolve: метаданные (загруженные заранее при получении ссылки) и выбор формата"""
+    await advance_stage(job, 'resolve')
+    info = info or await get_media_info(url)
+    info = await pipeline_stages['resolve'].run_in_thread(select_formats, info, format_type, quality)
+    # Preflight: don't download what can't be sent anyway
+    size = estimate_filesize(info)
+    if size and size > size_limit:
+        raise ValueError(f"Файл слишком большой: ~{format_size(size)} (лимит {size_limit // (1024 * 1024)} МБ)")
+    # Небольшие файлы размещаются в RAM
+    job['size_hint'] = size
+    return info
+
+async def fetch_media(job, info, format_type, progress):
+    """Этапы загрузки и постобработки; возвращает файлы для отправки, [] если ничего не скачано"""
+    if job.get('parts') and all(os.path.exists(path) for path in job['parts']):
+        # Возобновленная задача: скачана и обработана до перезапуска
+        job['files'].extend(job['parts'])
+        job['attributes'] = await describe_media(job, info, format_type, job['parts'])
+        return job['parts']
+    source = acquire_source(get_media_cache_key(info)) if format_type == 'audio' and FFMPEG_AVAILABLE else None
+    if source:
+        # Звуковая дорожка недавно скачанного файла: скачивать нечего
+        job['source'] = source
+        files, formats = [source['path']], [source['format']]
+        job['target'] = os.path.join(get_job_dir(job, AUDIO_DIR), f"{yt_dlp.utils.sanitize_filename(info.get('title') or 'audio')}.src")
+    else:
+        # Скачивание файла через yt-dlp в пуле потоков этапа загрузки
+        await advance_stage(job, 'download')
+        files = await download_media(job, info, format_type, progress)
+        if not files:
+            return []
+        formats = info.get('requested_formats') or [info]
+        # Поток со звуковой дорожкой (второй при слиянии) сохраняется для запросов аудио
+        for path, fmt in reversed(list(zip(files, formats))):
+            if format_type == 'audio' or fmt.get('acodec') != 'none':
+                job['download_source'] = (path, {'acodec': fmt.get('acodec'), 'vcodec': fmt.get('vcodec')})
+                break
+
+    # Слияние/конвертация FFmpeg без занятия потоков загрузки
+    await advance_stage(job, 'postprocess')
+    progress.set_stage('postprocess')
+    file_path = await pipeline_stages['postprocess'].run_in_thread(postprocess_media, files, formats, format_type, job['target'])
+    job['files'].append(file_path)
+    # Больше лимита Telegram: части режутся копированием потоков и отправляются пронумерованной серией
+    parts = await pipeline_stages['postprocess'].run_in_thread(split_media, file_path, info.get('duration'))
+    job['files'].extend(parts)
+    if job.get('journaled'):
+        update_job_record(job['unique_id'], parts=json.dumps(parts))
+    job['attributes'] = await describe_media(job, info, format_type, parts)
+    return parts
+
+async def release_job(job):
+    """Этап очистки: удаляет файлы задачи и освобождает её место в конвейере"""
+    source = job.pop('source', None)
+    try:
+        # Удаление папки задачи со всеми временными файлами (источник из кэша остается в кэше)
+        await advance_stage(job, 'cleanup')
+        if not job.get('cancelled'):
+            await pipeline_stages['cleanup'].run_in_thread(remove_job_dir, job)
+    finally:
+        if source:
+            release_source(source)
+        # Папку, оставшуюся после отмененной очистки, подберет очистка осиротевших файлов
+        staging_jobs.pop(job['unique_id'], None)
+        leave_stage(job)
+        dispatch_downloads()
+
+async def run_pipeline(client, chat_id, url, format_type, quality, cache_key, progress, record):
+    """Проводит задачу через все этапы конвейера и возвращает file_id отправленного файла"""
+    cache_format = get_cache_format(format_type, quality)
+    job = new_job(record['job_id'])
+    # Этапы, папка и готовые части записываются в журнал
+    job['journaled'] = True
+    if record.get('job_dir') and os.path.isdir(record['job_dir']):
+        adopt_job_dir(job, record['job_dir'])
+        job['parts'] = record.get('parts')
+    try:
+        info = await resolve_media(job, url, format_type, quality)
+        media_key = get_media_cache_key(info)
+        # Другая ссылка на уже отправленное видео
+        cached_file_id = media_key and await get_cached_file_id(media_key, cache_format)
+        if cached_file_id and await send_cached_media(client, chat_id, url, format_type, cached_file_id, record.setdefault('delivered', {})):
+            await save_cached_file_id([cache_key], cache_format, cached_file_id)
+            return cached_file_id
+
+        parts = await fetch_media(job, info, format_type, progress)
+        if not parts:
+            return None
+
+        await advance_stage(job, 'upload')
+        file_id = await upload_parts(client, chat_id, url, format_type, parts, progress, job['attributes'], record.get('delivered'))
+        # Запоминаем file_id для мгновенной повторной отправки того же источника
+        await save_cached_file_id([cache_key, media_key], cache_format, file_id)
+        await keep_source(job, media_key)
+        return file_id
+    except asyncio.CancelledError:
+        # Остановка: недокачанные файлы остаются для возобновления после перезапуска
+        job['cancelled'] = True
+        raise
+    finally:
+        await release_job(job)
+
+# ==========================================
+# ПЛЕЙЛИСТЫ И АЛЬБОМЫ (ПАКЕТНЫЙ РЕЖИМ)
+# ==========================================
+
+def get_entry_url(entry):
+    """Собственная ссылка элемента плейлиста, None если элемент извлечён вместе с плейлистом"""
+    if entry.get('_type') in ('url', 'url_transparent'):
+        return entry.get('url')
+    return None
+
+async def download_batch(client, chat_id, url, format_type, user_id, status_msg, playlist):
+    """Готовит элементы плейлиста параллельно и отправляет их альбомами по мере готовности"""
+    entries = collections.deque(entry for entry in (playlist.get('entries') or []) if entry)
+    total = min(len(entries), BATCH_MAX_ITEMS)
+    entries = collections.deque(itertools.islice(entries, total))
+    batch = {'total': total, 'sent': 0, 'failed': 0, 'bytes': 0, 'next_edit': 0, 'pending': collections.deque(), 'lock': asyncio.Lock()}
+    if not total:
+        raise ValueError("Плейлист пуст")
+    await update_batch_status(status_msg, batch, force=True)
+
+    async def worker():
+        while entries:
+            entry = entries.popleft()
+            try:
+                batch['pending'].append(await prepare_batch_entry(entry, format_type, user_id, batch))
+            except Exception as e:
+                console_log(f"Ошибка элемента плейлиста ({url}): {e}")
+                batch['failed'] += 1
+                await update_batch_status(status_msg, batch)
+                continue
+            await flush_batch(client, chat_id, url, format_type, status_msg, batch)
+
+    await asyncio.gather(*(worker() for _ in range(min(BATCH_PARALLEL, total))))
+    await flush_batch(client, chat_id, url, format_type, status_msg, batch, final=True)
+    await update_batch_status(status_msg, batch, force=True)
+
+async def prepare_batch_entry(entry, format_type, user_id, batch):
+    """Доводит один элемент до готовности к отправке: file_id из кэша или скачанные файлы"""
+    entry_url = get_entry_url(entry)
+    cache_key = get_url_cache_key(entry_url) if entry_url else get_media_cache_key(entry)
+    cached_file_id = cache_key and await get_cached_file_id(cache_key, format_type)
+    if cached_file_id:
+        return {'media': cached_file_id.split(PART_SEPARATOR), 'cache_keys': [], 'job': None}
+    size_limit = min(MAX_DOWNLOAD_SIZE_BYTES, BATCH_MAX_BYTES - batch['bytes'])
+    if size_limit <= 0:
+        raise ValueError("Достигнут лимит объёма плейлиста")
+    # Элементы делят слоты загрузки пользователя с остальными его задачами
+    download_id = await acquire_download_slot(user_id, None)
+    job = new_job()
+    try:
+        info = await resolve_media(job, entry_url, format_type, size_limit=size_limit, info=None if entry_url else entry)
+        media_key = get_media_cache_key(info)
+        cached_file_id = media_key and media_key != cache_key and await get_cached_file_id(media_key, format_type)
+        if cached_file_id:
+            await release_job(job)
+            return {'media': cached_file_id.split(PART_SEPARATOR), 'cache_keys': [cache_key], 'job': None}
+        parts = await fetch_media(job, info, format_type, ProgressReporter([]))
+        if not parts:
+            raise ValueError("Файл не был создан")
+        # Файлы ждут своего альбома вне этапов конвейера
+        leave_stage(job)
+        batch['bytes'] += sum(os.path.getsize(path) for path in parts)
+        return {'media': parts, 'cache_keys': [cache_key, media_key], 'job': job}
+    except BaseException:
+        await release_job(job)
+        raise
+    finally:
+        await finish_download(user_id, download_id)
+
+async def flush_batch(client, chat_id, url, format_type, status_msg, batch, final=False):
+    """Отправляет полные альбомы готовых элементов (и остаток в конце)"""
+    async with batch['lock']:
+        pending = batch['pending']
+        while pending and (final or sum(len(item['media']) for item in pending) >= MEDIA_GROUP_SIZE):
+            group = [pending.popleft()]
+            while pending and sum(len(item['media']) for item in group) + len(pending[0]['media']) <= MEDIA_GROUP_SIZE:
+                group.append(pending.popleft())
+            await send_batch_group(client, chat_id, url, format_type, group, batch)
+            await update_batch_status(status_msg, batch)
+
+async def send_batch_group(client, chat_id, url, format_type, group, batch):
+    """Отправляет элементы одним альбомом (по одному, если альбом отклонён) и кэширует их file_id"""
+    media = [path for item in group for path in item['media']]
+    attributes = {}
+    for item in group:
+        if item['job']:
+            attributes.update(item['job']['attributes'])
+    file_ids = None
+    upload_job = {}
+    await advance_stage(upload_job, 'upload')
+    try:
+        if 1 < len(media) <= MEDIA_GROUP_SIZE:
+            media_class = InputMediaVideo if format_type == 'video' else InputMediaAudio
+            try:
+                messages = await client.send_media_group(chat_id, [media_class(path, caption=f"**Готово!**\n{url}" if index == 0 else "", **attributes.get(path, {})) for index, path in enumerate(media)])
+                file_ids = [get_sent_file_id(message) for message in messages]
+            except Exception as e:
+                console_log(f"Альбом отклонён, отправляем файлы по одному: {e}")
+        if file_ids is None:
+            file_ids = []
+            for path in media:
+                try:
+                    file_ids.append(await upload_media(client, chat_id, format_type, path, f"**Готово!**\n{url}", None, attributes.get(path)))
+                except Exception as e:
+                    console_log(f"Ошибка отправки файла плейлиста ({url}): {e}")
+                    file_ids.append(None)
+    finally:
+        leave_stage(upload_job)
+    position = 0
+    for item in group:
+        item_ids = file_ids[position:position + len(item['media'])]
+        position += len(item['media'])
+        if all(item_ids):
+            batch['sent'] += 1
+            if item['job']:
+                await save_cached_file_id(item['cache_keys'], format_type, PART_SEPARATOR.join(item_ids))
+        else:
+            batch['failed'] += 1
+        if item['job']:
+            await release_job(item['job'])
+
+async def update_batch_status(status_msg, batch, force=False):
+    """Показывает прогресс плейлиста в сообщении статуса (не чаще PROGRESS_EDIT_INTERVAL)"""
+    if not force and time.monotonic() < batch['next_edit']:
+        return
+    batch['next_edit'] = time.monotonic() + PROGRESS_EDIT_INTERVAL
+    text = f"**Плейлист:** отправлено {batch['sent']} из {batch['total']}"
+    if batch['failed']:
+        text += f", с ошибкой {batch['failed']}"
+    try:
+        await status_msg.edit_text(text)
+    except Exception:
+        pass
+
+# ==========================================
+# SPOTIFY (SPOTDL)
+# ==========================================
+
+# Загрузчик spotDL на каждый рабочий поток: у каждого свой цикл событий
+spotify_threads = threading.local()
+spotify_client_lock = threading.Lock()
+spotify_client_ready = False
+
+def is_spotify_url(url):
+    """Ссылка на трек, альбом или плейлист Spotify"""
+    return bool(SPOTIFY_URL_PATTERN.match(url))
+
+def init_spotify_client():
+    """Один раз за процесс настраивает клиент Spotify API в spotDL (блокирующая)"""
+    global spotify_client_ready
+    from spotdl.utils.config import DEFAULT_CONFIG
+    from spotdl.utils.spotify import SpotifyClient
+    with spotify_client_lock:
+        if not spotify_client_ready:
+            SpotifyClient.init(
+                client_id=SPOTIFY_CLIENT_ID or DEFAULT_CONFIG['client_id'],
+                client_secret=SPOTIFY_CLIENT_SECRET or DEFAULT_CONFIG['client_secret'],
+                user_auth=False,
+            )
+            spotify_client_ready = True
+
+def get_spotify_downloader():
+    """Загрузчик spotDL текущего потока (блокирующая)"""
+    from spotdl.download.downloader import Downloader
+    init_spotify_client()
+    if not hasattr(spotify_threads, 'downloader'):
+        spotify_threads.downloader = Downloader(dict(SPOTDL_OPTIONS, ffmpeg=FFMPEG_PATH))
+    return spotify_threads.downloader
+
+def get_spotify_songs(url):
+    """Метаданные треков трека, альбома или плейлиста Spotify (блокирующая)"""
+    from spotdl.utils.search import get_simple_songs
+    init_spotify_client()
+    return get_simple_songs([url])[:BATCH_MAX_ITEMS]
+
+def match_spotify_song(song):
+    """Ищет источник трека у аудиопровайдеров (блокирующая)"""
+    return get_spotify_downloader().search(song)
+
+def download_spotify_song(song, source, directory):
+    """Скачивает подобранный источник и записывает в MP3 теги и обложку (блокирующая)"""
+    downloader = get_spotify_downloader()
+    downloader.settings['output'] = os.path.join(directory, "{artists} - {title}.{output-ext}")
+    # С известным источником spotDL не ищет сам
+    song.download_url = source
+    _, path = downloader.download_song(song)
+    return str(path) if path else None
+
+async def get_spotify_match(song, slots):
+    """Аудиоисточник трека: из кэша соответствий, иначе находится и запоминается"""
+    row = await db.fetchone('''
+        SELECT source_url FROM spotify_matches
+        WHERE track_id = ? AND date_created > datetime('now', ?)
+    ''', (song.song_id, f'-{SPOTIFY_MATCH_TTL_DAYS} days'))
+    if row:
+        return row[0]
+    async with slots:
+        source = await pipeline_stages['resolve'].run_in_thread(match_spotify_song, song)
+    if not source:
+        raise ValueError(f"Не найден аудиоисточник для {song.display_name}")
+    db.write('''
+        INSERT OR REPLACE INTO spotify_matches (track_id, source_url, date_created)
+        VALUES (?, ?, datetime('now'))
+    ''', (song.song_id, source))
+    return source
+
+async def download_spotify(client, chat_id, url, user_id, status_msg):
+    """Разбирает ссылку Spotify, параллельно подбирает источники треков и отправляет каждый трек, как только он готов"""
+    if not SPOTDL_AVAILABLE or not FFMPEG_AVAILABLE:
+        raise ValueError("Для ссылок Spotify нужны spotDL и FFmpeg")
+    songs = await pipeline_stages['resolve'].run_in_thread(get_spotify_songs, url)
+    if not songs:
+        raise ValueError("Треки не найдены")
+    batch = {'total': len(songs), 'sent': 0, 'failed': 0, 'next_edit': 0, 'error': None}
+    if batch['total'] > 1:
+        await update_batch_status(status_msg, batch, force=True)
+    # Подбор источников идет впереди загрузок для всего списка
+    slots = asyncio.Semaphore(SPOTIFY_MATCH_PARALLEL)
+    matches = {}
+    for song in songs:
+        if song.song_id not in matches:
+            matches[song.song_id] = asyncio.ensure_future(get_spotify_match(song, slots))
+    songs = collections.deque(songs)
+
+    async def worker():
+        while songs:
+            song = songs.popleft()
+            try:
+                await send_spotify_song(client, chat_id, song, matches[song.song_id], user_id)
+                batch['sent'] += 1
+            except Exception as e:
+                console_log(f"Ошибка трека Spotify ({song.url}): {e}")
+                batch['failed'] += 1
+                batch['error'] = e
+            if batch['total'] > 1:
+                await update_batch_status(status_msg, batch)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(BATCH_PARALLEL, batch['total']))))
+    finally:
+        for match in matches.values():
+            # Ошибки подбора для треков, отправленных из кэша, помечаются как полученные
+            if match.done() and not match.cancelled():
+                match.exception()
+            match.cancel()
+    if batch['total'] > 1:
+        await update_batch_status(status_msg, batch, force=True)
+    elif batch['error']:
+        raise batch['error']
+    else:
+        await status_msg.delete()
+
+async def send_spotify_song(client, chat_id, song, match, user_id):
+    """Отправляет один трек: по file_id из кэша или скачав его подобранный источник"""
+    cache_key = get_url_cache_key(song.url)
+    cached_file_id = await get_cached_file_id(cache_key, 'audio')
+    if cached_file_id and await send_cached_media(client, chat_id, song.url, 'audio', cached_file_id):
+        return
+    source = await asyncio.shield(match)
+    # Треки делят места загрузки пользователя с остальными его задачами
+    download_id = await acquire_download_slot(user_id, None)
+    job = new_job()
+    try:
+        await advance_stage(job, 'download')
+        path = await pipeline_stages['download'].run_in_thread(download_spotify_song, song, source, get_job_dir(job, SPOTIFY_DIR))
+        if not path:
+            raise ValueError("Файл не был создан")
+        job['files'].append(path)
+        # Обложка, встроенная spotDL, становится миниатюрой
+        attributes = await describe_media(job, {'artist': song.artist, 'track': song.name}, 'audio', [path])
+        await advance_stage(job, 'upload')
+        file_id = await upload_media(client, chat_id, 'audio', path, f"**Готово!**\n{song.url}", None, attributes[path])
+        await save_cached_file_id([cache_key], 'audio', file_id)
     finally:
-        # Освобождаем место в очереди загрузок
+        await release_job(job)
         await finish_download(user_id, download_id)
 
 @app.on_inline_query()
@@ -358,27 +3274,49 @@ async def inline_handler(client, inline_query):
     """Обработка инлайн-запросов (когда бота вызывают через @botname)"""
     query = inline_query.query.strip()
     user = inline_query.from_user
-    if not query: return
+    # Частичный ввод, который ещё не ссылка: отвечать и сохранять нечего
+    if not INLINE_URL_PATTERN.match(query): return
     
-    console_log(f"INLINE: {query} (ID: {user.id})")
-    url_hash = hashlib.md5(query.encode()).hexdigest()
-    await save_url_mapping(query)
-    
-    # Результаты инлайн-поиска
-    results = [
-        InlineQueryResultArticle(
-            title="Скачать Видео",
-            input_message_content=InputTextMessageContent(f"🎬 Загрузка видео:\n{query}"),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎬 Скачать", callback_data=f"dl_video_{url_hash}")]])
-        ),
-        InlineQueryResultArticle(
-            title="Скачать Аудио",
-            input_message_content=InputTextMessageContent(f"🎵 Загрузка аудио:\n{query}"),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎵 Скачать", callback_data=f"dl_audio_{url_hash}")]])
-        )
-    ]
-    await inline_query.answer(results, cache_time=1)
+    # Новое нажатие клавиши заменяет запрос, который ещё ждёт
+    previous = inline_tasks.pop(user.id, None)
+    if previous:
+        previous.cancel()
+    task = asyncio.create_task(answer_inline_query(inline_query, query))
+    inline_tasks[user.id] = task
+    task.add_done_callback(lambda t: finish_inline_task(user.id, t))
+
+def serve(client, coroutines):
+    """Запускает клиент и фоновые задачи до сигнала остановки, затем останавливает работающие задачи"""
+    clear_source_cache()
+    client.start()
+    background_tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+    idle()
+    for task in background_tasks:
+        task.cancel()
+    # Незавершенные задачи остаются в журнале и продолжатся после перезапуска
+    loop.run_until_complete(stop_jobs())
+    loop.run_until_complete(upload_engine.close())
+    client.stop()
 
 if __name__ == "__main__":
-    console_log("Бот запущен!")
-    app.run()
+    if sys.argv[1:2] == ['--bench'] and len(sys.argv) > 2:
+        # Замер скорости движка загрузки без запуска бота
+        loop.run_until_complete(benchmark_download(sys.argv[2]))
+    elif sys.argv[1:2] == ['--worker']:
+        # Воркер загрузок для бота в режиме воркеров: python bot_ru.py --worker [имя] [порт метрик] (на хосте у каждого воркера свое имя и порт)
+        worker_name = sys.argv[2] if len(sys.argv) > 2 else 'worker'
+        worker_metrics_port = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        WORKER_ID = f"{socket.gethostname()}/{worker_name}"
+        use_worker_folders(worker_name)
+        console_log(f"Воркер {WORKER_ID} запущен!")
+        # Своя сессия без обновлений: сообщения боту обрабатывает только процесс бота
+        worker = MediaClient(name=f"media_downloader_{worker_name}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True)
+        serve(worker, [maintain_staging(), run_worker(worker)] + ([serve_metrics(worker_metrics_port)] if worker_metrics_port else []))
+    else:
+        console_log("Бот запущен!")
+        # В режиме воркеров бот только ставит задачи в очередь, выполняют их воркеры
+        serve(app, [maintain_database(), maintain_staging()] + ([release_local_jobs()] if USE_WORKERS else [resume_jobs(app, adopt_queued=True)]) + ([serve_metrics(METRICS_PORT)] if METRICS_PORT else []))
+    loop.run_until_complete(close_http_session())
+    ydl_pool.close()
+    # Коммитим записи, ещё ожидающие в очереди отложенной записи
+    loop.run_until_complete(db.close())
@@ -14,3 +14,24 @@ BOT_TOKEN = ""
 # Если оставить пустым, бот будет доступен всем
 ALLOWED_USERS = []
 
+# Spotify API keys for spotDL (optional)
+# If left empty, spotDL's built-in keys are used
+# ---
+# Ключи Spotify API для spotDL (необязательно)
+# Если оставить пустыми, используются встроенные ключи spotDL
+SPOTIFY_CLIENT_ID = ""
+SPOTIFY_CLIENT_SECRET = ""
+
+# Worker mode (optional): the bot only queues downloads, workers started with
+# `python bot_en.py --worker NAME` download and send them (more workers - more capacity)
+# ---
+# Режим воркеров (необязательно): бот только ставит загрузки в очередь, их скачивают и отправляют
+# воркеры, запущенные через `python bot_ru.py --worker ИМЯ` (больше воркеров - больше мощности)
+USE_WORKERS = False
+
+# Local port of the Prometheus metrics endpoint (http://127.0.0.1:PORT/metrics), 0 - disabled
+# Workers serve theirs on the port given after the name: `--worker NAME PORT`
+# ---
+# Локальный порт эндпоинта метрик Prometheus (http://127.0.0.1:ПОРТ/metrics), 0 - отключен
+# Воркеры отдают свои на порту, указанном после имени: `--worker ИМЯ ПОРТ`
+METRICS_PORT = 9464
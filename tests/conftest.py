@@ -0,0 +1,19 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope='session', params=['bot_en', 'bot_ru'])
+def bot(request, tmp_path_factory):
+    """Bot module imported in a scratch folder: its downloads, database and logs folders are created there"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp(request.param))
+    try:
+        yield importlib.import_module(request.param)
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,63 @@
+import copy
+
+import pytest
+from yt_dlp import YoutubeDL
+
+AUDIO_SIZE = 9_600_000
+VIDEO_SIZE = 3_000_000_000
+
+
+@pytest.fixture
+def metadata(bot):
+    """Info of a video with separate audio and 1080p streams, after the metadata pass selected its best pair"""
+    info = {
+        'id': 'v', 'title': 'Video', 'duration': 600, 'extractor': 'test', 'extractor_key': 'Test',
+        'webpage_url': 'https://example.com/v',
+        'formats': [
+            {'format_id': '140', 'url': 'https://example.com/140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+             'abr': 128, 'filesize': AUDIO_SIZE},
+            {'format_id': '137', 'url': 'https://example.com/137', 'ext': 'mp4', 'acodec': 'none', 'vcodec': 'avc1',
+             'height': 1080, 'width': 1920, 'filesize_approx': VIDEO_SIZE},
+        ],
+    }
+    with YoutubeDL({'quiet': True, 'format': 'bestvideo+bestaudio'}) as ydl:
+        return ydl.process_ie_result(copy.deepcopy(info), download=False)
+
+
+def test_audio_selection_drops_the_pair_of_the_metadata_pass(bot, metadata):
+    assert [fmt['format_id'] for fmt in metadata['requested_formats']] == ['137', '140']
+    info = bot.select_formats(metadata, 'audio')
+    assert info['format_id'] == '140'
+    assert 'requested_formats' not in info
+    assert info.get('height') is None
+    assert bot.estimate_filesize(info) == AUDIO_SIZE
+
+
+def test_metadata_is_not_changed_by_a_selection(bot, metadata):
+    before = copy.deepcopy(metadata)
+    bot.select_formats(metadata, 'audio')
+    assert metadata == before
+
+
+def test_video_selection_sums_both_streams(bot, metadata, monkeypatch):
+    # Separate streams are only selected when FFmpeg can merge them
+    monkeypatch.setattr(bot, 'FFMPEG_AVAILABLE', True)
+    info = bot.select_formats(metadata, 'video', 1080)
+    assert bot.estimate_filesize(info) == AUDIO_SIZE + VIDEO_SIZE
+
+
+def single_format_info(megabytes):
+    """Metadata of a video offered in one 360p format of the given size"""
+    return {'duration': 600, 'formats': [
+        {'format_id': '18', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1', 'height': 360, 'filesize': megabytes * 1024 * 1024},
+    ]}
+
+
+@pytest.mark.parametrize('megabytes, planned', [(1900, True), (1980, False)])
+def test_planner_keeps_headroom_below_the_telegram_limit(bot, megabytes, planned):
+    assert bot.plan_format(single_format_info(megabytes), 'video', size_limit=bot.PLAN_FILE_SIZE_BYTES) == ('18' if planned else None)
+
+
+def test_planner_splits_instead_of_downgrading(bot):
+    size_limit = bot.MAX_SPLIT_PARTS * bot.SPLIT_PART_SIZE_BYTES - (bot.MAX_FILE_SIZE_BYTES - bot.PLAN_FILE_SIZE_BYTES)
+    assert bot.plan_format(single_format_info(3000), 'video', size_limit=size_limit) == '18'
@@ -0,0 +1,58 @@
+import pytest
+from pyrogram.errors import FileIdInvalid, FloodWait, UserIsBlocked
+
+
+class FakeClient:
+    """Re-sends file_ids; error(file_id) may raise instead"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    async def send_cached_media(self, chat_id, file_id, caption=''):
+        error = self.error and self.error(file_id)
+        if error:
+            raise error
+        self.sent.append(file_id)
+
+
+@pytest.fixture
+def invalidated(bot, monkeypatch):
+    """file_ids dropped from the media cache"""
+    dropped = []
+
+    async def invalidate(file_id):
+        dropped.append(file_id)
+
+    monkeypatch.setattr(bot, 'invalidate_cached_file_id', invalidate)
+    monkeypatch.setattr(bot, 'console_log', lambda message: None)
+    return dropped
+
+
+def resend(bot, client, file_id, delivered=None):
+    return bot.loop.run_until_complete(bot.send_cached_media(client, 1, 'https://example.com/v', 'video', file_id, delivered))
+
+
+def test_rejected_part_drops_the_file_and_remembers_delivered_parts(bot, invalidated):
+    client = FakeClient(lambda file_id: FileIdInvalid() if file_id == 'B' else None)
+    delivered = {}
+    assert not resend(bot, client, 'A,B,C', delivered)
+    assert invalidated == ['A,B,C']
+    assert delivered == {'count': 3, 'file_ids': ['A']}
+    # Another entry for the same media continues after the delivered part
+    assert resend(bot, FakeClient(), 'A,D,E', delivered)
+    assert delivered['file_ids'] == ['A', 'D', 'E']
+
+
+@pytest.mark.parametrize('error', [UserIsBlocked(), OSError('connection reset')])
+def test_errors_unrelated_to_the_file_keep_it_cached(bot, invalidated, error):
+    assert not resend(bot, FakeClient(lambda file_id: error), 'A')
+    assert invalidated == []
+
+
+def test_flood_wait_is_waited_out(bot, invalidated):
+    waits = iter([FloodWait(value=0)])
+    client = FakeClient(lambda file_id: next(waits, None))
+    assert resend(bot, client, 'A')
+    assert client.sent == ['A']
+    assert invalidated == []
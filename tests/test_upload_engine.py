@@ -0,0 +1,169 @@
+import asyncio
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+from pyrogram.errors import FloodWait
+
+
+class FakeStorage:
+    """Session parameters of a logged-in client"""
+
+    async def dc_id(self):
+        return 2
+
+    async def auth_key(self):
+        return b'key'
+
+    async def test_mode(self):
+        return False
+
+
+class FakeClient:
+    """Just what UploadEngine needs from a Pyrogram client"""
+    storage = FakeStorage()
+
+    def rnd_id(self):
+        return random.getrandbits(63)
+
+
+class FakeSession:
+    """Media session that stores the parts it receives; fail(invoke_number) may raise instead"""
+    parts = {}
+    invokes = 0
+    fail = None
+
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def invoke(self, rpc):
+        FakeSession.invokes += 1
+        error = FakeSession.fail and FakeSession.fail(FakeSession.invokes)
+        if error:
+            raise error
+        FakeSession.parts[(rpc.file_id, rpc.file_part)] = rpc.bytes
+        return True
+
+
+@pytest.fixture
+def engine(bot, monkeypatch):
+    """Fresh upload engine over fake media sessions"""
+    monkeypatch.setattr(bot, 'Session', FakeSession)
+    monkeypatch.setattr(bot, 'UPLOAD_RETRY_DELAY', 0)
+    monkeypatch.setattr(FakeSession, 'parts', {})
+    monkeypatch.setattr(FakeSession, 'invokes', 0)
+    monkeypatch.setattr(FakeSession, 'fail', None)
+    engine = bot.UploadEngine(2, 2)
+    yield engine
+    bot.loop.run_until_complete(engine.close())
+
+
+@pytest.fixture
+def media_file(bot, tmp_path):
+    """File of a few upload parts with a short last part"""
+    path = tmp_path / 'media.mp4'
+    path.write_bytes(os.urandom(3 * bot.UPLOAD_PART_SIZE + 100))
+    return str(path)
+
+
+def test_parts_are_reassembled_despite_failed_parts(bot, engine, media_file):
+    FakeSession.fail = lambda number: OSError('connection reset') if number % 3 == 0 else None
+    progress = []
+
+    async def on_progress(current, total):
+        progress.append((current, total))
+
+    input_file = bot.loop.run_until_complete(engine.save_file(FakeClient(), media_file, progress=on_progress))
+    data = b''.join(FakeSession.parts[(input_file.id, index)] for index in range(input_file.parts))
+    with open(media_file, 'rb') as f:
+        assert data == f.read()
+    assert input_file.parts == 4
+    assert progress[-1] == (os.path.getsize(media_file), os.path.getsize(media_file))
+    assert engine.stats()['retries'] > 0
+
+
+def test_flood_wait_does_not_use_up_the_retries(bot, engine, media_file):
+    FakeSession.fail = lambda number: FloodWait(value=0) if number <= bot.UPLOAD_PART_RETRIES else None
+    with open(media_file, 'rb') as f, bot.mmap.mmap(f.fileno(), 0, access=bot.mmap.ACCESS_READ) as mapped:
+        sent = bot.loop.run_until_complete(engine.send_part(FakeClient(), mapped, 7, 0, 4, False))
+    assert sent == bot.UPLOAD_PART_SIZE
+    assert (7, 0) in FakeSession.parts
+    assert FakeSession.invokes == bot.UPLOAD_PART_RETRIES + 1
+
+
+def test_part_fails_after_the_last_retry(bot, engine, media_file):
+    FakeSession.fail = lambda number: OSError('connection reset')
+    with pytest.raises(OSError):
+        bot.loop.run_until_complete(engine.save_file(FakeClient(), media_file))
+    assert engine.stats()['parts'] == 0
+
+
+class FakeProgress:
+    """Status message updates of a job"""
+
+    def set_stage(self, stage):
+        pass
+
+    def update(self, current, total):
+        pass
+
+
+class PartsClient:
+    """Uploads later parts faster and records the order their messages are sent in"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.sent = []
+
+    async def save_file(self, path, progress=None):
+        await asyncio.sleep(0.05 if path.endswith('0.mp4') else 0)
+        return f'input:{path}'
+
+    async def send_video(self, chat_id, video, caption, progress=None, **attributes):
+        # A MediaClient takes the uploaded file instead of uploading the path again
+        assert self.bot.prepared_uploads.pop(video) == f'input:{video}'
+        self.sent.append(video)
+        return SimpleNamespace(video=SimpleNamespace(file_id=f'id:{os.path.basename(video)}'), audio=None, document=None)
+
+
+def make_parts(tmp_path, count):
+    """Paths of the parts of a split file"""
+    parts = [tmp_path / f'part{index}.mp4' for index in range(count)]
+    for path in parts:
+        path.write_bytes(b'x')
+    return [str(path) for path in parts]
+
+
+def test_parts_are_sent_in_order_after_concurrent_uploads(bot, tmp_path):
+    parts = make_parts(tmp_path, 3)
+    client = PartsClient(bot)
+    file_ids = bot.loop.run_until_complete(bot.upload_parts(client, 1, 'https://example.com/v', 'video', parts, FakeProgress()))
+    assert client.sent == parts
+    assert file_ids == 'id:part0.mp4,id:part1.mp4,id:part2.mp4'
+    assert bot.prepared_uploads == {}
+
+
+def test_parts_delivered_from_the_cache_are_not_uploaded_again(bot, tmp_path):
+    parts = make_parts(tmp_path, 2)
+    client = PartsClient(bot)
+    delivered = {'count': 2, 'file_ids': ['cached0']}
+    file_ids = bot.loop.run_until_complete(bot.upload_parts(client, 1, 'https://example.com/v', 'video', parts, FakeProgress(), delivered=delivered))
+    assert client.sent == parts[1:]
+    assert file_ids == 'cached0,id:part1.mp4'
+
+
+def test_upload_totals_are_exported_as_metrics(bot, engine, media_file, monkeypatch):
+    monkeypatch.setattr(bot, 'upload_engine', engine)
+    bot.loop.run_until_complete(engine.save_file(FakeClient(), media_file))
+    samples = {name: value for name, labels, value in bot.collect_metrics() if not labels}
+    assert samples['bot_upload_parts_total'] == 4
+    assert samples['bot_upload_engine_bytes_total'] == os.path.getsize(media_file)
+    assert samples['bot_upload_engine_bytes_per_second'] > 0
+    assert samples['bot_upload_active'] == 0
@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def conn(bot, tmp_path, monkeypatch):
+    """Connection to a fresh bot database in a temporary file, claiming as worker host/test"""
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'bot.db'))
+    monkeypatch.setattr(bot, 'WORKER_ID', 'host/test')
+    bot.init_db()
+    conn = sqlite3.connect(bot.DB_PATH)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def database(bot, conn, monkeypatch):
+    """Bot's write-behind database on the temporary file"""
+    database = bot.Database(bot.DB_PATH)
+    monkeypatch.setattr(bot, 'db', database)
+    yield database
+    bot.loop.run_until_complete(database.close())
+
+
+def add_job(conn, job_id, user_id, worker=None, heartbeat_age=None):
+    """Journals a job; heartbeat_age is seconds since its worker last marked it"""
+    heartbeat = f'-{heartbeat_age} seconds' if heartbeat_age is not None else None
+    conn.execute('''
+        INSERT INTO jobs (job_id, url, format_type, user_id, chat_id, message_id, stage, attempts, worker, heartbeat, date_created, date_updated)
+        VALUES (?, ?, 'video', ?, 1, 1, 'queued', 0, ?, datetime('now', ?), datetime('now'), datetime('now'))
+    ''', (job_id, f'https://example.com/{job_id}', user_id, worker, heartbeat))
+    conn.commit()
+
+
+def claim_all(bot, conn):
+    """Ids of the jobs claimed until the queue gives nothing more"""
+    claimed = []
+    while (row := bot.claim_job(conn)) is not None:
+        claimed.append(row[0])
+    return claimed
+
+
+def test_jobs_of_a_dead_worker_are_taken_over(bot, conn):
+    add_job(conn, 'dead1', 1, 'host/dead', 600)
+    add_job(conn, 'dead2', 1, 'host/dead', 600)
+    add_job(conn, 'new', 1)
+    claimed = claim_all(bot, conn)
+    # The user's limit is filled by the taken over jobs, the new one waits for them
+    assert len(claimed) == bot.MAX_CONCURRENT_DOWNLOADS
+    assert set(claimed) <= {'dead1', 'dead2', 'new'}
+    workers = dict(conn.execute('SELECT job_id, worker FROM jobs').fetchall())
+    assert [workers[job_id] for job_id in claimed] == ['host/test'] * len(claimed)
+
+
+def test_jobs_of_a_live_worker_count_toward_the_user_limit(bot, conn):
+    add_job(conn, 'alive1', 1, 'host/alive', 5)
+    add_job(conn, 'alive2', 1, 'host/alive', 5)
+    add_job(conn, 'new', 1)
+    add_job(conn, 'other', 2)
+    assert claim_all(bot, conn) == ['other']
+
+
+def test_jobs_of_the_bot_itself_go_to_the_workers_in_worker_mode(bot, conn, database):
+    add_job(conn, 'local1', 1, 'local')
+    add_job(conn, 'local2', 1, 'local')
+    add_job(conn, 'new', 1)
+    bot.loop.run_until_complete(bot.release_local_jobs())
+    claimed = claim_all(bot, conn)
+    assert len(claimed) == bot.MAX_CONCURRENT_DOWNLOADS
+    assert set(claimed) <= {'local1', 'local2', 'new'}
+
+
+def test_the_bot_without_workers_adopts_the_queued_jobs(bot, conn, database, monkeypatch):
+    add_job(conn, 'queued', 1)
+    add_job(conn, 'interrupted', 1, 'local')
+    add_job(conn, 'elsewhere', 1, 'host/alive', 5)
+    adopted = {}
+
+    async def adopt_job(client, row, resumed):
+        adopted[row[0]] = resumed
+
+    monkeypatch.setattr(bot, 'adopt_job', adopt_job)
+    monkeypatch.setattr(bot, 'WORKER_ID', 'local')
+    bot.loop.run_until_complete(bot.resume_jobs(None, adopt_queued=True))
+    assert adopted == {'queued': False, 'interrupted': True}
+    bot.loop.run_until_complete(database.close())
+    assert conn.execute("SELECT worker FROM jobs WHERE job_id = 'queued'").fetchone() == ('local',)
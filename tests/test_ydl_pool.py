@@ -0,0 +1,23 @@
+def test_job_parameters_are_undone_when_the_instance_comes_back(bot):
+    pool = bot.YdlPool(1)
+    with pool.checkout('metadata', concurrent_fragment_downloads=4, quiet=False) as ydl:
+        assert ydl.params['concurrent_fragment_downloads'] == 4
+    with pool.checkout('metadata') as reused:
+        assert reused is ydl
+        assert 'concurrent_fragment_downloads' not in reused.params
+        assert reused.params['quiet'] is True
+    pool.close()
+
+
+def test_pool_usage_is_exported_as_metrics(bot, monkeypatch):
+    pool = bot.YdlPool(1)
+    monkeypatch.setattr(bot, 'ydl_pool', pool)
+    for _ in range(2):
+        with pool.checkout('metadata'):
+            pass
+    samples = {(name, tuple(labels.items())): value for name, labels, value in bot.collect_metrics()}
+    assert samples[('bot_ydl_instances_total', (('result', 'created'),))] == 1
+    assert samples[('bot_ydl_instances_total', (('result', 'reused'),))] == 1
+    assert samples[('bot_ydl_idle', (('profile', 'metadata'),))] == 1
+    assert 'bot_ydl_idle' in bot.metrics.render(bot.collect_metrics())
+    pool.close()